@@ -1,9 +1,11 @@
 import json
 import time
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional
 from utils import make_request, log_message
-from config import OPENAI_CONFIG
+from config import OPENAI_CONFIG, THREAD_SUMMARY_INSTRUCTIONS
 from odoo import get_tool_output
+from tracing import traced, span, record_metric
+from rate_limiter import openai_limiter
 
 def create_thread() -> str:
     """
@@ -24,16 +26,28 @@ def create_thread() -> str:
             "content": "you are a helpful assistant"
         }]
     }
-    response = make_request('POST', url, headers, data)
+    response = make_request('POST', url, headers, data, on_response=openai_limiter.observe)
     return response["id"]
 
-def create_run(thread_id: str, additional_messages: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+@traced('create_run')
+def create_run(
+    thread_id: str,
+    additional_messages: Optional[List[Dict[str, Any]]] = None,
+    additional_instructions: Optional[str] = None,
+    tool_choice: Optional[str] = None,
+    metadata: Optional[Dict[str, str]] = None
+) -> Dict[str, Any]:
     """
-    Creates a run within a given thread with optional additional messages.
+    Creates a run within a given thread with optional additional messages. The
+    configured truncation strategy and prompt token cap bound the thread context
+    the run reads.
 
     Args:
         thread_id (str): The ID of the thread.
         additional_messages (Optional[List[Dict[str, Any]]]): Additional messages to include in the run.
+        additional_instructions (Optional[str]): Instructions appended to the assistant's instructions for this run.
+        tool_choice (Optional[str]): Overrides whether the run may call tools ('none', 'auto' or 'required').
+        metadata (Optional[Dict[str, str]]): Stored on the run and passed to its tool calls, e.g. the user's line_id.
 
     Returns:
         Dict[str, Any]: The created run.
@@ -52,10 +66,24 @@ def create_run(thread_id: str, additional_messages: Optional[List[Dict[str, Any]
 
     if additional_messages:
         data["additional_messages"] = additional_messages
+    if additional_instructions:
+        data["additional_instructions"] = additional_instructions
+    if tool_choice:
+        data["tool_choice"] = tool_choice
+    if metadata:
+        data["metadata"] = metadata
+    if OPENAI_CONFIG['truncation_last_messages']:
+        data["truncation_strategy"] = {
+            "type": "last_messages",
+            "last_messages": OPENAI_CONFIG['truncation_last_messages']
+        }
+    if OPENAI_CONFIG['max_prompt_tokens']:
+        data["max_prompt_tokens"] = OPENAI_CONFIG['max_prompt_tokens']
 
     try:
-        result = make_request('POST', url, headers, data)
-        log_message('info', f"Run started: {result}")
+        result = make_request('POST', url, headers, data, on_response=openai_limiter.observe)
+        log_message('info', "Run started", run_id=result.get('id'), thread_id=thread_id)
+        log_message('debug', lambda: f"Run object: {json.dumps(result)}", sampled=True)
         return result
     except Exception as e:
         error_message = str(e)
@@ -64,20 +92,29 @@ def create_run(thread_id: str, additional_messages: Optional[List[Dict[str, Any]
             active_run_id = error_message.split('run_')[1].split('.')[0]
             run = {'id': f'run_{active_run_id}', 'thread_id': thread_id}
             run_status = complete_run(run)
-            log_message('info', f'Previously active run status: {run_status}')
-            return make_request('POST', url, headers, data)
+            log_message('info', "Previously active run finished", run_id=run['id'], status=run_status.get('status'))
+            return make_request('POST', url, headers, data, on_response=openai_limiter.observe)
         else:
             raise e
 
-def complete_run(run: Dict[str, Any]) -> Dict[str, Any]:
+# Run metadata passed on to the tool calls: the user's LINE ID and the LINE webhook event
+RUN_CONTEXT_METADATA = ('line_id', 'event_id')
+
+# Called with the tool name, parameters and output after each tool call
+ToolOutputCallback = Callable[[str, Dict[str, Any], str], None]
+
+@traced('complete_run')
+def complete_run(run: Dict[str, Any], on_tool_output: Optional[ToolOutputCallback] = None) -> Dict[str, Any]:
     """
     Completes a run by checking its status and handling any required actions.
 
     Args:
         run (Dict[str, Any]): The run object.
+        on_tool_output (Optional[ToolOutputCallback]): Called after each tool call of the run.
 
     Returns:
-        Dict[str, Any]: The final status of the run.
+        Dict[str, Any]: The final status of the run, with the number of tool output
+        submissions added as 'requires_action_cycles'.
     """
     thread_id = run['thread_id']
     run_id = run['id']
@@ -88,9 +125,18 @@ def complete_run(run: Dict[str, Any]) -> Dict[str, Any]:
         "OpenAI-Beta": "assistants=v2"
     }
 
+    # Time spent in each run state (queued, in_progress, requires_action...) is
+    # recorded as a run_<status> stage when the run leaves that state.
+    last_status, status_since = None, time.perf_counter()
+    requires_action_cycles = 0
     while True:
-        run_status = make_request('GET', url, headers)
+        run_status = make_request('GET', url, headers, on_response=openai_limiter.observe)
         status = run_status.get('status')
+        if status != last_status:
+            now = time.perf_counter()
+            if last_status is not None:
+                record_metric(f"run_{last_status}", (now - status_since) * 1000)
+            last_status, status_since = status, now
 
         if status == 'completed':
             log_message('info', f"Run {run_id} completed.")
@@ -110,19 +156,57 @@ def complete_run(run: Dict[str, Any]) -> Dict[str, Any]:
         elif status == 'cancelled':
             log_message('error', f"Run {run_id} was cancelled.")
             raise Exception("Run was cancelled.")
+        elif status in ('incomplete', 'expired'):
+            # An incomplete run hit max_prompt_tokens or max_completion_tokens; an
+            # expired one waited too long for tool outputs. Neither will go on.
+            reason = (run_status.get('incomplete_details') or {}).get('reason', 'unknown')
+            log_message('error', f"Run {run_id} ended as {status}.", reason=reason)
+            raise Exception(f"Run ended as {status} (reason: {reason}).")
         elif status == 'requires_action' and run_status['required_action']['type'] == 'submit_tool_outputs':
-            submit_tool_outputs(run_status)
+            submit_tool_outputs(run_status, on_tool_output)
+            requires_action_cycles += 1
         else:
             time.sleep(0.5)
 
+    run_status['requires_action_cycles'] = requires_action_cycles
     return run_status
 
-def submit_tool_outputs(run_status: Dict[str, Any]) -> None:
+def get_run_usage(run_status: Dict[str, Any]) -> Dict[str, int]:
+    """
+    Extracts token usage and timing from a completed run.
+
+    Args:
+        run_status (Dict[str, Any]): The final status of the run, as returned by complete_run.
+
+    Returns:
+        Dict[str, int]: Counters for the run: token usage, requires_action cycles, seconds
+        spent queued (created_at to started_at) and running (started_at to completed_at).
+    """
+    usage = run_status.get('usage') or {}
+    created_at = run_status.get('created_at')
+    started_at = run_status.get('started_at')
+    completed_at = run_status.get('completed_at')
+
+    run_usage = {
+        'runs': 1,
+        'prompt_tokens': usage.get('prompt_tokens', 0),
+        'completion_tokens': usage.get('completion_tokens', 0),
+        'total_tokens': usage.get('total_tokens', 0),
+        'requires_action_cycles': run_status.get('requires_action_cycles', 0)
+    }
+    if created_at and started_at:
+        run_usage['queued_seconds'] = started_at - created_at
+    if started_at and completed_at:
+        run_usage['run_seconds'] = completed_at - started_at
+    return run_usage
+
+def submit_tool_outputs(run_status: Dict[str, Any], on_tool_output: Optional[ToolOutputCallback] = None) -> None:
     """
     Submits tool outputs required to complete the run.
 
     Args:
         run_status (Dict[str, Any]): The current status of the run.
+        on_tool_output (Optional[ToolOutputCallback]): Called after each tool call.
     """
     url = f"https://api.openai.com/v1/threads/{run_status['thread_id']}/runs/{run_status['id']}/submit_tool_outputs"
     headers = {
@@ -136,7 +220,13 @@ def submit_tool_outputs(run_status: Dict[str, Any]) -> None:
     for tool_call in tool_calls:
         tool_name = tool_call['function']['name']
         parameters = json.loads(tool_call['function']['arguments'])
-        output = get_tool_output(tool_name, parameters)
+        context = {'thread_id': run_status['thread_id'], 'run_id': run_status['id'], 'tool_call_id': tool_call['id']}
+        metadata = run_status.get('metadata') or {}
+        context.update({name: metadata[name] for name in RUN_CONTEXT_METADATA if metadata.get(name)})
+        with span(f"tool_{tool_name}"):
+            output = get_tool_output(tool_name, parameters, context)
+        if on_tool_output:
+            on_tool_output(tool_name, parameters, output)
         tool_outputs.append({
             "tool_call_id": tool_call['id'],
             "output": output
@@ -146,8 +236,9 @@ def submit_tool_outputs(run_status: Dict[str, Any]) -> None:
         "tool_outputs": tool_outputs
     }
 
-    make_request('POST', url, headers, data)
+    make_request('POST', url, headers, data, on_response=openai_limiter.observe)
 
+@traced('get_thread_messages')
 def get_thread_messages(thread_id: str) -> Dict[str, Any]:
     """
     Retrieves the messages for the given thread ID.
@@ -164,4 +255,72 @@ def get_thread_messages(thread_id: str) -> Dict[str, Any]:
         "Authorization": f"Bearer {OPENAI_CONFIG['api_key']}",
         "OpenAI-Beta": "assistants=v2"
     }
-    return make_request('GET', url, headers)
+    return make_request('GET', url, headers, on_response=openai_limiter.observe)
+
+def get_latest_message_text(thread_id: str) -> str:
+    """
+    Retrieves the text of the most recent message in a thread.
+
+    Args:
+        thread_id (str): The thread ID.
+
+    Returns:
+        str: The text of the most recent message, or an empty string if there is none.
+    """
+    messages = get_thread_messages(thread_id)
+    if messages['data']:
+        sorted_messages = sorted(messages['data'], key=lambda x: x['created_at'], reverse=True)
+        most_recent_message = sorted_messages[0]
+        for content_part in most_recent_message["content"]:
+            if content_part["type"] == "text":
+                return content_part["text"]["value"]
+    return ""
+
+@traced('summarize_thread')
+def summarize_thread(thread_id: str) -> str:
+    """
+    Has the assistant summarize a thread (partner, language, last order) without calling tools.
+
+    Args:
+        thread_id (str): The ID of the thread to summarize.
+
+    Returns:
+        str: The summary.
+    """
+    run = create_run(thread_id, additional_instructions=THREAD_SUMMARY_INSTRUCTIONS, tool_choice="none")
+    complete_run(run)
+    return get_latest_message_text(thread_id)
+
+def build_session_instructions(session: Dict[str, Any]) -> Optional[str]:
+    """
+    Builds compact run instructions from the stored session state, so the assistant
+    does not have to rediscover the customer's account or last order.
+
+    Args:
+        session (Dict[str, Any]): The session state stored for the user.
+
+    Returns:
+        Optional[str]: The additional instructions, or None if nothing is known.
+    """
+    lines = []
+    if session.get('partner_id') is not None:
+        lines.append(
+            f"The customer's LINE account is linked to partner_id {session['partner_id']} "
+            f"({session.get('partner_name', 'unknown name')}). Skip Step 2 and do not search for "
+            f"their account again unless they ask to use a different account."
+        )
+    elif session.get('partner_unbound_at'):
+        lines.append(
+            "The customer unlinked the account they used earlier in this conversation. Do not use "
+            "its partner_id; go through Step 2 again before creating an invoice."
+        )
+    if session.get('language'):
+        lines.append(f"The customer last wrote in language '{session['language']}'.")
+    last_invoice = session.get('last_invoice')
+    if last_invoice:
+        ordered = ', '.join(
+            f"product_id {product_id} x {quantity}"
+            for product_id, quantity in zip(last_invoice['product_ids'], last_invoice['quantities'])
+        )
+        lines.append(f"Their last invoice ({last_invoice.get('name')}) was: {ordered}. Use it for Step 3a (Reordering).")
+    return "\n".join(lines) or None
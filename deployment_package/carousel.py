@@ -0,0 +1,134 @@
+import json
+from typing import Any, Dict, List
+from urllib.parse import urlencode
+
+# LINE allows up to 12 bubbles in a carousel and 300 characters of postback data
+MAX_BUBBLES = 12
+MAX_DATA_CHARS = 300
+MAX_NAME_CHARS = 100
+
+MESSAGES = {
+    'th': {
+        'alt_text': "สินค้าที่พบ: {names}",
+        'price': "฿{price:,.2f}",
+        'in_stock': "คงเหลือ {quantity:g} ชิ้น",
+        'out_of_stock': "สินค้าหมด (สั่งจองได้)",
+        'order_button': "สั่งซื้อ",
+        'order_display': "สั่งซื้อ {name}",
+        'order_request': "ต้องการสั่งซื้อ {product} ค่ะ"
+    },
+    'en': {
+        'alt_text': "Products found: {names}",
+        'price': "฿{price:,.2f}",
+        'in_stock': "{quantity:g} in stock",
+        'out_of_stock': "Out of stock (can be ordered)",
+        'order_button': "Order",
+        'order_display': "Order {name}",
+        'order_request': "I would like to order {product}."
+    }
+}
+
+def _messages(language: str) -> Dict[str, str]:
+    return MESSAGES.get(language, MESSAGES['th'])
+
+def product_results(tool_name: str, result: str) -> List[Dict[str, Any]]:
+    """
+    Extracts the products from the output of a product search.
+
+    Args:
+        tool_name (str): The name of the tool.
+        result (str): The output of the tool.
+
+    Returns:
+        List[Dict[str, Any]]: The products found (empty for other tools, failures and empty searches).
+    """
+    if tool_name != "get_product_info_by_criteria":
+        return []
+    try:
+        products = json.loads(result)
+    except ValueError:
+        return []
+    return products if isinstance(products, list) else []
+
+def _bubble(product: Dict[str, Any], messages: Dict[str, str], language: str) -> Dict[str, Any]:
+    name = str(product.get('name') or f"#{product['id']}")[:MAX_NAME_CHARS]
+    quantity = float(product.get('qty_available') or 0)
+    stock = messages['in_stock'].format(quantity=quantity) if quantity > 0 else messages['out_of_stock']
+    data = urlencode({'action': 'order', 'product_id': product['id'], 'name': name, 'lang': language})
+    if len(data) > MAX_DATA_CHARS:
+        # Thai names grow ninefold when URL-encoded; the assistant can go by the ID alone
+        data = urlencode({'action': 'order', 'product_id': product['id'], 'lang': language})
+    return {
+        'type': 'bubble',
+        'size': 'kilo',
+        'body': {
+            'type': 'box',
+            'layout': 'vertical',
+            'spacing': 'sm',
+            'contents': [
+                {'type': 'text', 'text': name, 'weight': 'bold', 'size': 'md', 'wrap': True},
+                {'type': 'text', 'text': messages['price'].format(price=float(product.get('list_price') or 0)),
+                 'weight': 'bold', 'size': 'lg', 'color': '#1DB446'},
+                {'type': 'text', 'text': stock, 'size': 'sm', 'color': '#888888', 'wrap': True}
+            ]
+        },
+        'footer': {
+            'type': 'box',
+            'layout': 'vertical',
+            'contents': [{
+                'type': 'button',
+                'style': 'primary',
+                'height': 'sm',
+                'action': {
+                    'type': 'postback',
+                    'label': messages['order_button'],
+                    'data': data,
+                    'displayText': messages['order_display'].format(name=name)
+                }
+            }]
+        }
+    }
+
+def build_product_carousel(products: List[Dict[str, Any]], language: str) -> Dict[str, Any]:
+    """
+    Renders product search results as a LINE Flex carousel, one bubble per product
+    with its name, price, stock and an order button, so the assistant does not have
+    to write the results out. Products found by several searches are shown once.
+
+    Args:
+        products (List[Dict[str, Any]]): Products as returned by get_product_info_by_criteria.
+        language (str): The language of the labels ('th' or 'en').
+
+    Returns:
+        Dict[str, Any]: The LINE Flex message.
+    """
+    messages = _messages(language)
+    unique: Dict[Any, Dict[str, Any]] = {}
+    for product in products:
+        unique.setdefault(product['id'], product)
+    shown = list(unique.values())[:MAX_BUBBLES]
+    names = ", ".join(str(product.get('name')) for product in shown)
+    return {
+        'type': 'flex',
+        'altText': messages['alt_text'].format(names=names)[:400],
+        'contents': {
+            'type': 'carousel',
+            'contents': [_bubble(product, messages, language) for product in shown]
+        }
+    }
+
+def build_order_request(params: Dict[str, str]) -> str:
+    """
+    Builds the message an "order" postback forwards to the assistant, naming the
+    product and its ID so no search is needed to put it on an invoice.
+
+    Args:
+        params (Dict[str, str]): The postback parameters (product_id, lang and, if it fit, name).
+
+    Returns:
+        str: The message to send to the assistant on the user's behalf.
+    """
+    product = f"product_id {params['product_id']}"
+    if params.get('name'):
+        product = f"{params['name']} ({product})"
+    return _messages(params.get('lang', 'th'))['order_request'].format(product=product)
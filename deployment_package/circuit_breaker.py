@@ -0,0 +1,66 @@
+import time
+from typing import Callable, Optional
+from utils import log_message
+from tracing import record_metric
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+class CircuitBreaker:
+    """
+    Circuit breaker for a remote service, kept per container. It opens after
+    failure_threshold consecutive failures, so callers stop waiting on a service
+    that is down. After reset_seconds it goes half-open and lets calls through again
+    until the first of them succeeds, which closes it, or fails, which opens it for
+    another reset_seconds. A container serves one invocation at a time, so the calls
+    let through while half-open are those of a single probing invocation.
+    """
+
+    def __init__(self, name: str, failure_threshold: int, reset_seconds: float, on_close: Optional[Callable[[], None]] = None) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.on_close = on_close
+        self.state = CLOSED
+        self.failures = 0
+        # Every failure ever recorded, so a caller can tell whether its own calls failed
+        self.total_failures = 0
+        self.opened_at = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.failure_threshold > 0
+
+    def allow(self) -> bool:
+        """
+        Tells whether a call may be made now, turning an open breaker half-open once
+        it has waited reset_seconds.
+
+        Returns:
+            bool: True if the call may be made.
+        """
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_seconds:
+            self.state = HALF_OPEN
+            log_message('info', "Circuit half-open", breaker=self.name)
+        return self.state != OPEN
+
+    def record_success(self) -> None:
+        self.failures = 0
+        if self.state != CLOSED:
+            self.state = CLOSED
+            log_message('info', "Circuit closed", breaker=self.name)
+            if self.on_close:
+                self.on_close()
+
+    def record_failure(self) -> None:
+        self.total_failures += 1
+        if not self.enabled:
+            return
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != OPEN:
+                record_metric(f"{self.name}_circuit_opened", 1, 'Count')
+                log_message('warning', "Circuit opened", breaker=self.name, failures=self.failures)
+            self.state = OPEN
+            self.opened_at = time.monotonic()
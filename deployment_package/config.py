@@ -32,20 +32,111 @@ ODOO_CONFIG = {
     'url': get_env_var('ODOO_URL'),
     'db': get_env_var('ODOO_DB'),
     'username': get_env_var('ODOO_USERNAME'),
-    'password': get_env_var('ODOO_PASSWORD')
+    'password': get_env_var('ODOO_PASSWORD'),
+    'retry_attempts': int(get_env_var('ODOO_RETRY_ATTEMPTS', '3', required=False)),
+    'timeout_seconds': float(get_env_var('ODOO_TIMEOUT_SECONDS', '10', required=False)),
+    # Consecutive failed calls that open the circuit breaker (0 turns it off), and how
+    # long it stays open before a probe call is let through
+    'breaker_failures': int(get_env_var('ODOO_BREAKER_FAILURES', '5', required=False)),
+    'breaker_reset_seconds': float(get_env_var('ODOO_BREAKER_RESET_SECONDS', '30', required=False)),
+    # Queue invoices instead of creating them during the conversation; a scheduled
+    # drain creates them and confirms them to the customer through LINE
+    'async_invoices': get_env_var('ODOO_ASYNC_INVOICES', 'false', required=False).lower() == 'true'
 }
 
 OPENAI_CONFIG = {
     'api_key': get_env_var('OPENAI_API_KEY'),
-    'assistant_id': get_env_var('OPENAI_ASSISTANT_ID')
+    'assistant_id': get_env_var('OPENAI_ASSISTANT_ID'),
+    'truncation_last_messages': int(get_env_var('OPENAI_TRUNCATION_LAST_MESSAGES', '0', required=False)),
+    'max_prompt_tokens': int(get_env_var('OPENAI_MAX_PROMPT_TOKENS', '0', required=False)),
+    'thread_rotation_turns': int(get_env_var('THREAD_ROTATION_TURNS', '0', required=False))
 }
 
+# Prefix of the summary that seeds a rotated thread
+THREAD_SEED_PREFIX = 'Summary of the earlier conversation with this customer:'
+
+# Instructions for the run that condenses an old thread before it is rotated
+THREAD_SUMMARY_INSTRUCTIONS = '''
+    Do not reply to the customer. Summarize this conversation so it can be continued in a new conversation.
+    Include, when known: the customer's partner_id and account name, the language they speak,
+    the products (with product_ids and quantities) of their last order, and any unfinished request.
+    Be brief and factual.
+'''
+
 AWS_CONFIG = {
     'region_name': get_env_var('AWS_REGION_NAME'),
-    'table_name': get_env_var('AWS_TABLE_NAME')
+    'table_name': get_env_var('AWS_TABLE_NAME'),
+    'usage_table_name': get_env_var('AWS_USAGE_TABLE_NAME', required=False),
+    'write_queue_table_name': get_env_var('AWS_WRITE_QUEUE_TABLE_NAME', required=False),
+    'write_queue_lease_seconds': int(get_env_var('WRITE_QUEUE_LEASE_SECONDS', '900', required=False)),
+    'write_queue_retention_days': int(get_env_var('WRITE_QUEUE_RETENTION_DAYS', '7', required=False)),
+    'unfollow_retention_days': int(get_env_var('UNFOLLOW_RETENTION_DAYS', '30', required=False))
 }
 
 LINE_CONFIG = {
     'channel_secret': get_env_var('LINE_CHANNEL_SECRET'),
     'access_token': get_env_var('LINE_CHANNEL_ACCESS_TOKEN')
 }
+
+# Read-only tool outputs are cached per container; a TTL of 0 turns caching off for that tool
+TOOL_CACHE_CONFIG = {
+    'max_entries': int(get_env_var('TOOL_CACHE_MAX_ENTRIES', '256', required=False)),
+    'ttl_seconds': {
+        'get_product_info_by_criteria': int(get_env_var('TOOL_CACHE_PRODUCT_TTL', '300', required=False)),
+        'get_partner_info_by_criteria': int(get_env_var('TOOL_CACHE_PARTNER_TTL', '60', required=False))
+    }
+}
+
+# Normalized phone/email index of res.partner, synced incrementally; 0 turns it off
+PARTNER_INDEX_CONFIG = {
+    'sync_seconds': int(get_env_var('PARTNER_INDEX_SYNC_SECONDS', '60', required=False))
+}
+
+# Retry policy of HTTP calls to OpenAI and LINE
+HTTP_CONFIG = {
+    'timeout_seconds': float(get_env_var('HTTP_TIMEOUT_SECONDS', '30', required=False)),
+    'retry_attempts': int(get_env_var('HTTP_RETRY_ATTEMPTS', '4', required=False)),
+    'retry_base_seconds': float(get_env_var('HTTP_RETRY_BASE_SECONDS', '0.5', required=False)),
+    'retry_max_seconds': float(get_env_var('HTTP_RETRY_MAX_SECONDS', '8', required=False)),
+    # The longest wait a server may ask for (Retry-After); asking for more fails the request
+    'retry_after_max_seconds': float(get_env_var('HTTP_RETRY_AFTER_MAX_SECONDS', '20', required=False)),
+    # Time left for the rest of the invocation after the last retry
+    'deadline_margin_seconds': float(get_env_var('HTTP_DEADLINE_MARGIN_SECONDS', '3', required=False))
+}
+
+# Connections opened in parallel while Lambda initializes, so the first request does
+# not pay for DNS, TCP and TLS; init waits for them up to the timeout
+WARMUP_CONFIG = {
+    'on_init': get_env_var('WARMUP_ON_INIT', 'true', required=False).lower() == 'true',
+    'timeout_seconds': float(get_env_var('WARMUP_TIMEOUT_SECONDS', '3', required=False))
+}
+
+# Client-side budget for OpenAI calls, off unless the organization's requests-per-minute
+# limit is set; the tokens-per-minute limit is only enforced when it is set too
+RATE_LIMIT_CONFIG = {
+    'requests_per_minute': int(get_env_var('OPENAI_REQUESTS_PER_MINUTE', '0', required=False)),
+    'tokens_per_minute': int(get_env_var('OPENAI_TOKENS_PER_MINUTE', '0', required=False)),
+    # What one assistant turn is assumed to use: the run, its polls and tool output submissions
+    'turn_requests': int(get_env_var('RATE_LIMIT_TURN_REQUESTS', '10', required=False)),
+    'turn_tokens': int(get_env_var('RATE_LIMIT_TURN_TOKENS', '4000', required=False)),
+    # Share of the budget held back from lower priority work
+    'reserve': {
+        'low': float(get_env_var('RATE_LIMIT_LOW_RESERVE', '0.5', required=False)),
+        'normal': float(get_env_var('RATE_LIMIT_NORMAL_RESERVE', '0.2', required=False)),
+        'high': 0.0
+    },
+    'max_wait_seconds': float(get_env_var('RATE_LIMIT_MAX_WAIT_SECONDS', '5', required=False)),
+    # Shares the budget across Lambda instances when set (partition key bucket: S)
+    'table_name': get_env_var('RATE_LIMIT_TABLE_NAME', required=False)
+}
+
+LOG_CONFIG = {
+    'level': get_env_var('LOG_LEVEL', 'INFO', required=False).upper(),
+    'max_chars': int(get_env_var('LOG_MAX_CHARS', '2000', required=False)),
+    'debug_sample_rate': float(get_env_var('LOG_DEBUG_SAMPLE_RATE', '0.1', required=False))
+}
+
+METRICS_CONFIG = {
+    'namespace': get_env_var('METRICS_NAMESPACE', 'LINEChatbot', required=False),
+    'service': get_env_var('METRICS_SERVICE', 'line-chatbot', required=False)
+}
@@ -1,11 +1,60 @@
-import boto3
+import time
 from botocore.exceptions import ClientError
-from typing import Dict
-from config import AWS_CONFIG, OPENAI_CONFIG, INITIAL_MESSAGE
-from assistant import create_thread
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional, Tuple
+from config import AWS_CONFIG, OPENAI_CONFIG, INITIAL_MESSAGE, THREAD_SEED_PREFIX
+from assistant import create_thread, summarize_thread
 from utils import make_request, log_message
+from dynamodb_client import dynamodb
+from tracing import traced
+from rate_limiter import openai_limiter, PRIORITY_LOW
+from dynamodb_types import serializer, deserialize_item
 
-dynamodb = boto3.resource('dynamodb', region_name=AWS_CONFIG['region_name'])
+# The thread mapping is read and written through the container's shared client of
+# dynamodb_client.py. It has a fixed {line_id: S, thread_id: S, turns: N, created_at: N,
+# previous_thread_id: S, unfollowed_at: N, expires_at: N} schema, so those attributes
+# are marshalled by hand instead of going through the resource layer's TypeSerializer.
+# The session attributes stored on the same item hold nested values and go through
+# dynamodb_types.
+
+# Stand-in for the usage table when AWS_USAGE_TABLE_NAME is not set, keyed on (line_id, day).
+local_usage: Dict[Tuple[str, str], Dict[str, int]] = {}
+
+# Structured session state kept on the mapping item, so a returning customer's
+# partner, language and last order are known without asking the model to find them.
+# partner_id is the LINE account's binding to an Odoo partner; several LINE accounts
+# can be bound to the same partner.
+SESSION_FIELDS = (
+    'partner_id', 'partner_name', 'partner_bound_at', 'partner_unbound_at',
+    'language', 'last_invoice', 'awaiting_reply', 'session_updated_at'
+)
+
+def _thread_key(line_id: str) -> Dict[str, Dict[str, str]]:
+    """
+    Builds the DynamoDB key for a line_id in the thread mapping table.
+
+    Args:
+        line_id (str): The line ID of the user.
+
+    Returns:
+        Dict[str, Dict[str, str]]: The key in DynamoDB attribute value format.
+    """
+    return {'line_id': {'S': line_id}}
+
+def _now() -> str:
+    return str(int(time.time()))
+
+def _session_from_item(item: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Extracts the session state from a mapping item.
+
+    Args:
+        item (Dict[str, Dict[str, Any]]): The mapping item in DynamoDB attribute value format.
+
+    Returns:
+        Dict[str, Any]: The session fields present on the item.
+    """
+    return deserialize_item({name: item[name] for name in SESSION_FIELDS if name in item})
 
 def get_or_create_thread_id(line_id: str) -> str:
     """
@@ -18,22 +67,166 @@ def get_or_create_thread_id(line_id: str) -> str:
     Returns:
         str: The thread ID associated with the line ID.
     """
+    thread_id, _ = get_or_create_conversation(line_id)
+    return thread_id
+
+@traced('get_or_create_thread_id')
+def get_or_create_conversation(line_id: str, count_turn: bool = True) -> Tuple[str, Dict[str, Any]]:
+    """
+    Retrieves or creates the thread ID and session state for the given line_id in a
+    single DynamoDB call. If the user is new, an initial message is sent to start the
+    conversation. Each call counts one turn on the mapping; a thread that has already
+    served THREAD_ROTATION_TURNS turns is rotated before it is returned.
+
+    Args:
+        line_id (str): The line ID of the user.
+        count_turn (bool): Whether the call counts as a turn, False when the thread is
+            prepared ahead of the user's first message.
+
+    Returns:
+        Tuple[str, Dict[str, Any]]: The thread ID and the session state (see SESSION_FIELDS).
+    """
     table_name = AWS_CONFIG['table_name']
-    table = dynamodb.Table(table_name)
 
     try:
-        response = table.get_item(Key={'line_id': line_id})
-        if 'Item' in response:
-            return response['Item']['thread_id']
-        else:
-            thread_id = create_thread()
-            send_initial_message(thread_id, INITIAL_MESSAGE)
-            table.put_item(Item={'line_id': line_id, 'thread_id': thread_id})
-            return thread_id
+        response = dynamodb.update_item(
+            TableName=table_name,
+            Key=_thread_key(line_id),
+            UpdateExpression='ADD turns :one',
+            ExpressionAttributeValues={':one': {'N': '1' if count_turn else '0'}},
+            ReturnValues='ALL_NEW'
+        )
+        item = response['Attributes']
+        if 'thread_id' in item:
+            thread_id = item['thread_id']['S']
+            rotation_turns = OPENAI_CONFIG['thread_rotation_turns']
+            if count_turn and rotation_turns and int(item.get('turns', {}).get('N', '0')) > rotation_turns:
+                thread_id = rotate_thread(line_id, thread_id)
+            return thread_id, _session_from_item(item)
+
+        thread_id = create_thread()
+        send_initial_message(thread_id, INITIAL_MESSAGE)
+        try:
+            dynamodb.update_item(
+                TableName=table_name,
+                Key=_thread_key(line_id),
+                UpdateExpression='SET thread_id = :thread_id, created_at = :now',
+                ConditionExpression='attribute_not_exists(thread_id)',
+                ExpressionAttributeValues={':thread_id': {'S': thread_id}, ':now': {'N': _now()}}
+            )
+            return thread_id, {}
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            # A concurrent message created the thread first; use that one
+            response = dynamodb.get_item(TableName=table_name, Key=_thread_key(line_id), ConsistentRead=True)
+            return response['Item']['thread_id']['S'], _session_from_item(response['Item'])
     except ClientError as e:
         log_message('error', f"Failed to retrieve or create thread ID: {e}")
         raise Exception(f"Failed to retrieve or create thread ID: {e}")
 
+def follow_conversation(line_id: str) -> Optional[str]:
+    """
+    Prepares the thread of a user who added the bot, so their first message does not
+    wait for the thread to be created. Clears the expiry set when a returning user
+    blocked the bot, keeping their thread and session. Preparing the thread is low
+    priority work and is left to the first message when the OpenAI budget is low.
+
+    Args:
+        line_id (str): The line ID of the user.
+
+    Returns:
+        Optional[str]: The thread ID associated with the line ID, or None if it was not prepared.
+    """
+    try:
+        dynamodb.update_item(
+            TableName=AWS_CONFIG['table_name'],
+            Key=_thread_key(line_id),
+            UpdateExpression='REMOVE unfollowed_at, expires_at',
+            ConditionExpression='attribute_exists(line_id)'
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            log_message('error', f"Failed to restore mapping: {e}", line_id=line_id)
+    # Creating the thread and its initial message
+    if not openai_limiter.acquire(PRIORITY_LOW, {'requests': 2, 'tokens': 0}):
+        return None
+    thread_id, _ = get_or_create_conversation(line_id, count_turn=False)
+    return thread_id
+
+def unfollow_conversation(line_id: str) -> None:
+    """
+    Marks the mapping of a user who blocked the bot. With UNFOLLOW_RETENTION_DAYS set,
+    expires_at is set so DynamoDB's TTL removes the mapping unless the user adds the
+    bot again. Unknown users are ignored. Failures are logged.
+
+    Args:
+        line_id (str): The line ID of the user.
+    """
+    now = int(time.time())
+    retention_days = AWS_CONFIG['unfollow_retention_days']
+    values = {':now': {'N': str(now)}}
+    update = 'SET unfollowed_at = :now'
+    if retention_days:
+        values[':expires'] = {'N': str(now + retention_days * 86400)}
+        update += ', expires_at = :expires'
+
+    try:
+        dynamodb.update_item(
+            TableName=AWS_CONFIG['table_name'],
+            Key=_thread_key(line_id),
+            UpdateExpression=update,
+            ConditionExpression='attribute_exists(line_id)',
+            ExpressionAttributeValues=values
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            log_message('error', f"Failed to archive mapping: {e}", line_id=line_id)
+
+def rotate_thread(line_id: str, old_thread_id: str) -> str:
+    """
+    Replaces the user's thread with a fresh one. The old thread is summarized
+    (partner, language, last order) into a seed message for the new thread, and the
+    mapping is switched only if it still points to the old thread. This runs at the
+    start of a turn, before the turn's run is created, so no message can land in the
+    old thread after it was summarized. Failures are logged and leave the current
+    thread in place, and so does a low OpenAI budget, since the summary run is low
+    priority work.
+
+    Args:
+        line_id (str): The line ID of the user.
+        old_thread_id (str): The thread that has served THREAD_ROTATION_TURNS turns.
+
+    Returns:
+        str: The thread to use for the turn: the new one, or the old one if it was not rotated.
+    """
+    try:
+        if not openai_limiter.acquire(PRIORITY_LOW):
+            log_message('info', "Thread rotation deferred", line_id=line_id)
+            return old_thread_id
+
+        summary = summarize_thread(old_thread_id)
+        thread_id = create_thread()
+        send_initial_message(thread_id, f"{THREAD_SEED_PREFIX}\n{summary}")
+        dynamodb.update_item(
+            TableName=AWS_CONFIG['table_name'],
+            Key=_thread_key(line_id),
+            # The turn being started is the new thread's first
+            UpdateExpression='SET thread_id = :thread_id, previous_thread_id = :old, turns = :one, created_at = :now',
+            ConditionExpression='thread_id = :old',
+            ExpressionAttributeValues={
+                ':thread_id': {'S': thread_id},
+                ':old': {'S': old_thread_id},
+                ':one': {'N': '1'},
+                ':now': {'N': _now()}
+            }
+        )
+        log_message('info', "Thread rotated", line_id=line_id, old_thread_id=old_thread_id, thread_id=thread_id)
+        return thread_id
+    except Exception as e:
+        log_message('error', f"Failed to rotate thread: {e}", line_id=line_id)
+        return old_thread_id
+
 def send_initial_message(thread_id: str, message: str) -> None:
     """
     Sends an initial message to a new thread.
@@ -53,7 +246,7 @@ def send_initial_message(thread_id: str, message: str) -> None:
         "content": message
     }
 
-    make_request('POST', url, headers, data)
+    make_request('POST', url, headers, data, on_response=openai_limiter.observe)
 
 def is_new_user(line_id: str) -> bool:
     """
@@ -66,11 +259,118 @@ def is_new_user(line_id: str) -> bool:
         bool: True if the user is new, False otherwise.
     """
     table_name = AWS_CONFIG['table_name']
-    table = dynamodb.Table(table_name)
 
     try:
-        response = table.get_item(Key={'line_id': line_id})
-        return 'Item' not in response
+        response = dynamodb.get_item(
+            TableName=table_name,
+            Key=_thread_key(line_id),
+            ProjectionExpression='thread_id'
+        )
+        return 'thread_id' not in response.get('Item', {})
     except ClientError as e:
         log_message('error', f"Failed to check if user is new: {e}")
         raise Exception(f"Failed to check if user is new: {e}")
+
+def record_run_usage(line_id: str, run_usage: Dict[str, int], day: Optional[str] = None) -> None:
+    """
+    Adds the usage of a run to the user's daily aggregate. Uses DynamoDB atomic
+    counters in the usage table (partition key line_id, sort key day) when
+    AWS_USAGE_TABLE_NAME is set, and an in-memory stand-in otherwise. Failures
+    are logged and do not interrupt the conversation.
+
+    Args:
+        line_id (str): The LINE ID of the user.
+        run_usage (Dict[str, int]): Counters to add, as returned by assistant.get_run_usage.
+        day (Optional[str]): The UTC day (YYYY-MM-DD) to aggregate under, today by default.
+    """
+    day = day or datetime.now(timezone.utc).strftime('%Y-%m-%d')
+    table_name = AWS_CONFIG['usage_table_name']
+
+    if not table_name:
+        totals = local_usage.setdefault((line_id, day), {})
+        for name, value in run_usage.items():
+            totals[name] = totals.get(name, 0) + value
+        return
+
+    names = sorted(run_usage)
+    try:
+        dynamodb.update_item(
+            TableName=table_name,
+            Key={'line_id': {'S': line_id}, 'day': {'S': day}},
+            UpdateExpression='ADD ' + ', '.join(f'#c{i} :c{i}' for i in range(len(names))),
+            ExpressionAttributeNames={f'#c{i}': name for i, name in enumerate(names)},
+            ExpressionAttributeValues={f':c{i}': {'N': str(run_usage[name])} for i, name in enumerate(names)}
+        )
+    except ClientError as e:
+        log_message('error', f"Failed to record run usage: {e}", line_id=line_id)
+
+def get_session(line_id: str) -> Dict[str, Any]:
+    """
+    Retrieves the session state of a user without counting a turn.
+
+    Args:
+        line_id (str): The LINE ID of the user.
+
+    Returns:
+        Dict[str, Any]: The session fields stored for the user (empty if none).
+    """
+    try:
+        response = dynamodb.get_item(TableName=AWS_CONFIG['table_name'], Key=_thread_key(line_id))
+        return _session_from_item(response.get('Item', {}))
+    except ClientError as e:
+        log_message('error', f"Failed to retrieve session: {e}", line_id=line_id)
+        return {}
+
+def unbind_partner(line_id: str, partner_id: int) -> bool:
+    """
+    Removes the binding of a LINE account to a partner, along with the partner's last
+    invoice, so the next conversation identifies the customer again. Nothing changes
+    if the account is no longer bound to that partner.
+
+    Args:
+        line_id (str): The LINE ID of the user.
+        partner_id (int): The partner the user asked to unbind from.
+
+    Returns:
+        bool: True if the binding was removed, False otherwise.
+    """
+    try:
+        dynamodb.update_item(
+            TableName=AWS_CONFIG['table_name'],
+            Key=_thread_key(line_id),
+            UpdateExpression='SET partner_unbound_at = :now REMOVE partner_id, partner_name, partner_bound_at, last_invoice',
+            ConditionExpression='partner_id = :partner_id',
+            ExpressionAttributeValues={':now': {'N': _now()}, ':partner_id': {'N': str(partner_id)}}
+        )
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            log_message('error', f"Failed to unbind partner: {e}", line_id=line_id)
+        return False
+
+def update_session(line_id: str, updates: Dict[str, Any]) -> None:
+    """
+    Stores session fields on the user's mapping item. Failures are logged and do not
+    interrupt the conversation.
+
+    Args:
+        line_id (str): The LINE ID of the user.
+        updates (Dict[str, Any]): Session fields to set (see SESSION_FIELDS).
+    """
+    updates = {name: value for name, value in updates.items() if name in SESSION_FIELDS}
+    if not updates:
+        return
+    updates['session_updated_at'] = int(time.time())
+
+    names = sorted(updates)
+    try:
+        dynamodb.update_item(
+            TableName=AWS_CONFIG['table_name'],
+            Key=_thread_key(line_id),
+            UpdateExpression='SET ' + ', '.join(f'#s{i} = :s{i}' for i in range(len(names))),
+            ExpressionAttributeNames={f'#s{i}': name for i, name in enumerate(names)},
+            ExpressionAttributeValues={f':s{i}': serializer.serialize(updates[name]) for i, name in enumerate(names)}
+        )
+    except (ClientError, TypeError, ArithmeticError) as e:
+        # TypeError and ArithmeticError come from the serializer, e.g. on a float
+        log_message('error', f"Failed to update session: {e}", line_id=line_id)
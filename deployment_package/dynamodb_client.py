@@ -0,0 +1,7 @@
+from config import AWS_CONFIG
+from model_cache import create_session
+
+# The low-level DynamoDB client of the container, created once and reused across
+# invocations by every module that uses DynamoDB, so the service model is loaded
+# once and the connection pool warmer.py opens is the one requests go through.
+dynamodb = create_session().client('dynamodb', region_name=AWS_CONFIG['region_name'])
@@ -0,0 +1,109 @@
+from decimal import Decimal
+from typing import Any, Callable, Dict, Tuple
+from boto3.dynamodb.types import (
+    TypeSerializer, TypeDeserializer, Binary,
+    NULL, BOOLEAN, NUMBER, STRING, BINARY, MAP, LIST,
+    STRING_SET, NUMBER_SET, BINARY_SET
+)
+
+class FastTypeSerializer(TypeSerializer):
+    """
+    TypeSerializer that dispatches on the exact type of builtin values through a
+    lookup table instead of running the predicate chain for every value. Values
+    whose type is not in the table (sets, floats, subclasses such as IntEnum or
+    OrderedDict) fall back to the predicates, so results are identical.
+    """
+
+    def __init__(self) -> None:
+        self._dispatch: Dict[type, Tuple[str, Callable[[Any], Any]]] = {
+            type(None): (NULL, self._serialize_null),
+            bool: (BOOLEAN, self._serialize_bool),
+            int: (NUMBER, self._serialize_n),
+            Decimal: (NUMBER, self._serialize_n),
+            str: (STRING, self._serialize_s),
+            bytes: (BINARY, self._serialize_b),
+            bytearray: (BINARY, self._serialize_b),
+            Binary: (BINARY, self._serialize_b),
+            dict: (MAP, self._serialize_m),
+            list: (LIST, self._serialize_l),
+            tuple: (LIST, self._serialize_l),
+        }
+
+    def serialize(self, value: Any) -> Dict[str, Any]:
+        entry = self._dispatch.get(type(value))
+        if entry is None:
+            return super().serialize(value)
+        dynamodb_type, serializer = entry
+        return {dynamodb_type: serializer(value)}
+
+    def _serialize_l(self, value: Any) -> list:
+        serialize = self.serialize
+        return [serialize(v) for v in value]
+
+    def _serialize_m(self, value: Any) -> dict:
+        serialize = self.serialize
+        return {k: serialize(v) for k, v in value.items()}
+
+class FastTypeDeserializer(TypeDeserializer):
+    """
+    TypeDeserializer that looks up the deserializer for a DynamoDB type code in a
+    table instead of formatting a method name and calling getattr for every value.
+    """
+
+    def __init__(self) -> None:
+        self._dispatch: Dict[str, Callable[[Any], Any]] = {
+            NULL: self._deserialize_null,
+            BOOLEAN: self._deserialize_bool,
+            NUMBER: self._deserialize_n,
+            STRING: self._deserialize_s,
+            BINARY: self._deserialize_b,
+            NUMBER_SET: self._deserialize_ns,
+            STRING_SET: self._deserialize_ss,
+            BINARY_SET: self._deserialize_bs,
+            LIST: self._deserialize_l,
+            MAP: self._deserialize_m,
+        }
+
+    def deserialize(self, value: Dict[str, Any]) -> Any:
+        if not value:
+            return super().deserialize(value)
+        dynamodb_type = next(iter(value))
+        deserializer = self._dispatch.get(dynamodb_type)
+        if deserializer is None:
+            return super().deserialize(value)
+        return deserializer(value[dynamodb_type])
+
+    def _deserialize_l(self, value: list) -> list:
+        deserialize = self.deserialize
+        return [deserialize(v) for v in value]
+
+    def _deserialize_m(self, value: dict) -> dict:
+        deserialize = self.deserialize
+        return {k: deserialize(v) for k, v in value.items()}
+
+serializer = FastTypeSerializer()
+deserializer = FastTypeDeserializer()
+
+def serialize_item(item: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """
+    Converts a Python dictionary into a DynamoDB item.
+
+    Args:
+        item (Dict[str, Any]): The attributes of the item.
+
+    Returns:
+        Dict[str, Dict[str, Any]]: The item in DynamoDB attribute value format.
+    """
+    return {key: serializer.serialize(value) for key, value in item.items()}
+
+def deserialize_item(item: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Converts a DynamoDB item into a Python dictionary.
+
+    Args:
+        item (Dict[str, Dict[str, Any]]): The item in DynamoDB attribute value format.
+
+    Returns:
+        Dict[str, Any]: The attributes of the item.
+    """
+    return {key: deserializer.deserialize(value) for key, value in item.items()}
@@ -0,0 +1,136 @@
+import re
+from typing import Any, Dict, List, Union
+
+# LINE rejects text messages over 5000 characters, and a reply or push call
+# over five message objects
+LINE_TEXT_LIMIT = 5000
+MAX_MESSAGES_PER_CALL = 5
+
+CODE_FENCE = re.compile(r'^[ \t]*```[^\n]*\n?', re.MULTILINE)
+HEADING = re.compile(r'^[ \t]{0,3}#{1,6}[ \t]+(.*?)[ \t]*#*[ \t]*$', re.MULTILINE)
+HORIZONTAL_RULE = re.compile(r'^[ \t]{0,3}(?:[-*_][ \t]*){3,}$', re.MULTILINE)
+BULLET = re.compile(r'^([ \t]*)[-*+][ \t]+', re.MULTILINE)
+IMAGE = re.compile(r'!\[([^\]]*)\]\(([^)\s]+)[^)]*\)')
+LINK = re.compile(r'\[([^\]]+)\]\(([^)\s]+)[^)]*\)')
+BOLD = re.compile(r'(\*\*|__)(?=\S)(.+?)(?<=\S)\1')
+ITALIC = re.compile(r'(?<![\w*])\*(?=\S)([^*\n]+?)(?<=\S)\*(?![\w*])')
+INLINE_CODE = re.compile(r'`([^`\n]+)`')
+BLANK_LINES = re.compile(r'\n{3,}')
+
+def to_line_text(markdown: str) -> str:
+    """
+    Converts the markdown the assistant writes into plain text for a LINE bubble,
+    which shows markdown syntax literally. Emphasis and code markers are dropped,
+    headings become plain lines, bullets become '•' and links show their URL.
+
+    Args:
+        markdown (str): The assistant's reply.
+
+    Returns:
+        str: The reply as plain text.
+    """
+    text = markdown.replace('\r\n', '\n')
+    text = CODE_FENCE.sub('', text)
+    text = HEADING.sub(r'\1', text)
+    text = HORIZONTAL_RULE.sub('', text)
+    text = BULLET.sub(r'\1• ', text)
+    text = IMAGE.sub(r'\2', text)
+    text = LINK.sub(lambda m: m.group(2) if m.group(1) == m.group(2) else f"{m.group(1)}: {m.group(2)}", text)
+    text = BOLD.sub(r'\2', text)
+    text = ITALIC.sub(r'\1', text)
+    text = INLINE_CODE.sub(r'\1', text)
+    text = BLANK_LINES.sub('\n\n', text)
+    return text.strip()
+
+def line_length(text: str) -> int:
+    """
+    Measures text the way LINE counts it, in UTF-16 code units, so an emoji counts
+    as two characters.
+
+    Args:
+        text (str): The text to measure.
+
+    Returns:
+        int: The length of the text.
+    """
+    return len(text.encode('utf-16-le')) // 2
+
+def _hard_split(text: str, limit: int) -> List[str]:
+    chunks = []
+    while line_length(text) > limit:
+        cut = limit
+        while line_length(text[:cut]) > limit:
+            # Each character is one or two code units, so this never cuts below the limit
+            cut -= (line_length(text[:cut]) - limit + 1) // 2
+        # Break at the last space before the limit, unless that wastes most of the chunk
+        space = text.rfind(' ', 0, cut)
+        if space > cut // 2:
+            cut = space
+        chunks.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    if text:
+        chunks.append(text)
+    return chunks
+
+def _pack(pieces: List[str], separator: str, limit: int) -> List[str]:
+    chunks: List[str] = []
+    for piece in pieces:
+        if chunks and line_length(chunks[-1] + separator + piece) <= limit:
+            chunks[-1] += separator + piece
+        else:
+            chunks.append(piece)
+    return chunks
+
+def split_text(text: str, limit: int = LINE_TEXT_LIMIT) -> List[str]:
+    """
+    Splits text into chunks within the LINE text limit. Whole paragraphs are packed
+    together where they fit; a paragraph that does not fit is split between its lines,
+    so list items stay whole, and a line that does not fit is split between words.
+
+    Args:
+        text (str): The text to split.
+        limit (int): The maximum length of a chunk.
+
+    Returns:
+        List[str]: The chunks, in order.
+    """
+    pieces = []
+    for paragraph in text.split('\n\n'):
+        if line_length(paragraph) <= limit:
+            pieces.append(paragraph)
+            continue
+        lines = []
+        for line in paragraph.split('\n'):
+            lines.extend(_hard_split(line, limit))
+        pieces.extend(_pack(lines, '\n', limit))
+    return [chunk for chunk in _pack(pieces, '\n\n', limit) if chunk.strip()]
+
+def format_reply(message: Union[str, Dict[str, Any], List[Union[str, Dict[str, Any]]]]) -> List[Dict[str, Any]]:
+    """
+    Builds the LINE message objects for a reply. Text is converted from markdown and
+    split into as many text messages as it needs; message objects are sent as they are.
+
+    Args:
+        message (Union[str, Dict[str, Any], List[Union[str, Dict[str, Any]]]]): The text
+            to send, a LINE message object, or a list of them.
+
+    Returns:
+        List[Dict[str, Any]]: The message objects, in order.
+    """
+    if isinstance(message, list):
+        return [formatted for part in message for formatted in format_reply(part)]
+    if not isinstance(message, str):
+        return [message]
+    return [{'type': 'text', 'text': chunk} for chunk in split_text(to_line_text(message))]
+
+def batch_messages(messages: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+    """
+    Groups message objects into batches of at most MAX_MESSAGES_PER_CALL.
+
+    Args:
+        messages (List[Dict[str, Any]]): The message objects.
+
+    Returns:
+        List[List[Dict[str, Any]]]: The batches, in order.
+    """
+    return [messages[i:i + MAX_MESSAGES_PER_CALL] for i in range(0, len(messages), MAX_MESSAGES_PER_CALL)]
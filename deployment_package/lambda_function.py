@@ -4,22 +4,43 @@ contact information: ayden@lamparski.com
 '''
 
 import json
-import requests
 import hashlib
 import hmac
 import base64
-from typing import Any, Dict
-from assistant import create_run, complete_run, get_thread_messages
-from database import get_or_create_thread_id
-from utils import log_message
-from config import LINE_CONFIG
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Union
+from urllib.parse import parse_qsl
+from assistant import create_run, complete_run, get_latest_message_text, get_run_usage, build_session_instructions
+from database import (
+    get_or_create_conversation, record_run_usage, update_session, get_session,
+    follow_conversation, unfollow_conversation
+)
+from odoo import session_updates, queued_writes_due, drain_queued_writes, DRAIN_BATCH
+from reorder import handle_reorder_postback, invoice_created_message
+from carousel import product_results, build_product_carousel, build_order_request
+from router import Reply, route_message, observe_assistant_latency, canned_reply, unbind_account, message_priority, awaits_reply
+from utils import log_message, detect_language, make_request, set_deadline, time_left, RequestError
+from formatter import format_reply, batch_messages
+from rate_limiter import openai_limiter, PRIORITY_LOW, PRIORITY_NORMAL, PRIORITY_HIGH
+from warmer import warm_connections
+from config import LINE_CONFIG, WARMUP_CONFIG
+from tracing import start_trace, emit_trace, set_property, traced, record_metric
 
 CHANNEL_SECRET = LINE_CONFIG['channel_secret']
 CHANNEL_ACCESS_TOKEN = LINE_CONFIG['access_token']
 
+# Sent when handling a message or postback fails
+ERROR_REPLY = "Sorry, something went wrong."
+
+# Cold start: open the connections the first request needs while Lambda initializes
+if WARMUP_CONFIG['on_init']:
+    warm_connections(WARMUP_CONFIG['timeout_seconds'])
+
 def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     """
-    AWS Lambda handler for processing incoming LINE messages.
+    AWS Lambda handler for processing incoming LINE messages, and the scheduled
+    events of EventBridge rules.
 
     Args:
         event (Dict[str, Any]): The event data.
@@ -28,8 +49,82 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     Returns:
         Dict[str, Any]: The response dictionary.
     """
-    log_message('info', f"Event received: {json.dumps(event, default=str)}")
+    start_trace(getattr(context, 'aws_request_id', None))
+    # Retries of OpenAI and LINE calls must leave time to reply before the Lambda times out
+    set_deadline(context.get_remaining_time_in_millis() if hasattr(context, 'get_remaining_time_in_millis') else None)
+    try:
+        if event.get('source') == 'aws.events':
+            return handle_scheduled_event(event)
+        return process_webhook(event)
+    finally:
+        emit_trace()
+
+def handle_scheduled_event(event: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Run the action named in the detail of a scheduled EventBridge event, e.g.
+    {"action": "drain-invoices"} or {"action": "keep-warm"}.
+
+    Args:
+        event (Dict[str, Any]): The scheduled event.
+
+    Returns:
+        Dict[str, Any]: The response dictionary.
+    """
+    action = (event.get('detail') or {}).get('action')
+    handler = SCHEDULED_ACTIONS.get(action)
+    if handler is None:
+        log_message('warning', "Unknown scheduled action", action=action)
+        return {'statusCode': 400, 'body': json.dumps('Unknown action')}
+    log_message('info', "Scheduled action", action=action)
+    handler()
+    return {'statusCode': 200, 'body': json.dumps('Success')}
+
+def drain_invoices() -> None:
+    # Batches until the queue is empty, Odoo fails or the invocation runs out of time
+    while time_left() is None or time_left() > 0:
+        if drain_queued_writes(on_complete=confirm_queued_write) < DRAIN_BATCH:
+            break
+
+def confirm_queued_write(job: Dict[str, Any], result: str, succeeded: bool) -> None:
+    """
+    Apply the outcome of a queued write to the session of the user it was queued for,
+    and push them the confirmation of a queued invoice, or tell them it failed.
+
+    Args:
+        job (Dict[str, Any]): The queued write.
+        result (str): The output of the tool.
+        succeeded (bool): Whether the write succeeded.
+    """
+    line_id = job['context'].get('line_id')
+    if not line_id:
+        return
+    updates = session_updates(job['tool'], job['parameters'], result) if succeeded else {}
+    if updates:
+        update_session(line_id, updates)
+    if job['tool'] == 'create_invoice':
+        session = get_session(line_id)
+        send_line_push(line_id, format_reply(invoice_created_message(session, job['parameters'], updates)))
+
+def keep_warm() -> None:
+    # Keeps an idle container's connections open, and does nothing else
+    remaining = time_left()
+    warm_connections(WARMUP_CONFIG['timeout_seconds'] if remaining is None else max(remaining, 0))
+
+SCHEDULED_ACTIONS: Dict[str, Callable[[], None]] = {
+    'drain-invoices': drain_invoices,
+    'keep-warm': keep_warm,
+}
+
+def process_webhook(event: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Verify the webhook and handle each LINE event it contains.
+
+    Args:
+        event (Dict[str, Any]): The API Gateway event carrying the webhook.
 
+    Returns:
+        Dict[str, Any]: The response dictionary.
+    """
     headers = event.get('headers', {})
     body = event.get('body', '{}')
 
@@ -41,21 +136,132 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
 
     body = json.loads(body)
     events = body.get('events', [])
+    log_message('info', "Webhook received", event_count=len(events), event_types=[e.get('type') for e in events])
+    set_property('event_count', len(events))
+    log_message('debug', lambda: f"Webhook body: {json.dumps(body, ensure_ascii=False)}", sampled=True)
 
     for event in events:
-        if event['type'] == 'message' and event['message']['type'] == 'text':
-            reply_token = event['replyToken']
-            line_id = event['source']['userId']
-            user_message = event['message']['text']
-            log_message('info', f"User message received: {user_message}")
-            response_message = handle_user_message(line_id, user_message)
-            send_line_reply(reply_token, response_message)
+        handler = EVENT_HANDLERS.get(event['type'])
+        if handler is None:
+            log_message('info', "Event ignored", event_type=event['type'])
+            continue
+        handler(event)
+
+    # Odoo came back during this invocation; carry out the writes queued while it was down
+    if queued_writes_due():
+        drain_queued_writes(on_complete=confirm_queued_write)
 
     return {
         'statusCode': 200,
         'body': json.dumps('Success')
     }
 
+def handle_message_event(event: Dict[str, Any]) -> None:
+    """
+    Handle a message event. Text goes through the router and then the assistant;
+    stickers and other message types get a canned reply without an assistant run.
+
+    Args:
+        event (Dict[str, Any]): The LINE message event.
+    """
+    reply_token = event['replyToken']
+    line_id = event['source']['userId']
+    message_type = event['message']['type']
+
+    if message_type != 'text':
+        log_message('info', "Message received", line_id=line_id, message_type=message_type)
+        send_line_reply(reply_token, canned_reply(line_id, 'sticker' if message_type == 'sticker' else 'unsupported'), line_id)
+        return
+
+    user_message = event['message']['text']
+    log_message('info', "User message received", line_id=line_id, text=user_message,
+                redelivery=event.get('deliveryContext', {}).get('isRedelivery', False))
+    routed_reply = route_message(line_id, user_message)
+    if routed_reply is not None:
+        send_line_reply(reply_token, routed_reply, line_id)
+        return
+    started = time.perf_counter()
+    response_message = handle_user_message(line_id, user_message, message_priority(user_message), event.get('webhookEventId'))
+    send_line_reply(reply_token, response_message, line_id)
+    observe_assistant_latency((time.perf_counter() - started) * 1000)
+
+def handle_follow_event(event: Dict[str, Any]) -> None:
+    """
+    Handle a user adding the bot by preparing their thread ahead of their first
+    message. LINE sends the greeting configured for the channel, so there is no reply.
+
+    Args:
+        event (Dict[str, Any]): The LINE follow event.
+    """
+    line_id = event['source']['userId']
+    try:
+        thread_id = follow_conversation(line_id)
+        log_message('info', "User followed", line_id=line_id, thread_id=thread_id)
+    except Exception as e:
+        log_message('error', f"Error preparing thread: {e}", line_id=line_id)
+
+def handle_unfollow_event(event: Dict[str, Any]) -> None:
+    """
+    Handle a user blocking the bot by marking their mapping to expire.
+
+    Args:
+        event (Dict[str, Any]): The LINE unfollow event.
+    """
+    line_id = event['source']['userId']
+    log_message('info', "User unfollowed", line_id=line_id)
+    unfollow_conversation(line_id)
+
+def handle_postback_event(event: Dict[str, Any]) -> None:
+    """
+    Handle a postback from a button by dispatching its action directly, without an
+    assistant run. A failing action gets the generic error reply, so it does not fail
+    the other events of the webhook.
+
+    Args:
+        event (Dict[str, Any]): The LINE postback event.
+    """
+    reply_token = event['replyToken']
+    line_id = event['source']['userId']
+    params = dict(parse_qsl(event['postback']['data']))
+    action = params.get('action')
+    log_message('info', "Postback received", line_id=line_id, action=action)
+    handler = POSTBACK_ACTIONS.get(action)
+    if handler is None:
+        log_message('warning', "Unknown postback action", line_id=line_id, action=action)
+        return
+    try:
+        reply = handler(line_id, params)
+    except Exception as e:
+        log_message('error', f"Error handling postback: {e}", line_id=line_id, action=action)
+        reply = ERROR_REPLY
+    if reply is not None:
+        send_line_reply(reply_token, reply, line_id)
+
+# A postback action gets the user's LINE ID and the postback parameters, and returns
+# the reply, or None to send no reply
+PostbackHandler = Callable[[str, Dict[str, str]], Optional[Union[Reply, List[Reply]]]]
+
+def reorder_postback(line_id: str, params: Dict[str, str]) -> str:
+    return handle_reorder_postback(line_id, params, get_session(line_id))
+
+def order_postback(line_id: str, params: Dict[str, str]) -> Union[str, List[Reply]]:
+    # The button only names the product; the assistant confirms quantity and invoice details
+    return handle_user_message(line_id, build_order_request(params), PRIORITY_HIGH)
+
+POSTBACK_ACTIONS: Dict[str, PostbackHandler] = {
+    'order': order_postback,
+    'unbind': unbind_account,
+    'reorder': reorder_postback,
+    'reorder_cancel': reorder_postback,
+}
+
+EVENT_HANDLERS: Dict[str, Callable[[Dict[str, Any]], None]] = {
+    'message': handle_message_event,
+    'follow': handle_follow_event,
+    'unfollow': handle_unfollow_event,
+    'postback': handle_postback_event,
+}
+
 def verify_signature(headers: Dict[str, str], body: str) -> bool:
     """
     Verify the request signature.
@@ -79,48 +285,103 @@ def verify_signature(headers: Dict[str, str], body: str) -> bool:
         log_message('error', "Invalid signature")
     return is_valid
 
-def handle_user_message(line_id: str, user_message: str) -> str:
+def handle_user_message(
+    line_id: str,
+    user_message: str,
+    priority: str = PRIORITY_NORMAL,
+    event_id: Optional[str] = None
+) -> Union[str, List[Reply]]:
     """
-    Handle the user message and generate a response.
+    Handle the user message and generate a response. The stored session state is
+    passed to the run as additional instructions, and updated from the user's
+    language and the results of successful tool calls. Products found during the
+    run are shown as a Flex carousel after the assistant's text. When the OpenAI
+    budget is low, the run waits for it or, for lower priority messages, the user
+    is asked to try again later.
 
     Args:
         line_id (str): The user's LINE ID.
         user_message (str): The user's message.
+        priority (str): The priority of the run for the rate limiter.
+        event_id (Optional[str]): The webhookEventId of the LINE event, which LINE keeps
+            when it redelivers the event.
 
     Returns:
-        str: The response message.
+        Union[str, List[Reply]]: The response message, or the response message and the product carousel.
     """
+    updates: Dict[str, Any] = {}
+    products: List[Dict[str, Any]] = []
+
+    def collect_tool_output(tool_name: str, parameters: Dict[str, Any], output: str) -> None:
+        updates.update(session_updates(tool_name, parameters, output))
+        if tool_name == "get_product_info_by_criteria":
+            products.extend(product_results(tool_name, output))
+        else:
+            # The carousel only follows an answer to a product search, not a checkout or
+            # an invoice made from products found earlier in the run
+            products.clear()
+
     try:
-        thread_id = get_or_create_thread_id(line_id)
-        log_message('info', f"Thread ID: {thread_id}")
+        thread_id, session = get_or_create_conversation(line_id)
+        log_message('info', "Thread resolved", line_id=line_id, thread_id=thread_id, partner_id=session.get('partner_id'))
+
+        language = detect_language(user_message)
+        if language and language != session.get('language'):
+            updates['language'] = language
+        instructions = build_session_instructions({**session, **updates})
+
+        # An answer to the assistant's question is part of a conversation, not small talk
+        if priority == PRIORITY_LOW and session.get('awaiting_reply'):
+            priority = PRIORITY_NORMAL
+        if not openai_limiter.acquire(priority):
+            return canned_reply(line_id, 'busy')
 
         new_message = [{"role": "user", "content": user_message}]
-        run = create_run(thread_id, new_message)
-        run_status = complete_run(run)
-        messages = get_thread_messages(thread_id)
-        response_message = ""
-        if messages['data']:
-            sorted_messages = sorted(messages['data'], key=lambda x: x['created_at'], reverse=True)
-            most_recent_message = sorted_messages[0]
-            for content_part in most_recent_message["content"]:
-                if content_part["type"] == "text":
-                    response_message = content_part["text"]["value"]
-                    break
+        # line_id reaches the tool calls, so a queued invoice can be confirmed to the user,
+        # and event_id, so a redelivered event does not create its invoice again
+        metadata = {'line_id': line_id, **({'event_id': event_id} if event_id else {})}
+        run = create_run(thread_id, new_message, additional_instructions=instructions, metadata=metadata)
+        run_status = complete_run(run, on_tool_output=collect_tool_output)
+        run_usage = get_run_usage(run_status)
+        log_message('info', "Run usage", line_id=line_id, thread_id=thread_id, **run_usage)
+        for name in ('prompt_tokens', 'completion_tokens', 'requires_action_cycles'):
+            record_metric(name, run_usage[name], 'Count')
+        record_run_usage(line_id, run_usage)
+        response_message = get_latest_message_text(thread_id)
 
+        # Lets the router avoid answering a short "ok" meant as a reply to a question
+        awaiting_reply = awaits_reply(response_message)
+        if awaiting_reply != session.get('awaiting_reply', False):
+            updates['awaiting_reply'] = awaiting_reply
+        if products:
+            language = updates.get('language') or session.get('language') or 'th'
+            return [response_message, build_product_carousel(products, language)]
         return response_message
 
     except Exception as e:
         log_message('error', f"Error processing request: {e}")
-        return "Sorry, something went wrong."
+        return ERROR_REPLY
+    finally:
+        update_session(line_id, updates)
 
-def send_line_reply(reply_token: str, message: str) -> None:
+@traced('send_line_reply')
+def send_line_reply(reply_token: str, message: Union[Reply, List[Reply]], line_id: Optional[str] = None) -> None:
     """
-    Send a reply message back to the user via the LINE API.
+    Send a reply message back to the user via the LINE API. Text is converted from
+    markdown and split into several messages when it is over the LINE text limit.
+    A reply carries up to five messages; the rest are pushed to line_id.
 
     Args:
         reply_token (str): The reply token for the LINE message.
-        message (str): The message to send.
+        message (Union[Reply, List[Reply]]): The text or LINE message object to send, or a list of them.
+        line_id (Optional[str]): The user's LINE ID, needed to push messages past the fifth.
     """
+    messages = format_reply(message)
+    if not messages:
+        log_message('warning', "Empty reply not sent", line_id=line_id)
+        return
+    batches = batch_messages(messages)
+
     url = 'https://api.line.me/v2/bot/message/reply'
     headers = {
         'Content-Type': 'application/json',
@@ -128,10 +389,52 @@ def send_line_reply(reply_token: str, message: str) -> None:
     }
     data = {
         'replyToken': reply_token,
-        'messages': [{'type': 'text', 'text': message}]
+        'messages': batches[0]
     }
-    response = requests.post(url, headers=headers, data=json.dumps(data))
-    if response.status_code == 200:
-        log_message('info', f"Reply message sent: {message}")
-    else:
-        log_message('error', f"Error sending reply: {response.status_code} {response.text}")
+    try:
+        make_request('POST', url, headers, data)
+    except RequestError as e:
+        log_message('error', "Error sending reply", status_code=e.status_code, error=str(e))
+        return
+    log_message('info', "Reply message sent", messages=len(batches[0]),
+                chars=len(json.dumps(data['messages'], ensure_ascii=False)))
+    log_message('debug', lambda: f"Reply message: {message}", sampled=True)
+
+    if len(batches) > 1:
+        if line_id is None:
+            log_message('error', "Reply overflow dropped", messages=len(messages) - len(batches[0]))
+            return
+        for batch in batches[1:]:
+            send_line_push(line_id, batch)
+
+def send_line_push(line_id: str, messages: List[Dict[str, Any]]) -> bool:
+    """
+    Push messages to a user via the LINE API, for messages that do not fit in a reply.
+    The retry key lets LINE drop a duplicate if the request is sent again, so a 409
+    on a retry means an earlier attempt was accepted.
+
+    Args:
+        line_id (str): The user's LINE ID.
+        messages (List[Dict[str, Any]]): Up to five LINE message objects.
+
+    Returns:
+        bool: True if the messages were sent, False otherwise.
+    """
+    url = 'https://api.line.me/v2/bot/message/push'
+    headers = {
+        'Content-Type': 'application/json',
+        'Authorization': f'Bearer {CHANNEL_ACCESS_TOKEN}',
+        'X-Line-Retry-Key': str(uuid.uuid4())
+    }
+    data = {
+        'to': line_id,
+        'messages': messages
+    }
+    try:
+        make_request('POST', url, headers, data)
+    except RequestError as e:
+        if e.status_code != 409:
+            log_message('error', "Error sending push message", status_code=e.status_code, error=str(e))
+            return False
+    log_message('info', "Push message sent", line_id=line_id, messages=len(messages))
+    return True
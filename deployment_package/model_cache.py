@@ -0,0 +1,160 @@
+import gc
+import hashlib
+import marshal
+import os
+import sys
+from typing import Any, Optional
+import boto3
+import botocore.session
+from botocore.loaders import JSONFileLoader, create_loader, _JSON_OPEN_METHODS
+
+# Precompiled models live next to the JSON model they were built from, e.g.
+# botocore/data/dynamodb/2012-08-10/service-2.marshal next to service-2.json.gz.
+PRECOMPILED_SUFFIX = '.marshal'
+PRECOMPILED_FORMAT = 1
+
+def _find_source(file_path: str) -> Optional[str]:
+    """
+    Finds the JSON model botocore would load for a path without extension.
+
+    Args:
+        file_path (str): The full path to the model without the '.json' extension.
+
+    Returns:
+        Optional[str]: The path of the '.json' or '.json.gz' file, or None if there is none.
+    """
+    for ext in _JSON_OPEN_METHODS:
+        if os.path.isfile(file_path + ext):
+            return file_path + ext
+    return None
+
+def _digest(path: str) -> str:
+    """
+    Computes the SHA-256 digest of a file.
+
+    Args:
+        path (str): The path of the file.
+
+    Returns:
+        str: The hex digest of the file contents.
+    """
+    with open(path, 'rb') as fp:
+        return hashlib.sha256(fp.read()).hexdigest()
+
+def _plain(value: Any) -> Any:
+    """
+    Converts the OrderedDicts produced by botocore's JSON loader into plain dicts,
+    which keep insertion order and can be marshalled.
+
+    Args:
+        value (Any): The loaded JSON value.
+
+    Returns:
+        Any: The same value built from dicts, lists and scalars only.
+    """
+    if isinstance(value, dict):
+        return {key: _plain(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_plain(item) for item in value]
+    return value
+
+def _header() -> tuple:
+    """
+    Identifies the format and interpreter a precompiled model was written for,
+    since marshal data is only guaranteed to load on the same Python version.
+
+    Returns:
+        tuple: The format version, Python major/minor version and marshal version.
+    """
+    return (PRECOMPILED_FORMAT, sys.version_info[:2], marshal.version)
+
+def load_precompiled(file_path: str) -> Optional[Any]:
+    """
+    Loads the precompiled form of a model if it is present and still matches
+    the JSON model it was built from.
+
+    Args:
+        file_path (str): The full path to the model without the '.json' extension.
+
+    Returns:
+        Optional[Any]: The model data, or None if there is no valid precompiled form.
+    """
+    precompiled_path = file_path + PRECOMPILED_SUFFIX
+    if not os.path.isfile(precompiled_path):
+        return None
+
+    with open(precompiled_path, 'rb') as fp:
+        payload = fp.read()
+
+    # marshal.load on a file object reads in small chunks, so load from bytes. The
+    # models are acyclic, and pausing the collector avoids repeated collections
+    # while tens of thousands of containers are allocated.
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        header, source_name, source_digest, data = marshal.loads(payload)
+    except (EOFError, ValueError, TypeError):
+        return None
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    if header != _header():
+        return None
+
+    # A model without its JSON source is still valid, e.g. once a slim package
+    # build drops the JSON files it shipped precompiled.
+    source = _find_source(file_path)
+    if source is not None:
+        if os.path.basename(source) != source_name or _digest(source) != source_digest:
+            return None
+
+    return data
+
+def precompile(file_path: str) -> Optional[str]:
+    """
+    Writes the precompiled form of a JSON model next to it.
+
+    Args:
+        file_path (str): The full path to the model without the '.json' extension.
+
+    Returns:
+        Optional[str]: The path of the precompiled file, or None if there is no JSON model.
+    """
+    source = _find_source(file_path)
+    if source is None:
+        return None
+
+    data = _plain(JSONFileLoader().load_file(file_path))
+    precompiled_path = file_path + PRECOMPILED_SUFFIX
+    with open(precompiled_path, 'wb') as fp:
+        marshal.dump((_header(), os.path.basename(source), _digest(source), data), fp)
+    return precompiled_path
+
+class PrecompiledJSONFileLoader(JSONFileLoader):
+    """
+    JSON file loader that prefers a valid precompiled model over decompressing
+    and parsing the JSON file.
+    """
+
+    def exists(self, file_path: str) -> bool:
+        return os.path.isfile(file_path + PRECOMPILED_SUFFIX) or super().exists(file_path)
+
+    def load_file(self, file_path: str) -> Optional[Any]:
+        data = load_precompiled(file_path)
+        if data is not None:
+            return data
+        return super().load_file(file_path)
+
+def create_session() -> boto3.session.Session:
+    """
+    Creates a boto3 session whose data loader reads precompiled models when they exist.
+
+    Returns:
+        boto3.session.Session: The session to create clients from.
+    """
+    botocore_session = botocore.session.get_session()
+    loader = create_loader(botocore_session.get_config_variable('data_path'))
+    loader.file_loader = PrecompiledJSONFileLoader()
+    botocore_session.register_component('data_loader', loader)
+    return boto3.session.Session(botocore_session=botocore_session)
@@ -1,87 +1,572 @@
 import xmlrpc.client
+import hashlib
+import http.client
 import json
+import random
+import threading
+import time
+from decimal import Decimal
 from datetime import datetime
-from typing import List, Dict, Any, Optional
+from typing import Callable, List, Dict, Any, Optional, Tuple, TypeVar
 from config import ODOO_CONFIG
 from utils import connect_and_authenticate, log_message
+from tool_cache import tool_cache
+from partner_index import partner_index, SearchRead
+from circuit_breaker import CircuitBreaker
+from write_queue import write_queue, DONE, FAILED
+from tracing import record_metric
+
+T = TypeVar('T')
+
+# Identifies the tool call a tool runs for: thread_id, run_id and tool_call_id, and
+# line_id and the LINE webhook event_id when they are known
+ToolContext = Dict[str, str]
+
+# Parameters a tool cannot run without
+REQUIRED_PARAMETERS = {
+    'create_invoice': ('partner_id', 'product_ids', 'quantities'),
+    'confirm_partner': ('partner_id',),
+    'create_partner': ('name', 'street', 'city', 'email')
+}
+
+# Writes that can be carried out later: create_invoice is idempotent, and
+# create_partner returns the partner if it was created in the meantime
+QUEUEABLE_TOOLS = ('create_invoice', 'create_partner')
+
+# Queued writes carried out per drain
+DRAIN_BATCH = 10
+
+ODOO_UNAVAILABLE = (
+    "Odoo is temporarily unavailable and no cached result matches. Do not retry this tool "
+    "call now; ask the customer to try again in a few minutes."
+)
+WRITE_QUEUED = (
+    "Odoo is temporarily unavailable. The request was queued as job {job_id} and will be "
+    "carried out automatically when Odoo is back. Tell the customer it was received and "
+    "will be confirmed later, and do not call the tool again."
+)
+INVOICE_QUEUED = (
+    "The invoice request was received and queued as job {job_id}. SK-Medical's system will "
+    "create it shortly and send the customer the confirmation with the invoice number through "
+    "LINE. Tell the customer the order was received, and do not call create_invoice again."
+)
+
+# Invoices are queued only where the queue outlives the container: held in memory, an
+# order would be lost with the container, and no other container could drain it
+ASYNC_INVOICES = ODOO_CONFIG['async_invoices'] and write_queue.durable
+if ODOO_CONFIG['async_invoices'] and not ASYNC_INVOICES:
+    log_message('warning', "ODOO_ASYNC_INVOICES ignored: AWS_WRITE_QUEUE_TABLE_NAME is not set")
+
+# The authenticated Odoo session of the container, reused until a call fails. The
+# lock is held only to publish a session, never across a call to Odoo, so a request
+# never waits on the warmer; each thread connects on its own proxies until then.
+_session: Optional[Tuple[Any, int]] = None
+_session_lock = threading.RLock()
+
+# Set when the breaker closes, so the writes queued while it was open are carried out
+_writes_due = False
+
+def _on_breaker_close() -> None:
+    global _writes_due
+    _writes_due = True
+
+odoo_breaker = CircuitBreaker(
+    'odoo', ODOO_CONFIG['breaker_failures'], ODOO_CONFIG['breaker_reset_seconds'], on_close=_on_breaker_close
+)
+
+def odoo_session() -> Tuple[Optional[Any], Optional[int], str]:
+    """
+    Returns the Odoo session of the container, connecting and authenticating only
+    when there is none yet, or an error without trying while the circuit breaker
+    is open.
+
+    Returns:
+        tuple: A tuple containing the models proxy, user ID, and error message (empty if no error).
+    """
+    if not odoo_breaker.allow():
+        return None, None, ODOO_UNAVAILABLE
+    session = _session
+    if session is None:
+        models, uid, error = connect_and_authenticate()
+        if error:
+            odoo_breaker.record_failure()
+            return None, None, error
+        session = _publish_session(models, uid)
+    return session[0], session[1], ""
+
+def _publish_session(models: Any, uid: int) -> Tuple[Any, int]:
+    # Keeps the session another thread published first, if any
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = (models, uid)
+        return _session
+
+def warm_odoo_session() -> bool:
+    """
+    Opens the connection the tools use before the first tool call, and loads the
+    partner index if it is not loaded yet. Without a session yet, it authenticates
+    on proxies of its own, does both on them, and only then publishes them as the
+    container's session, so no other thread shares the proxies while it works. With
+    a session, it uses that one to keep its connection open.
+
+    Returns:
+        bool: True if Odoo answered and the partner index is loaded or turned off.
+    """
+    if not odoo_breaker.allow():
+        return False
+    session = _session
+    if session is None:
+        models, uid, error = connect_and_authenticate()
+        if error:
+            odoo_breaker.record_failure()
+            return False
+    else:
+        models, uid = session
+    try:
+        _with_retries(lambda: models.execute_kw(
+            ODOO_CONFIG['db'], uid, ODOO_CONFIG['password'],
+            'res.users', 'check_access_rights', ['read'], {'raise_exception': False}
+        ), attempts=1)
+    except Exception:
+        return False
+    loaded = _load_partner_index(models, uid)
+    if session is None:
+        _publish_session(models, uid)
+    return loaded
+
+def _record_failure() -> None:
+    global _session
+    # Reconnect on the next call, in case the server restarted
+    _session = None
+    odoo_breaker.record_failure()
+
+def _is_transient(error: Exception) -> bool:
+    """
+    Tells whether an Odoo call failed for a reason that may pass on a retry: a network
+    error, or an HTTP 429 or 5xx from the server. Faults raised by Odoo itself, such as
+    access or validation errors, are not transient.
+
+    Args:
+        error (Exception): The error raised by the call.
+
+    Returns:
+        bool: True if the call may be retried.
+    """
+    if isinstance(error, xmlrpc.client.ProtocolError):
+        return error.errcode == 429 or error.errcode >= 500
+    return isinstance(error, (OSError, http.client.HTTPException))
+
+def _with_retries(call: Callable[[], T], attempts: Optional[int] = None) -> T:
+    """
+    Runs an Odoo call, retrying transient failures up to ODOO_RETRY_ATTEMPTS times in
+    all with exponential backoff and jitter. Only idempotent calls may be retried.
+    The outcome is reported to the circuit breaker: a call that still fails with a
+    transient error counts as a failure, and one Odoo answered, even with a fault,
+    as a success.
+
+    Args:
+        call (Callable[[], T]): The call to run.
+        attempts (Optional[int]): Overrides the number of attempts; 1 for calls that
+            must not be repeated.
 
-def get_tool_output(tool_name: str, parameters: Dict[str, Any]) -> str:
+    Returns:
+        T: The result of the call.
+    """
+    attempts = attempts or ODOO_CONFIG['retry_attempts']
+    attempt = 1
+    while True:
+        try:
+            result = call()
+            odoo_breaker.record_success()
+            return result
+        except Exception as e:
+            if not _is_transient(e):
+                odoo_breaker.record_success()
+                raise
+            if attempt >= attempts or not odoo_breaker.allow():
+                _record_failure()
+                raise
+            delay = random.uniform(0, 0.25 * 2 ** (attempt - 1))
+            log_message('warning', "Retrying Odoo call", attempt=attempt, delay=round(delay, 3), error=str(e))
+            record_metric('odoo_retries', 1, 'Count')
+            time.sleep(delay)
+            attempt += 1
+
+def _execute_kw(models: Any, uid: int, model: str, method: str, args: List[Any], kwargs: Optional[Dict[str, Any]] = None) -> Any:
+    """
+    Calls an Odoo model method over XML-RPC, retrying transient failures. Only for
+    methods that are safe to repeat, such as reads.
+
+    Args:
+        models (Any): The Odoo models proxy.
+        uid (int): The authenticated user ID.
+        model (str): The name of the model, e.g. 'res.partner'.
+        method (str): The name of the method, e.g. 'search_read'.
+        args (List[Any]): The positional arguments of the method.
+        kwargs (Optional[Dict[str, Any]]): The keyword arguments of the method.
+
+    Returns:
+        Any: The result of the method.
+    """
+    return _with_retries(lambda: models.execute_kw(
+        ODOO_CONFIG['db'], uid, ODOO_CONFIG['password'], model, method, args, kwargs or {}
+    ))
+
+def _partner_search(models: Any, uid: int) -> SearchRead:
+    return lambda domain, kwargs: _execute_kw(models, uid, 'res.partner', 'search_read', [domain], kwargs)
+
+def _load_partner_index(models: Any, uid: int) -> bool:
+    # Loads the partner index, off the request path, if it has not been loaded yet in
+    # this container; True if it is loaded or turned off
+    if not partner_index.enabled or partner_index.loaded:
+        return True
+    try:
+        partner_index.sync(_partner_search(models, uid))
+    except Exception as e:
+        log_message('error', f"Failed to load partner index: {e}")
+        return False
+    return True
+
+def get_tool_output(tool_name: str, parameters: Dict[str, Any], context: Optional[ToolContext] = None) -> str:
     """
-    Executes the tool and returns its output, with logging.
+    Executes the tool and returns its output, with logging. Outputs of read-only
+    tools are served from the tool cache while they are fresh, and write tools drop
+    the cached outputs they make stale. While the Odoo circuit breaker is open, read
+    tools answer from cached records marked stale and write tools are queued. With
+    ODOO_ASYNC_INVOICES and a write queue table, create_invoice is checked without
+    calling Odoo and queued for the user in any case.
 
     Args:
         tool_name (str): The name of the tool.
         parameters (Dict[str, Any]): The parameters to be used by the tool.
+        context (Optional[ToolContext]): The thread, run and tool call the tool runs for,
+            which scopes the idempotency key of create_invoice.
 
     Returns:
         str: The output from the tool.
     """
     try:
-        if tool_name == "get_product_info_by_criteria":
-            name = parameters.get("name")
-            min_price = parameters.get("min_price")
-            max_price = parameters.get("max_price")
-            product_id = parameters.get("product_id")
-            in_stock = parameters.get("in_stock")
-            result = get_product_info_by_criteria(name, min_price, max_price, product_id, in_stock)
-        elif tool_name == "create_invoice":
-            partner_id = parameters.get("partner_id")
-            product_ids = parameters.get("product_ids")
-            quantities = parameters.get("quantities")
-            if partner_id is None or product_ids is None or quantities is None:
-                result = "Missing required parameters for create_invoice."
-            else:
-                result = create_invoice(partner_id, product_ids, quantities)
-        elif tool_name == "get_partner_info_by_criteria":
-            partner_id = parameters.get("partner_id")
-            name = parameters.get("name")
-            email = parameters.get("email")
-            phone = parameters.get("phone")
-            result = get_partner_info_by_criteria(partner_id, name, email, phone)
-        elif tool_name == "create_partner":
-            name = parameters.get("name")
-            street = parameters.get("street")
-            city = parameters.get("city")
-            email = parameters.get("email")
-            phone = parameters.get("phone")
-            zip = parameters.get("zip")
-            if name is None or street is None or city is None or email is None:
-                result = "Missing required parameters for create_partner."
-            else:
-                result = create_partner(name, street, city, email, phone, zip)
+        cached = tool_cache.get(tool_name, parameters)
+        if cached is not None:
+            log_message('info', "Tool call", tool=tool_name, parameters=parameters, result_chars=len(cached), cached=True)
+            return cached
+
+        if any(parameters.get(name) is None for name in REQUIRED_PARAMETERS.get(tool_name, ())):
+            result = f"Missing required parameters for {tool_name}."
+        elif tool_name == "create_invoice" and ASYNC_INVOICES and (context or {}).get('line_id'):
+            result = validate_invoice(parameters) or \
+                INVOICE_QUEUED.format(job_id=write_queue.enqueue(tool_name, parameters, context))
+        elif not odoo_breaker.allow():
+            result = degraded_tool_output(tool_name, parameters, context)
         else:
-            result = f"Unknown tool: {tool_name}"
+            result = run_tool(tool_name, parameters, context)
+            if not odoo_breaker.allow():
+                # This call opened the breaker
+                result = degraded_tool_output(tool_name, parameters, context)
+            else:
+                tool_cache.put(tool_name, parameters, result)
+                tool_cache.invalidate_for_write(tool_name, parameters)
 
-        # Log the tool call, parameters, and result
-        log_message('info', f"Tool call: {tool_name}, Parameters: {json.dumps(parameters)}, Result: {result}")
+        # Log the tool call and the size of its result; full results only go to sampled debug lines
+        log_message('info', "Tool call", tool=tool_name, parameters=parameters, result_chars=len(result))
+        log_message('debug', lambda: f"Tool result for {tool_name}: {result}", sampled=True)
 
         return result
     except Exception as e:
         error_message = f"Error, please make sure you made the correct tool call: {str(e)}"
-        log_message('error', f"Tool call: {tool_name}, Parameters: {json.dumps(parameters)}, Error: {error_message}")
+        log_message('error', "Tool call failed", tool=tool_name, parameters=parameters, error=error_message)
         return error_message
 
+def run_tool(tool_name: str, parameters: Dict[str, Any], context: Optional[ToolContext] = None) -> str:
+    """
+    Runs a tool against Odoo.
+
+    Args:
+        tool_name (str): The name of the tool.
+        parameters (Dict[str, Any]): The parameters to be used by the tool, with the required ones present.
+        context (Optional[ToolContext]): The thread, run and tool call the tool runs for.
+
+    Returns:
+        str: The output from the tool.
+    """
+    if tool_name == "get_product_info_by_criteria":
+        name = parameters.get("name")
+        min_price = parameters.get("min_price")
+        max_price = parameters.get("max_price")
+        product_id = parameters.get("product_id")
+        in_stock = parameters.get("in_stock")
+        names = parameters.get("names")
+        product_ids = parameters.get("product_ids")
+        return get_product_info_by_criteria(name, min_price, max_price, product_id, in_stock, names, product_ids)
+    if tool_name == "create_invoice":
+        partner_id = parameters["partner_id"]
+        product_ids = parameters["product_ids"]
+        quantities = parameters["quantities"]
+        key = invoice_idempotency_key(partner_id, product_ids, quantities, context)
+        return create_invoice(partner_id, product_ids, quantities, idempotency_key=key)
+    if tool_name == "get_partner_info_by_criteria":
+        partner_id = parameters.get("partner_id")
+        name = parameters.get("name")
+        email = parameters.get("email")
+        phone = parameters.get("phone")
+        return get_partner_info_by_criteria(partner_id, name, email, phone)
+    if tool_name == "confirm_partner":
+        return confirm_partner(parameters["partner_id"])
+    if tool_name == "create_partner":
+        name = parameters["name"]
+        street = parameters["street"]
+        city = parameters["city"]
+        email = parameters["email"]
+        phone = parameters.get("phone")
+        zip = parameters.get("zip")
+        return create_partner(name, street, city, email, phone, zip)
+    return f"Unknown tool: {tool_name}"
+
+def _cached_products(parameters: Dict[str, Any]) -> List[Dict[str, Any]]:
+    # Applies the criteria of get_product_info_by_criteria to the cached products
+    name_terms = [str(term).casefold() for term in [parameters.get("name"), *(parameters.get("names") or [])] if term]
+    id_terms = {int(term) for term in [parameters.get("product_id"), *(parameters.get("product_ids") or [])] if term}
+    min_price = parameters.get("min_price")
+    max_price = parameters.get("max_price")
+    products = []
+    for product in tool_cache.records("get_product_info_by_criteria"):
+        product_name = str(product.get('name') or '').casefold()
+        if (name_terms or id_terms) and product['id'] not in id_terms and not any(term in product_name for term in name_terms):
+            continue
+        price = float(product.get('list_price') or 0)
+        if (min_price and price < min_price) or (max_price and price > max_price):
+            continue
+        if parameters.get("in_stock") is not None and not float(product.get('qty_available') or 0) > 0:
+            continue
+        products.append({field: value for field, value in product.items() if field != 'matched_terms'})
+    return products[:20 * max(len(name_terms), 1) + len(id_terms)]
+
+def _cached_partners(parameters: Dict[str, Any]) -> List[Dict[str, Any]]:
+    # Applies the criteria of get_partner_info_by_criteria to the cached partners,
+    # matching email and phone through the partner index where it knows them
+    partner_id = parameters.get("partner_id")
+    name = parameters.get("name")
+    email = parameters.get("email")
+    phone = parameters.get("phone")
+    indexed_ids = partner_index.lookup(None, email=email, phone=phone) if email or phone else None
+    partners = []
+    for partner in tool_cache.records("get_partner_info_by_criteria"):
+        if partner_id is not None and partner['id'] != int(partner_id):
+            continue
+        if name and name.casefold() not in str(partner.get('name') or '').casefold():
+            continue
+        if indexed_ids is not None:
+            if partner['id'] not in indexed_ids:
+                continue
+        elif (email and email.casefold() not in str(partner.get('email') or '').casefold()) or \
+                (phone and phone not in str(partner.get('phone') or '')):
+            continue
+        partners.append(partner)
+    return partners[:20]
+
+def degraded_tool_output(tool_name: str, parameters: Dict[str, Any], context: Optional[ToolContext] = None) -> str:
+    """
+    Answers a tool call while Odoo is unavailable. Write tools are queued to be
+    carried out when Odoo is back. Read tools search the records cached by earlier
+    calls, which may be out of date, so each record returned is marked 'stale'.
+
+    Args:
+        tool_name (str): The name of the tool.
+        parameters (Dict[str, Any]): The parameters to be used by the tool.
+        context (Optional[ToolContext]): The thread, run and tool call the tool runs for.
+
+    Returns:
+        str: The output for the assistant.
+    """
+    record_metric('odoo_degraded', 1, 'Count')
+    if tool_name in QUEUEABLE_TOOLS:
+        return WRITE_QUEUED.format(job_id=write_queue.enqueue(tool_name, parameters, context))
+
+    if tool_name == "get_product_info_by_criteria":
+        records = _cached_products(parameters)
+    elif tool_name == "get_partner_info_by_criteria":
+        records = _cached_partners(parameters)
+    elif tool_name == "confirm_partner":
+        records = [
+            {'id': partner['id'], 'name': partner['name']}
+            for partner in _cached_partners({'partner_id': parameters['partner_id']})
+        ]
+    else:
+        records = []
+    log_message('warning', "Tool call served without Odoo", tool=tool_name, records=len(records))
+    if not records:
+        return ODOO_UNAVAILABLE
+    return json.dumps([{**record, 'stale': True} for record in records], indent=4)
+
+def queued_writes_due() -> bool:
+    """
+    Tells whether Odoo came back since writes were last queued in this container.
+
+    Returns:
+        bool: True if drain_queued_writes should run.
+    """
+    return _writes_due
+
+def _queued_invoices(jobs: List[Dict[str, Any]]) -> Dict[str, str]:
+    # Creates the queued invoices in one batch, keyed by job ID. If the batch fails as a
+    # whole, e.g. on one bad invoice, nothing is returned and each job runs on its own.
+    invoices = [job for job in jobs if job['tool'] == 'create_invoice']
+    if not invoices:
+        return {}
+    outputs = create_invoices([
+        (
+            job['parameters']['partner_id'], job['parameters']['product_ids'], job['parameters']['quantities'],
+            invoice_idempotency_key(
+                job['parameters']['partner_id'], job['parameters']['product_ids'],
+                job['parameters']['quantities'], job['context'] or None
+            )
+        )
+        for job in invoices
+    ])
+    if len(outputs) > 1 and all(output.startswith("Failed to create invoice:") for output in outputs):
+        return {}
+    return {job['job_id']: output for job, output in zip(invoices, outputs)}
+
+def drain_queued_writes(
+    limit: int = DRAIN_BATCH,
+    on_complete: Optional[Callable[[Dict[str, Any], str, bool], None]] = None
+) -> int:
+    """
+    Claims queued writes, oldest first, and carries them out, creating the queued
+    invoices with one account.move create call. Only jobs this call claimed are
+    carried out, so a job drained by two containers at once is confirmed once.
+    Draining stops as soon as a call fails on a transient error, a connection
+    failure or an open circuit breaker, putting the job that failed and the rest
+    back in the queue.
+
+    Args:
+        limit (int): The maximum number of queued writes to carry out.
+        on_complete (Optional[Callable[[Dict[str, Any], str, bool], None]]): Called with
+            each job carried out, its output and whether it succeeded.
+
+    Returns:
+        int: The number of queued writes carried out, successfully or not.
+    """
+    global _writes_due
+    _writes_due = False
+    if not odoo_breaker.allow():
+        return 0
+    # Failures recorded before this drain, e.g. by an earlier tool call, do not stop it
+    failures_before = odoo_breaker.total_failures
+
+    def failed() -> bool:
+        return odoo_breaker.total_failures != failures_before or not odoo_breaker.allow()
+
+    jobs = write_queue.claim(limit)
+    results = _queued_invoices(jobs)
+    if failed():
+        # The batch hit a connection, timeout or unavailable error, so none of its
+        # outputs is final
+        results = {}
+    executed = 0
+    for job in jobs:
+        result = results.get(job['job_id'])
+        if result is None and not failed():
+            result = run_tool(job['tool'], job['parameters'], job['context'] or None)
+            if failed():
+                result = None
+        if result is None:
+            # Left for a later drain; only outputs Odoo gave, such as an unknown
+            # product, complete a job as FAILED
+            write_queue.release(job)
+            continue
+        try:
+            succeeded = isinstance(json.loads(result), list)
+        except ValueError:
+            succeeded = False
+        if succeeded:
+            tool_cache.invalidate_for_write(job['tool'], job['parameters'])
+        write_queue.complete(job['job_id'], DONE if succeeded else FAILED, result)
+        log_message('info' if succeeded else 'error', "Queued write carried out",
+                    job_id=job['job_id'], tool=job['tool'], succeeded=succeeded)
+        if on_complete:
+            on_complete(job, result, succeeded)
+        executed += 1
+    return executed
+
+def session_updates(tool_name: str, parameters: Dict[str, Any], result: str) -> Dict[str, Any]:
+    """
+    Derives session state from a successful tool call, so a returning customer's
+    partner and last order are known without another lookup. The LINE account is
+    only bound to a partner the customer created or confirmed, never to a search
+    result, nor to an existing partner create_partner matched by the email or phone
+    the customer typed; the assistant has that one confirmed through confirm_partner.
+
+    Args:
+        tool_name (str): The name of the tool.
+        parameters (Dict[str, Any]): The parameters the tool was called with.
+        result (str): The output of the tool.
+
+    Returns:
+        Dict[str, Any]: Session fields to store (empty if the call failed or identifies nothing).
+    """
+    try:
+        records = json.loads(result)
+    except ValueError:
+        # Failures and empty searches are returned as plain messages
+        return {}
+    if not isinstance(records, list):
+        return {}
+
+    if tool_name in ("confirm_partner", "create_partner") and len(records) == 1:
+        if records[0].get('existing'):
+            return {}
+        return {
+            'partner_id': records[0]['id'],
+            'partner_name': records[0]['name'],
+            'partner_bound_at': int(datetime.now().timestamp())
+        }
+    if tool_name == "create_invoice" and records:
+        invoice = records[0]
+        return {
+            'last_invoice': {
+                'invoice_id': invoice['id'],
+                'name': invoice.get('name'),
+                # The model may send IDs as floats such as 12.0, which DynamoDB rejects
+                'partner_id': int(parameters['partner_id']),
+                'product_ids': [int(product_id) for product_id in parameters['product_ids']],
+                # DynamoDB numbers must be Decimal
+                'quantities': [Decimal(str(quantity)) for quantity in parameters['quantities']],
+                'created_at': int(datetime.now().timestamp())
+            }
+        }
+    return {}
+
 def get_product_info_by_criteria(
     name: Optional[str] = None,
     min_price: Optional[float] = None,
     max_price: Optional[float] = None,
     product_id: Optional[str] = None,
-    in_stock: Optional[bool] = None
+    in_stock: Optional[bool] = None,
+    names: Optional[List[str]] = None,
+    product_ids: Optional[List[int]] = None
 ) -> str:
     """
     Retrieves product information based on the given criteria from an Odoo server.
+    All names and product IDs are search terms combined with OR in one search_read,
+    so an English and a Thai name, or the products being compared, take one call.
+    The price and stock criteria apply to every term. Each product is returned once,
+    and with several terms it lists the terms it matched in 'matched_terms'.
 
     Args:
         name (Optional[str]): The name or partial name of the product.
         min_price (Optional[float]): The minimum price of the product.
         max_price (Optional[float]): The maximum price of the product.
-        reference (Optional[str]): The internal reference or code of the product.
+        product_id (Optional[str]): The ID of the product.
         in_stock (Optional[bool]): Whether to search for products that are currently in stock.
+        names (Optional[List[str]]): More names or partial names to search for.
+        product_ids (Optional[List[int]]): More product IDs to search for.
 
     Returns:
         str: Formatted information about matching products or an error message.
     """
-    models, uid, error = connect_and_authenticate()
+    models, uid, error = odoo_session()
     if error:
         return error
 
@@ -90,32 +575,69 @@ def get_product_info_by_criteria(
         'description_purchase', 'qty_available'
     ]
 
-    domain = []
-    if name:
-        domain.append(['name', 'ilike', name])
+    name_terms = list(dict.fromkeys(term for term in [name, *(names or [])] if term))
+    id_terms = list(dict.fromkeys(int(term) for term in [product_id, *(product_ids or [])] if term))
+    terms = [['name', 'ilike', term] for term in name_terms] + [['id', '=', term] for term in id_terms]
+
+    # Prefix notation: n terms are joined by n - 1 leading '|' operators, and the
+    # whole group is ANDed with the remaining criteria
+    domain: List[Any] = ['|'] * (len(terms) - 1) + terms if terms else []
     if min_price:
         domain.append(['list_price', '>=', min_price])
     if max_price:
         domain.append(['list_price', '<=', max_price])
-    if product_id:
-        domain.append(['id', '=', product_id])
     if in_stock is not None:
         domain.append(['qty_available', '>', 0])
+    # Up to 20 products per name, as for a single-name search
+    limit = 20 * max(len(name_terms), 1) + len(id_terms)
 
     try:
-        products = models.execute_kw(
-            ODOO_CONFIG['db'], uid, ODOO_CONFIG['password'],
-            'product.product', 'search_read',
-            [domain], {'fields': fields_of_interest, 'limit': 20}
+        products = _execute_kw(
+            models, uid, 'product.product', 'search_read',
+            [domain], {'fields': fields_of_interest, 'limit': limit}
         )
 
         if not products:
             return "No products found with the given criteria."
-        else:
-            return json.dumps(products, indent=4)
+
+        unique: Dict[int, Dict[str, Any]] = {}
+        for product in products:
+            unique.setdefault(product['id'], product)
+        if len(terms) > 1:
+            for product in unique.values():
+                product_name = str(product.get('name') or '').casefold()
+                product['matched_terms'] = (
+                    [term for term in name_terms if term.casefold() in product_name]
+                    + [term for term in id_terms if term == product['id']]
+                )
+        return json.dumps(list(unique.values()), indent=4)
     except Exception as e:
         return f"Failed to retrieve products: {e}"
 
+def get_product_names(product_ids: List[int]) -> Dict[int, str]:
+    """
+    Retrieves the names of products by ID from an Odoo server.
+
+    Args:
+        product_ids (List[int]): The product IDs.
+
+    Returns:
+        Dict[int, str]: The product names by ID; empty if the server could not be reached.
+    """
+    models, uid, error = odoo_session()
+    if error:
+        return {}
+
+    try:
+        products = _execute_kw(
+            models, uid, 'product.product', 'read',
+            [list(product_ids)], {'fields': ['name']}
+        )
+        return {product['id']: product['name'] for product in products}
+    except Exception as e:
+        log_message('error', f"Failed to retrieve product names: {e}")
+        return {}
+
 def get_partner_info_by_criteria(
     partner_id: Optional[int] = None,
     name: Optional[str] = None,
@@ -124,6 +646,9 @@ def get_partner_info_by_criteria(
 ) -> str:
     """
     Retrieves partner (contact) information based on the given criteria from an Odoo server.
+    An email or phone number that exactly matches a partner in the partner index, once
+    normalized, is read by ID instead of scanned for with ilike, so differently
+    formatted numbers for the same phone match.
 
     Args:
         partner_id (Optional[int]): The ID of the partner.
@@ -134,7 +659,7 @@ def get_partner_info_by_criteria(
     Returns:
         str: Formatted information about matching partners or an error message.
     """
-    models, uid, error = connect_and_authenticate()
+    models, uid, error = odoo_session()
     if error:
         return error
 
@@ -142,6 +667,23 @@ def get_partner_info_by_criteria(
         'name', 'email', 'phone', 'is_company', 'street', 'city', 'state_id', 'country_id'
     ]
 
+    if partner_id is None and (email or phone):
+        indexed_ids = partner_index.lookup(_partner_search(models, uid), email=email, phone=phone)
+        if indexed_ids:
+            try:
+                partners = _execute_kw(
+                    models, uid, 'res.partner', 'read', [indexed_ids], {'fields': fields_of_interest}
+                )
+                if name:
+                    partners = [
+                        partner for partner in partners
+                        if name.casefold() in str(partner.get('name') or '').casefold()
+                    ]
+                if partners:
+                    return json.dumps(partners, indent=4)
+            except Exception as e:
+                log_message('error', f"Failed to read indexed partners: {e}")
+
     domain = []
     if partner_id is not None:
         domain.append(['id', '=', partner_id])
@@ -153,9 +695,8 @@ def get_partner_info_by_criteria(
         domain.append(['phone', 'ilike', phone])
 
     try:
-        partners = models.execute_kw(
-            ODOO_CONFIG['db'], uid, ODOO_CONFIG['password'],
-            'res.partner', 'search_read',
+        partners = _execute_kw(
+            models, uid, 'res.partner', 'search_read',
             [domain], {'fields': fields_of_interest, 'limit': 20}
         )
 
@@ -166,52 +707,246 @@ def get_partner_info_by_criteria(
     except Exception as e:
         return f"Failed to retrieve partners: {e}"
 
-def create_invoice(partner_id: int, product_ids: List[int], quantities: List[float]) -> str:
+def confirm_partner(partner_id: int) -> str:
+    """
+    Confirms the partner the customer identified as their account, which binds their
+    LINE account to it.
+
+    Args:
+        partner_id (int): The ID of the partner.
+
+    Returns:
+        str: The partner's ID and name, or an error message.
+    """
+    models, uid, error = odoo_session()
+    if error:
+        return error
+
+    try:
+        partners = _execute_kw(
+            models, uid, 'res.partner', 'read', [[int(partner_id)]], {'fields': ['id', 'name']}
+        )
+        if not partners:
+            return f"No partner found with partner_id {partner_id}."
+        return json.dumps(partners, indent=4)
+    except Exception as e:
+        return f"Failed to confirm partner: {e}"
+
+def invoice_idempotency_key(
+    partner_id: int,
+    product_ids: List[int],
+    quantities: List[float],
+    context: Optional[ToolContext] = None
+) -> str:
+    """
+    Derives the idempotency key of an invoice from its contents, scoped to the LINE
+    webhook event that led to it, else to the run that requests it, or to the day when
+    there is neither. A redelivered event starts a new run but keeps its event ID, so
+    it finds the invoice made the first time. The tool_call_id is left out on purpose:
+    when the model re-issues the same create_invoice after a timeout, it does so under
+    a new tool call ID, and that must not create a second invoice.
+    A context that already carries an idempotency_key, such as a queued reorder,
+    keeps it.
+
+    Args:
+        partner_id (int): The ID of the partner (customer).
+        product_ids (List[int]): The product IDs of the invoice lines.
+        quantities (List[float]): The quantities of the invoice lines.
+        context (Optional[ToolContext]): The thread and run the invoice is created in.
+
+    Returns:
+        str: The idempotency key.
+    """
+    if context and context.get('idempotency_key'):
+        return context['idempotency_key']
+    content = json.dumps([int(partner_id), [int(p) for p in product_ids], [float(q) for q in quantities]])
+    if context and context.get('event_id'):
+        scope = f"event:{context['event_id']}"
+    elif context and context.get('run_id'):
+        scope = f"{context['thread_id']}:{context['run_id']}"
+    else:
+        scope = datetime.today().strftime('%Y-%m-%d')
+    return f"{scope}:{content}"
+
+def _invoice_ref(idempotency_key: str) -> str:
+    return f"chatbot-{hashlib.sha256(idempotency_key.encode('utf-8')).hexdigest()[:32]}"
+
+def create_invoice(
+    partner_id: int,
+    product_ids: List[int],
+    quantities: List[float],
+    idempotency_key: Optional[str] = None
+) -> str:
     """
     Creates an invoice in the Odoo system and returns the created invoice information.
+    The idempotency key is hashed into the invoice's reference ('ref'), and an invoice
+    that already carries it is returned instead of creating another one, so the call
+    can be retried safely.
 
     Args:
         partner_id (int): The ID of the partner (customer).
         product_ids (List[int]): A list of product IDs to be included in the invoice.
         quantities (List[float]): A list of quantities corresponding to each product ID in the invoice.
+        idempotency_key (Optional[str]): Identifies the request; derived from the contents
+            and the current day if not given.
 
     Returns:
         str: Formatted information about the created invoice or an error message.
     """
-    models, uid, error = connect_and_authenticate()
+    if idempotency_key is None:
+        idempotency_key = invoice_idempotency_key(partner_id, product_ids, quantities)
+    return create_invoices([(partner_id, product_ids, quantities, idempotency_key)])[0]
+
+# An invoice to create: partner ID, product IDs, quantities and idempotency key
+InvoiceRequest = Tuple[int, List[int], List[float], str]
+
+def create_invoices(invoices: List[InvoiceRequest]) -> List[str]:
+    """
+    Creates invoices in Odoo with one account.move create call, as create_invoice
+    does for one. Invoices that already exist, found by the ref derived from their
+    idempotency key, are returned instead of created, so a batch can be retried
+    safely. An invoice naming an unknown product fails on its own.
+
+    Args:
+        invoices (List[InvoiceRequest]): The invoices to create.
+
+    Returns:
+        List[str]: The output for each invoice, in order, as create_invoice returns it.
+    """
+    models, uid, error = odoo_session()
     if error:
-        return error
+        return [error] * len(invoices)
 
-    try:
-        invoice_lines = [(0, 0, {
-            'product_id': product_id,
-            'quantity': quantity,
-            'price_unit': models.execute_kw(
-                ODOO_CONFIG['db'], uid, ODOO_CONFIG['password'],
-                'product.product', 'read',
-                [[product_id]], {'fields': ['list_price']}
-            )[0]['list_price']
-        }) for product_id, quantity in zip(product_ids, quantities)]
+    refs = [_invoice_ref(key) for _, _, _, key in invoices]
+    fields = ['id', 'name', 'partner_id', 'invoice_line_ids', 'ref']
 
-        invoice_id = models.execute_kw(
+    def find_or_create() -> Dict[str, Any]:
+        found: Dict[str, Any] = {}
+        for invoice in models.execute_kw(
             ODOO_CONFIG['db'], uid, ODOO_CONFIG['password'],
-            'account.move', 'create', [{
+            'account.move', 'search_read', [[['ref', 'in', list(set(refs))]]], {'fields': fields}
+        ):
+            log_message('info', "Existing invoice found", invoice_id=invoice['id'], ref=invoice['ref'])
+            found[invoice['ref']] = {**invoice, 'existing': True}
+
+        missing = {ref: invoice for ref, invoice in zip(refs, invoices) if ref not in found}
+        if not missing:
+            return found
+        product_ids = sorted({int(product_id) for _, ids, _, _ in missing.values() for product_id in ids})
+        prices = {
+            product['id']: product['list_price']
+            for product in models.execute_kw(
+                ODOO_CONFIG['db'], uid, ODOO_CONFIG['password'],
+                'product.product', 'read', [product_ids], {'fields': ['list_price']}
+            )
+        }
+
+        values = []
+        created_refs = []
+        for ref, (partner_id, ids, quantities, _) in missing.items():
+            unknown = [product_id for product_id in ids if int(product_id) not in prices]
+            if unknown:
+                found[ref] = f"Failed to create invoice: unknown product_ids {unknown}"
+                continue
+            values.append({
                 'partner_id': partner_id,
                 'invoice_date': datetime.today().strftime('%Y-%m-%d'),
                 'move_type': 'out_invoice',  # Specify the type of invoice
-                'invoice_line_ids': invoice_lines,
-                'invoice_origin': 'Created by chatbot'
-            }]
-        )
+                'invoice_line_ids': [(0, 0, {
+                    'product_id': product_id,
+                    'quantity': quantity,
+                    'price_unit': prices[int(product_id)]
+                }) for product_id, quantity in zip(ids, quantities)],
+                'invoice_origin': 'Created by chatbot',
+                'ref': ref
+            })
+            created_refs.append(ref)
+        if values:
+            # The IDs come back in the order of the values
+            invoice_ids = models.execute_kw(
+                ODOO_CONFIG['db'], uid, ODOO_CONFIG['password'],
+                'account.move', 'create', [values]
+            )
+            refs_by_id = dict(zip(invoice_ids, created_refs))
+            for invoice in models.execute_kw(
+                ODOO_CONFIG['db'], uid, ODOO_CONFIG['password'],
+                'account.move', 'read', [invoice_ids], {'fields': fields}
+            ):
+                found[refs_by_id[invoice['id']]] = invoice
+        return found
 
-        invoice_info = models.execute_kw(
-            ODOO_CONFIG['db'], uid, ODOO_CONFIG['password'],
-            'account.move', 'read', [[invoice_id]], {'fields': ['id', 'name', 'partner_id', 'invoice_line_ids']}
+    try:
+        # A retry after a create whose response was lost finds the invoices by their ref
+        found = _with_retries(find_or_create)
+    except Exception as e:
+        return [f"Failed to create invoice: {e}"] * len(invoices)
+    return [
+        found[ref] if isinstance(found[ref], str)
+        else json.dumps([{field: value for field, value in found[ref].items() if field != 'ref'}], indent=4)
+        for ref in refs
+    ]
+
+def validate_invoice(parameters: Dict[str, Any]) -> Optional[str]:
+    """
+    Checks the shape of an invoice request before it is queued, without calling Odoo.
+    Products are not checked here: an unknown product_id fails that invoice when the
+    queue is drained, and the customer is told through LINE.
+
+    Args:
+        parameters (Dict[str, Any]): The parameters of the create_invoice call.
+
+    Returns:
+        Optional[str]: The problem to report to the assistant, or None if the request is valid.
+    """
+    product_ids = parameters['product_ids']
+    quantities = parameters['quantities']
+    if not product_ids or len(product_ids) != len(quantities):
+        return "Invalid create_invoice call: give one quantity for each product_id."
+    try:
+        if any(float(quantity) <= 0 for quantity in quantities):
+            return "Invalid create_invoice call: quantities must be positive."
+        if any(int(product_id) <= 0 for product_id in product_ids):
+            return "Invalid create_invoice call: product_ids must be IDs from get_product_info_by_criteria."
+    except (TypeError, ValueError):
+        return "Invalid create_invoice call: product_ids and quantities must be numbers."
+    return None
+
+def find_existing_partner(models: Any, uid: int, email: Optional[str], phone: Optional[str]) -> Optional[Dict[str, Any]]:
+    """
+    Finds a partner that already has the given email or phone number, first by exact
+    normalized match in the partner index, then with a case-insensitive exact match
+    (=ilike) in Odoo for partners the index has not seen yet.
+
+    Args:
+        models (Any): The Odoo models proxy.
+        uid (int): The authenticated user ID.
+        email (Optional[str]): The email address of the new partner.
+        phone (Optional[str]): The phone number of the new partner.
+
+    Returns:
+        Optional[Dict[str, Any]]: The existing partner's id and name, or None if there is none.
+    """
+    search_read = _partner_search(models, uid)
+    indexed_ids = partner_index.lookup(search_read, email=email) or partner_index.lookup(search_read, phone=phone)
+    if indexed_ids:
+        partners = _execute_kw(
+            models, uid, 'res.partner', 'read', [indexed_ids[:1]], {'fields': ['id', 'name']}
         )
+        if partners:
+            return partners[0]
 
-        return json.dumps(invoice_info, indent=4)
-    except Exception as e:
-        return f"Failed to create invoice: {e}"
+    terms = []
+    if email:
+        terms.append(['email', '=ilike', email.strip()])
+    if phone:
+        terms.append(['phone', '=ilike', phone.strip()])
+    if not terms:
+        return None
+    partners = _execute_kw(
+        models, uid, 'res.partner', 'search_read',
+        [['|'] * (len(terms) - 1) + terms], {'fields': ['id', 'name'], 'limit': 1, 'order': 'id asc'}
+    )
+    return partners[0] if partners else None
 
 def create_partner(
     name: str,
@@ -222,7 +957,8 @@ def create_partner(
     zip: Optional[str] = None
 ) -> str:
     """
-    Creates a partner in the Odoo database.
+    Creates a partner in the Odoo database, unless a partner with the same email or
+    phone number already exists, in which case that partner is returned instead.
 
     Args:
         name (str): The name of the partner.
@@ -233,12 +969,20 @@ def create_partner(
         zip (Optional[str]): The zip code of the partner.
 
     Returns:
-        str: A message indicating the result of the operation, including the partner details.
+        str: The partner's id and name, with 'existing' set if it was already there, or an error message.
     """
-    models, uid, error = connect_and_authenticate()
+    models, uid, error = odoo_session()
     if error:
         return error
 
+    try:
+        existing = find_existing_partner(models, uid, email, phone)
+    except Exception as e:
+        return f"Failed to create partner: {e}"
+    if existing is not None:
+        log_message('info', "Existing partner found", partner_id=existing['id'])
+        return json.dumps([{'id': existing['id'], 'name': existing['name'], 'existing': True}], indent=4)
+
     comment = f"Created by the chatbot on {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
 
     partner_data: Dict[str, Any] = {
@@ -255,16 +999,13 @@ def create_partner(
         partner_data['zip'] = zip
 
     try:
-        partner_id = models.execute_kw(
+        # Not repeated: a create whose response was lost would make a duplicate
+        partner_id = _with_retries(lambda: models.execute_kw(
             ODOO_CONFIG['db'], uid, ODOO_CONFIG['password'],
             'res.partner', 'create', [partner_data]
-        )
-
-        partner_info = models.execute_kw(
-            ODOO_CONFIG['db'], uid, ODOO_CONFIG['password'],
-            'res.partner', 'read', [[partner_id]], {'fields': ['id', 'name']}
-        )
+        ), attempts=1)
+        partner_index.add(partner_id, email, phone)
 
-        return json.dumps(partner_info, indent=4)
+        return json.dumps([{'id': partner_id, 'name': name, 'existing': False}], indent=4)
     except Exception as e:
         return f"Failed to create partner: {e}"
@@ -0,0 +1,197 @@
+import re
+import time
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+from config import PARTNER_INDEX_CONFIG
+from utils import log_message
+from tracing import record_metric, span
+
+NON_DIGITS = re.compile(r'\D')
+
+# Partners read per search_read call when syncing
+SYNC_PAGE_SIZE = 500
+
+# Runs a res.partner search_read with a domain and keyword arguments (fields, order,
+# offset, limit), with the caller's retries and circuit breaker
+SearchRead = Callable[[List[Any], Dict[str, Any]], List[Dict[str, Any]]]
+
+def normalize_phone(phone: Optional[str]) -> Optional[str]:
+    """
+    Normalizes a phone number to E.164, reading numbers in Thai national format
+    (a leading 0, or 9 digits without it) as Thai, so "081-234-5678",
+    "+66 81 234 5678" and "0812345678" share one key. Other numbers without a
+    country code, such as "1-800-555-0100", cannot be placed and are not indexed.
+
+    Args:
+        phone (Optional[str]): The phone number as entered.
+
+    Returns:
+        Optional[str]: The number in E.164 form, or None if it is not a usable number.
+    """
+    if not phone:
+        return None
+    phone = phone.strip()
+    digits = NON_DIGITS.sub('', phone)
+    if not phone.startswith('+'):
+        if digits.startswith('00'):
+            digits = digits[2:]
+        elif digits.startswith('0'):
+            digits = '66' + digits[1:]
+        elif len(digits) == 9:
+            digits = '66' + digits
+        elif not (digits.startswith('66') and len(digits) in (10, 11)):
+            return None
+    if digits.startswith('660'):
+        # "+66 (0)81 ..." keeps the trunk prefix
+        digits = '66' + digits[3:]
+    # Thai numbers have 8 or 9 digits after the country code; E.164 allows 15 in all
+    if len(digits) < 10 or len(digits) > 15:
+        return None
+    return '+' + digits
+
+def normalize_email(email: Optional[str]) -> Optional[str]:
+    """
+    Normalizes an email address for exact matching.
+
+    Args:
+        email (Optional[str]): The email address as entered.
+
+    Returns:
+        Optional[str]: The lowercased address, or None if it is not an address.
+    """
+    if not email:
+        return None
+    email = email.strip().lower()
+    return email if '@' in email else None
+
+class PartnerIndex:
+    """
+    In-memory index from normalized phone numbers and email addresses to res.partner
+    IDs, kept per container. Every active partner is loaded in pages off the request
+    path, by the warmer; until then lookups miss and callers search Odoo. Later
+    lookups re-read only the partners written since the last sync, at most once
+    every PARTNER_INDEX_SYNC_SECONDS.
+    """
+
+    def __init__(self, sync_seconds: int) -> None:
+        self.sync_seconds = sync_seconds
+        self.by_phone: Dict[str, Set[int]] = {}
+        self.by_email: Dict[str, Set[int]] = {}
+        self.partner_keys: Dict[int, Tuple[Optional[str], Optional[str]]] = {}
+        self.synced_write_date: Optional[str] = None
+        self.synced_at: Optional[float] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.sync_seconds > 0
+
+    @property
+    def loaded(self) -> bool:
+        return self.synced_at is not None
+
+    def add(self, partner_id: int, email: Optional[str], phone: Optional[str]) -> None:
+        """
+        Indexes a partner under its normalized email and phone, replacing its old keys.
+
+        Args:
+            partner_id (int): The ID of the partner.
+            email (Optional[str]): The email address of the partner.
+            phone (Optional[str]): The phone number of the partner.
+        """
+        self.remove(partner_id)
+        keys = (normalize_email(email), normalize_phone(phone))
+        if keys[0]:
+            self.by_email.setdefault(keys[0], set()).add(partner_id)
+        if keys[1]:
+            self.by_phone.setdefault(keys[1], set()).add(partner_id)
+        self.partner_keys[partner_id] = keys
+
+    def remove(self, partner_id: int) -> None:
+        email, phone = self.partner_keys.pop(partner_id, (None, None))
+        for index, key in ((self.by_email, email), (self.by_phone, phone)):
+            if key and key in index:
+                index[key].discard(partner_id)
+                if not index[key]:
+                    del index[key]
+
+    def sync(self, search_read: SearchRead) -> None:
+        """
+        Reads the partners written since the last sync (every active partner on the
+        first sync), SYNC_PAGE_SIZE at a time, and updates the index. Partners
+        archived since the last sync are dropped from it.
+
+        Args:
+            search_read (SearchRead): Runs the res.partner search_read calls.
+        """
+        if self.synced_write_date:
+            # write_date has one-second precision, so re-read the last second
+            domain: List[Any] = [['active', 'in', [True, False]], ['write_date', '>=', self.synced_write_date]]
+        else:
+            domain = []
+        partners: List[Dict[str, Any]] = []
+        with span('partner_index_sync'):
+            while True:
+                page = search_read(domain, {
+                    'fields': ['email', 'phone', 'active', 'write_date'],
+                    'order': 'write_date asc, id asc',
+                    'offset': len(partners),
+                    'limit': SYNC_PAGE_SIZE
+                })
+                partners.extend(page)
+                if len(page) < SYNC_PAGE_SIZE:
+                    break
+        for partner in partners:
+            if partner.get('active', True):
+                self.add(partner['id'], partner.get('email') or None, partner.get('phone') or None)
+            else:
+                self.remove(partner['id'])
+            if partner.get('write_date'):
+                self.synced_write_date = max(self.synced_write_date or '', partner['write_date'])
+        self.synced_at = time.monotonic()
+        record_metric('partner_index_synced', len(partners), 'Count')
+        log_message('info', "Partner index synced", partners=len(partners), indexed=len(self.partner_keys))
+
+    def lookup(
+        self,
+        search_read: Optional[SearchRead],
+        email: Optional[str] = None,
+        phone: Optional[str] = None
+    ) -> Optional[List[int]]:
+        """
+        Finds the partners whose normalized email and phone exactly match the given
+        ones, first syncing the partners written since the last sync if that is due.
+        An index that has not been loaded yet is not loaded here.
+
+        Args:
+            search_read (Optional[SearchRead]): Runs the sync's search_read calls; None
+                while Odoo is unavailable.
+            email (Optional[str]): The email address to match.
+            phone (Optional[str]): The phone number to match.
+
+        Returns:
+            Optional[List[int]]: The matching partner IDs, or None if there is no exact
+            match (or nothing to match on), in which case Odoo should be searched.
+        """
+        keys = [(self.by_email, normalize_email(email)), (self.by_phone, normalize_phone(phone))]
+        keys = [(index, key) for index, key in keys if key]
+        if not self.enabled or not keys or not self.loaded:
+            return None
+
+        if search_read and time.monotonic() - self.synced_at >= self.sync_seconds:
+            try:
+                self.sync(search_read)
+            except Exception as e:
+                log_message('error', f"Failed to sync partner index: {e}")
+                # Try again after another PARTNER_INDEX_SYNC_SECONDS, not on every lookup
+                self.synced_at = time.monotonic()
+
+        ids: Optional[Set[int]] = None
+        for index, key in keys:
+            matches = index.get(key, set())
+            ids = set(matches) if ids is None else ids & matches
+        if not ids:
+            record_metric('partner_index_miss', 1, 'Count')
+            return None
+        record_metric('partner_index_hit', 1, 'Count')
+        return sorted(ids)
+
+partner_index = PartnerIndex(PARTNER_INDEX_CONFIG['sync_seconds'])
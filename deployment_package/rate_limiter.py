@@ -0,0 +1,250 @@
+import time
+from typing import Any, Dict, Optional, Tuple
+import requests
+from botocore.exceptions import ClientError
+from config import RATE_LIMIT_CONFIG
+from dynamodb_client import dynamodb
+from utils import log_message, time_left
+from tracing import record_metric
+
+PRIORITY_LOW = 'low'
+PRIORITY_NORMAL = 'normal'
+PRIORITY_HIGH = 'high'
+
+# Budget dimensions, named after OpenAI's x-ratelimit-{limit,remaining}-* headers
+DIMENSIONS = ('requests', 'tokens')
+
+# A container writes what it read from OpenAI's headers to the shared bucket at most this often
+PUBLISH_INTERVAL_SECONDS = 1.0
+
+# How often a take that lost the race for the shared bucket is tried again
+SHARED_TAKE_ATTEMPTS = 3
+
+Levels = Dict[str, float]
+
+class TokenBucket:
+    """
+    Token bucket with one level per budget dimension, each refilled continuously up
+    to its per-minute capacity, the way OpenAI replenishes its own limits.
+    """
+
+    def __init__(self, capacities: Levels) -> None:
+        self.capacities = {name: float(capacity) for name, capacity in capacities.items() if capacity > 0}
+        self.levels = dict(self.capacities)
+        self.updated_at = time.time()
+
+    def _refilled(self, levels: Levels, updated_at: float, now: float) -> Levels:
+        elapsed = max(now - updated_at, 0.0)
+        return {
+            name: min(capacity, levels.get(name, capacity) + elapsed * capacity / 60)
+            for name, capacity in self.capacities.items()
+        }
+
+    def _wait(self, levels: Levels, costs: Levels, reserve: float) -> float:
+        # Seconds until every level covers its cost on top of the reserve
+        return max(
+            [(costs.get(name, 0) + reserve * capacity - levels[name]) * 60 / capacity
+             for name, capacity in self.capacities.items()] + [0.0]
+        )
+
+    def take(self, costs: Levels, reserve: float) -> float:
+        """
+        Takes the costs from the bucket if every level covers them on top of the
+        reserve.
+
+        Args:
+            costs (Levels): The cost in each dimension.
+            reserve (float): The share of each capacity that must be left over.
+
+        Returns:
+            float: 0 if the costs were taken, otherwise the seconds until they can be.
+        """
+        now = time.time()
+        levels = self._refilled(self.levels, self.updated_at, now)
+        wait = self._wait(levels, costs, reserve)
+        if wait <= 0:
+            levels = {name: level - costs.get(name, 0) for name, level in levels.items()}
+        self.levels, self.updated_at = levels, now
+        return wait
+
+    def observe(self, limits: Levels, remaining: Levels) -> None:
+        """
+        Replaces the levels with what the API reported as remaining, which also counts
+        what other clients of the same organization used.
+
+        Args:
+            limits (Levels): The reported per-minute limits.
+            remaining (Levels): The reported remaining budget.
+        """
+        self.capacities.update({name: limit for name, limit in limits.items() if limit > 0 and name in self.capacities})
+        self.levels = {
+            name: min(remaining.get(name, level), self.capacities[name])
+            for name, level in self._refilled(self.levels, self.updated_at, time.time()).items()
+        }
+        self.updated_at = time.time()
+
+class SharedTokenBucket(TokenBucket):
+    """
+    Token bucket kept in a DynamoDB item, so every Lambda instance draws on the same
+    budget. Takes and publishes are conditional on the item not having changed since
+    it was read; if DynamoDB cannot be reached, the bucket falls back to its local
+    levels.
+    """
+
+    def __init__(self, capacities: Levels, table_name: str, name: str) -> None:
+        super().__init__(capacities)
+        self.table_name = table_name
+        self.key = {'bucket': {'S': name}}
+        self.published_at = 0.0
+        self.dynamodb = dynamodb
+
+    def _read(self) -> Tuple[Levels, float, Optional[str]]:
+        item = self.dynamodb.get_item(TableName=self.table_name, Key=self.key, ConsistentRead=True).get('Item')
+        if not item:
+            return dict(self.capacities), time.time(), None
+        levels = {name: float(item[name]['N']) for name in self.capacities if name in item}
+        return levels, float(item['updated_at']['N']), item['updated_at']['N']
+
+    def _write(self, levels: Levels, now: float, previous: Optional[str]) -> None:
+        item = {**self.key, 'updated_at': {'N': f"{now:.6f}"}}
+        item.update({name: {'N': f"{level:.3f}"} for name, level in levels.items()})
+        if previous is None:
+            self.dynamodb.put_item(
+                TableName=self.table_name, Item=item,
+                ConditionExpression='attribute_not_exists(#bucket)',
+                ExpressionAttributeNames={'#bucket': 'bucket'}
+            )
+        else:
+            self.dynamodb.put_item(
+                TableName=self.table_name, Item=item,
+                ConditionExpression='updated_at = :previous',
+                ExpressionAttributeValues={':previous': {'N': previous}}
+            )
+
+    def take(self, costs: Levels, reserve: float) -> float:
+        try:
+            for _ in range(SHARED_TAKE_ATTEMPTS):
+                levels, updated_at, previous = self._read()
+                now = time.time()
+                levels = self._refilled(levels, updated_at, now)
+                wait = self._wait(levels, costs, reserve)
+                if wait > 0:
+                    return wait
+                try:
+                    self._write({name: level - costs.get(name, 0) for name, level in levels.items()}, now, previous)
+                    return 0.0
+                except ClientError as e:
+                    if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                        raise
+            # Other instances kept winning; look again shortly
+            return 0.05
+        except ClientError as e:
+            log_message('error', f"Failed to use shared rate limit bucket: {e}")
+            return super().take(costs, reserve)
+
+    def observe(self, limits: Levels, remaining: Levels) -> None:
+        super().observe(limits, remaining)
+        now = time.time()
+        if now - self.published_at < PUBLISH_INTERVAL_SECONDS:
+            return
+        self.published_at = now
+        try:
+            levels, updated_at, previous = self._read()
+            levels = self._refilled(levels, updated_at, now)
+            # OpenAI has not counted the budget other instances took for calls still to
+            # come, so the lower of the two levels stands
+            self._write({name: min(level, self.levels[name]) for name, level in levels.items()}, now, previous)
+        except ClientError as e:
+            # Losing the race to another instance's take or publish is fine
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                log_message('error', f"Failed to publish rate limit levels: {e}")
+
+class RateLimiter:
+    """
+    Client-side limiter for OpenAI calls. Each assistant turn takes its expected cost
+    from a token bucket kept in step with OpenAI's rate limit headers. Lower priority
+    work may only draw on the budget above a reserve: when the budget runs low it
+    waits up to RATE_LIMIT_MAX_WAIT_SECONDS (and never past the invocation deadline)
+    and is then shed, so checkout conversations keep going. High priority work is
+    never shed; if it cannot get budget in time it goes ahead and relies on the
+    retries in make_request.
+    """
+
+    def __init__(self, bucket: TokenBucket, turn_costs: Levels, reserve: Dict[str, float], max_wait_seconds: float) -> None:
+        self.bucket = bucket
+        self.turn_costs = turn_costs
+        self.reserve = reserve
+        self.max_wait_seconds = max_wait_seconds
+
+    @property
+    def enabled(self) -> bool:
+        return 'requests' in self.bucket.capacities
+
+    def observe(self, response: requests.Response) -> None:
+        """
+        Updates the budget from the x-ratelimit-* headers of an OpenAI response.
+
+        Args:
+            response (requests.Response): The response.
+        """
+        limits: Levels = {}
+        remaining: Levels = {}
+        for name in DIMENSIONS:
+            for values, header in ((limits, f'x-ratelimit-limit-{name}'), (remaining, f'x-ratelimit-remaining-{name}')):
+                try:
+                    values[name] = float(response.headers[header])
+                except (KeyError, ValueError):
+                    pass
+        if self.enabled and remaining:
+            self.bucket.observe(limits, remaining)
+
+    def acquire(self, priority: str = PRIORITY_NORMAL, costs: Optional[Levels] = None) -> bool:
+        """
+        Takes budget for a piece of work, waiting for it if need be.
+
+        Args:
+            priority (str): PRIORITY_LOW, PRIORITY_NORMAL or PRIORITY_HIGH.
+            costs (Optional[Levels]): The expected requests and tokens, an assistant turn by default.
+
+        Returns:
+            bool: True if the work may go ahead, False if it was shed.
+        """
+        if not self.enabled:
+            return True
+        costs = self.turn_costs if costs is None else costs
+        started = time.monotonic()
+        while True:
+            wait = self.bucket.take(costs, self.reserve.get(priority, 0.0))
+            waited = time.monotonic() - started
+            if wait <= 0:
+                if waited:
+                    record_metric('rate_limit_wait', waited * 1000)
+                return True
+
+            allowed = self.max_wait_seconds - waited
+            remaining = time_left()
+            if remaining is not None:
+                allowed = min(allowed, remaining)
+            if wait > allowed:
+                if priority == PRIORITY_HIGH:
+                    log_message('warning', "Rate limit budget exhausted", priority=priority, waited=round(waited, 3))
+                    return True
+                record_metric('rate_limit_shed', 1, 'Count')
+                log_message('warning', "Work shed by rate limiter", priority=priority, waited=round(waited, 3), wait=round(wait, 3))
+                return False
+            time.sleep(wait)
+
+def _create_limiter(config: Dict[str, Any]) -> RateLimiter:
+    capacities = {'requests': config['requests_per_minute'], 'tokens': config['tokens_per_minute']}
+    if config['requests_per_minute'] > 0 and config['table_name']:
+        bucket: TokenBucket = SharedTokenBucket(capacities, config['table_name'], 'openai')
+    else:
+        bucket = TokenBucket(capacities)
+    return RateLimiter(
+        bucket,
+        {'requests': config['turn_requests'], 'tokens': config['turn_tokens']},
+        config['reserve'],
+        config['max_wait_seconds']
+    )
+
+openai_limiter = _create_limiter(RATE_LIMIT_CONFIG)
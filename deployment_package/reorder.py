@@ -0,0 +1,168 @@
+from typing import Any, Dict, List, Optional
+from odoo import create_invoice, get_product_names, session_updates, degraded_tool_output, odoo_breaker, ASYNC_INVOICES
+from database import update_session
+from write_queue import write_queue
+from utils import log_message
+from tracing import traced
+from tool_cache import tool_cache
+
+MESSAGES = {
+    'th': {
+        'confirm': "ต้องการสั่งซื้อรายการเดียวกับครั้งที่แล้ว ({invoice}) ใช่ไหมคะ?\n{lines}",
+        'confirm_button': "ยืนยันสั่งซื้อ",
+        'cancel_button': "ยกเลิก",
+        'created': "สร้างใบสั่งซื้อ {invoice} เรียบร้อยแล้วค่ะ\n{lines}\nเจ้าหน้าที่ SK-Medical จะติดต่อกลับเพื่อยืนยันคำสั่งซื้อ ขอบคุณที่สั่งซื้อกับเราค่ะ",
+        'cancelled': "ยกเลิกการสั่งซื้อซ้ำแล้วค่ะ หากต้องการสินค้าอื่น พิมพ์บอกได้เลยค่ะ",
+        'expired': "ไม่พบคำสั่งซื้อครั้งก่อนที่ตรงกันค่ะ กรุณาพิมพ์รายการที่ต้องการสั่งซื้ออีกครั้ง",
+        'failed': "ขออภัยค่ะ ไม่สามารถสร้างใบสั่งซื้อได้ในขณะนี้ กรุณาลองใหม่อีกครั้ง",
+        'queued': "ได้รับคำสั่งซื้อแล้วค่ะ\n{lines}\nเราจะส่งเลขที่ใบสั่งซื้อให้ทางแชทนี้เมื่อสร้างเรียบร้อยค่ะ"
+    },
+    'en': {
+        'confirm': "Would you like to reorder the same items as your last order ({invoice})?\n{lines}",
+        'confirm_button': "Confirm order",
+        'cancel_button': "Cancel",
+        'created': "Your order {invoice} has been created.\n{lines}\nAn SK-Medical representative will contact you to finalize it. Thank you for your purchase!",
+        'cancelled': "The reorder was cancelled. Just tell me if you would like anything else.",
+        'expired': "I could not find a matching previous order. Please tell me what you would like to order.",
+        'failed': "Sorry, the order could not be created right now. Please try again.",
+        'queued': "Your order was received.\n{lines}\nWe will send you the order number in this chat once it is created."
+    }
+}
+
+def _messages(session: Dict[str, Any]) -> Dict[str, str]:
+    return MESSAGES.get(session.get('language'), MESSAGES['th'])
+
+def _format_lines(product_ids: List[int], quantities: List[Any]) -> str:
+    names = get_product_names(product_ids)
+    return "\n".join(
+        f"- {names.get(int(product_id), f'#{product_id}')} x {float(quantity):g}"
+        for product_id, quantity in zip(product_ids, quantities)
+    )
+
+def invoice_created_message(session: Dict[str, Any], parameters: Dict[str, Any], updates: Dict[str, Any]) -> str:
+    """
+    Builds the message telling the user whether an invoice was created, such as the
+    confirmation pushed for a queued invoice.
+
+    Args:
+        session (Dict[str, Any]): The session state of the user.
+        parameters (Dict[str, Any]): The parameters of the create_invoice call.
+        updates (Dict[str, Any]): The session updates derived from its output, empty if it failed.
+
+    Returns:
+        str: The message.
+    """
+    messages = _messages(session)
+    if not updates.get('last_invoice'):
+        return messages['failed']
+    return messages['created'].format(
+        invoice=updates['last_invoice']['name'],
+        lines=_format_lines(parameters['product_ids'], parameters['quantities'])
+    )
+
+@traced('reorder_confirmation')
+def build_reorder_confirmation(session: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Builds a LINE text message with quick-reply buttons that confirm or cancel
+    repeating the user's last invoice through a postback.
+
+    Args:
+        session (Dict[str, Any]): The session state of the user.
+
+    Returns:
+        Optional[Dict[str, Any]]: The LINE message object, or None if there is no last invoice.
+    """
+    last_invoice = session.get('last_invoice')
+    if not last_invoice:
+        return None
+    # The account was switched since; the assistant asks what to order for the new one
+    if session.get('partner_id') is not None and int(last_invoice['partner_id']) != int(session['partner_id']):
+        return None
+
+    messages = _messages(session)
+    invoice_id = last_invoice['invoice_id']
+    text = messages['confirm'].format(
+        invoice=last_invoice.get('name') or invoice_id,
+        lines=_format_lines(last_invoice['product_ids'], last_invoice['quantities'])
+    )
+    return {
+        'type': 'text',
+        'text': text,
+        'quickReply': {
+            'items': [
+                {
+                    'type': 'action',
+                    'action': {
+                        'type': 'postback',
+                        'label': messages['confirm_button'],
+                        'data': f"action=reorder&invoice_id={invoice_id}",
+                        'displayText': messages['confirm_button']
+                    }
+                },
+                {
+                    'type': 'action',
+                    'action': {
+                        'type': 'postback',
+                        'label': messages['cancel_button'],
+                        'data': "action=reorder_cancel",
+                        'displayText': messages['cancel_button']
+                    }
+                }
+            ]
+        }
+    }
+
+@traced('reorder')
+def handle_reorder_postback(line_id: str, params: Dict[str, str], session: Dict[str, Any]) -> str:
+    """
+    Creates an invoice repeating the user's last invoice directly in Odoo, without an
+    assistant run. Like a create_invoice tool call, it is queued instead with
+    ODOO_ASYNC_INVOICES, or while the Odoo circuit breaker is open, and confirmed
+    through LINE once created. The postback must refer to the invoice currently
+    stored as the last one, so a stale or repeated button press cannot order twice.
+
+    Args:
+        line_id (str): The LINE ID of the user.
+        params (Dict[str, str]): The parsed postback data.
+        session (Dict[str, Any]): The session state of the user.
+
+    Returns:
+        str: The reply to send to the user.
+    """
+    messages = _messages(session)
+    if params.get('action') == 'reorder_cancel':
+        return messages['cancelled']
+
+    last_invoice = session.get('last_invoice')
+    if not last_invoice or str(last_invoice['invoice_id']) != params.get('invoice_id'):
+        return messages['expired']
+
+    parameters = {
+        'partner_id': int(last_invoice['partner_id']),
+        'product_ids': [int(product_id) for product_id in last_invoice['product_ids']],
+        # Stored as Decimal; XML-RPC needs floats
+        'quantities': [float(quantity) for quantity in last_invoice['quantities']]
+    }
+    # Concurrent presses of the same button create one invoice
+    idempotency_key = f"reorder:{line_id}:{last_invoice['invoice_id']}"
+    context = {'line_id': line_id, 'idempotency_key': idempotency_key}
+    if ASYNC_INVOICES:
+        write_queue.enqueue('create_invoice', parameters, context)
+        return messages['queued'].format(lines=_format_lines(parameters['product_ids'], parameters['quantities']))
+
+    if odoo_breaker.allow():
+        result = create_invoice(**parameters, idempotency_key=idempotency_key)
+    if not odoo_breaker.allow():
+        # Odoo is down, or this call found it down; as for a create_invoice tool call,
+        # the invoice is queued, and the key makes creating it later safe
+        degraded_tool_output('create_invoice', parameters, context)
+        return messages['queued'].format(lines=_format_lines(parameters['product_ids'], parameters['quantities']))
+    tool_cache.invalidate_for_write('create_invoice', parameters)
+    updates = session_updates('create_invoice', parameters, result)
+    if not updates:
+        log_message('error', "Reorder failed", line_id=line_id, result=result)
+        return messages['failed']
+
+    update_session(line_id, updates)
+    log_message('info', "Reorder created", line_id=line_id, invoice_id=updates['last_invoice']['invoice_id'])
+    return invoice_created_message(session, parameters, updates)
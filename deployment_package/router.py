@@ -0,0 +1,292 @@
+import json
+import re
+import time
+from typing import Any, Callable, Dict, List, Optional, Pattern, Tuple, Union
+from database import get_session, unbind_partner
+from odoo import get_partner_info_by_criteria
+from reorder import build_reorder_confirmation
+from utils import log_message, detect_language
+from tracing import record_metric
+from rate_limiter import PRIORITY_LOW, PRIORITY_NORMAL, PRIORITY_HIGH
+
+# A reply is either text or a LINE message object
+Reply = Union[str, Dict[str, Any]]
+
+# A route handler gets the session and message language, and returns a reply, or
+# None to hand the message to the assistant after all
+RouteHandler = Callable[[Dict[str, Any], str], Optional[Reply]]
+
+TEMPLATES = {
+    'th': {
+        'greeting': "สวัสดีค่ะ คุณ{name} วันนี้ต้องการค้นหาหรือสั่งซื้อสินค้าอะไรดีคะ?",
+        'thanks': "ยินดีค่ะ หากต้องการสั่งซื้อหรือค้นหาสินค้าเพิ่มเติม พิมพ์บอกได้ตลอดเวลาเลยค่ะ",
+        'acknowledge': "รับทราบค่ะ หากต้องการความช่วยเหลือเพิ่มเติม พิมพ์บอกได้เลยค่ะ",
+        'account': "ข้อมูลบัญชีของคุณ:\nชื่อ: {name}\nอีเมล: {email}\nโทรศัพท์: {phone}\nที่อยู่: {address}",
+        'unbind_confirm': "ต้องการยกเลิกการเชื่อมบัญชี {name} กับ LINE นี้ใช่ไหมคะ?",
+        'unbind_button': "ยกเลิกการเชื่อมบัญชี",
+        'not_my_account_button': "ไม่ใช่บัญชีของฉัน",
+        'unbound': "ยกเลิกการเชื่อมบัญชีเรียบร้อยแล้วค่ะ ครั้งถัดไปฉันจะขอข้อมูลบัญชีของคุณอีกครั้งนะคะ",
+        'unbind_failed': "ขออภัยค่ะ ไม่สามารถยกเลิกการเชื่อมบัญชีได้ รบกวนพิมพ์ขอยกเลิกการเชื่อมบัญชีอีกครั้งนะคะ",
+        'sticker': "ขอบคุณสำหรับสติกเกอร์ค่ะ 😊 ต้องการค้นหาหรือสั่งซื้อสินค้าอะไร พิมพ์บอกได้เลยค่ะ",
+        'unsupported': "ขออภัยค่ะ ตอนนี้ฉันอ่านได้เฉพาะข้อความเท่านั้น รบกวนพิมพ์สิ่งที่ต้องการได้เลยค่ะ",
+        'busy': "ขออภัยค่ะ ขณะนี้มีผู้ติดต่อเข้ามาจำนวนมาก รบกวนส่งข้อความอีกครั้งในอีกสักครู่นะคะ"
+    },
+    'en': {
+        'greeting': "Hello {name}! What would you like to search for or order today?",
+        'thanks': "You're welcome! Just message me any time you would like to order or search for products.",
+        'acknowledge': "Got it. Let me know if there is anything else I can help with.",
+        'account': "Your account:\nName: {name}\nEmail: {email}\nPhone: {phone}\nAddress: {address}",
+        'unbind_confirm': "Would you like to unlink the account {name} from this LINE account?",
+        'unbind_button': "Unlink account",
+        'not_my_account_button': "Not my account",
+        'unbound': "Your account has been unlinked. I will ask for your account details again next time.",
+        'unbind_failed': "Sorry, I couldn't unlink your account. Please ask me to unlink it again.",
+        'sticker': "Thanks for the sticker! 😊 Just type what you would like to search for or order.",
+        'unsupported': "Sorry, I can only read text messages for now. Please type what you need.",
+        'busy': "Sorry, we are receiving a lot of messages right now. Please send your message again in a minute."
+    }
+}
+
+# Assumed cost of an assistant turn until one has been observed in this container
+DEFAULT_ASSISTANT_LATENCY_MS = 8000.0
+assistant_latency_ms = DEFAULT_ASSISTANT_LATENCY_MS
+
+# How often each route fired in this container, including 'assistant' for pass-through
+route_counts: Dict[str, int] = {}
+
+def observe_assistant_latency(elapsed_ms: float) -> None:
+    """
+    Updates the moving average of an assistant turn's latency, used to estimate the
+    latency saved by routed messages.
+
+    Args:
+        elapsed_ms (float): The latency of an assistant turn in milliseconds.
+    """
+    global assistant_latency_ms
+    assistant_latency_ms = 0.8 * assistant_latency_ms + 0.2 * elapsed_ms
+    route_counts['assistant'] = route_counts.get('assistant', 0) + 1
+
+def _template(language: str, name: str) -> str:
+    return TEMPLATES.get(language, TEMPLATES['th'])[name]
+
+def handle_greeting(session: Dict[str, Any], language: str) -> Optional[Reply]:
+    # New customers get the assistant's onboarding instead
+    if session.get('partner_id') is None:
+        return None
+    return _template(language, 'greeting').format(name=session.get('partner_name') or '')
+
+def handle_thanks(session: Dict[str, Any], language: str) -> Optional[Reply]:
+    if session.get('awaiting_reply'):
+        return None
+    return _template(language, 'thanks')
+
+def handle_acknowledge(session: Dict[str, Any], language: str) -> Optional[Reply]:
+    # "ok" may be the answer to the assistant's last question, e.g. confirming an invoice
+    if session.get('awaiting_reply'):
+        return None
+    return _template(language, 'acknowledge')
+
+def handle_reorder(session: Dict[str, Any], language: str) -> Optional[Reply]:
+    return build_reorder_confirmation(session)
+
+def _unbind_item(session: Dict[str, Any], label: str) -> Dict[str, Any]:
+    return {
+        'type': 'action',
+        'action': {
+            'type': 'postback',
+            'label': label,
+            'data': f"action=unbind&partner_id={session['partner_id']}",
+            'displayText': label
+        }
+    }
+
+def handle_unbind(session: Dict[str, Any], language: str) -> Optional[Reply]:
+    if session.get('partner_id') is None:
+        return None
+    button = _template(language, 'unbind_button')
+    return {
+        'type': 'text',
+        'text': _template(language, 'unbind_confirm').format(name=session.get('partner_name') or session['partner_id']),
+        'quickReply': {'items': [_unbind_item(session, button)]}
+    }
+
+def handle_account(session: Dict[str, Any], language: str) -> Optional[Reply]:
+    if session.get('partner_id') is None:
+        return None
+    try:
+        partner = json.loads(get_partner_info_by_criteria(partner_id=int(session['partner_id'])))[0]
+    except (ValueError, IndexError, KeyError):
+        # Odoo unreachable or the partner is gone; let the assistant handle it
+        return None
+    address = ', '.join(str(part) for part in (partner.get('street'), partner.get('city')) if part)
+    text = _template(language, 'account').format(
+        name=partner.get('name') or '-',
+        email=partner.get('email') or '-',
+        phone=partner.get('phone') or '-',
+        address=address or '-'
+    )
+    return {
+        'type': 'text',
+        'text': text,
+        'quickReply': {'items': [_unbind_item(session, _template(language, 'not_my_account_button'))]}
+    }
+
+def unbind_account(line_id: str, params: Dict[str, str]) -> str:
+    """
+    Handles the "unbind" postback by removing the LINE account's binding to the
+    partner named in the postback, if it is still bound to it. A postback whose
+    partner_id is missing or not a number unbinds nothing.
+
+    Args:
+        line_id (str): The LINE ID of the user.
+        params (Dict[str, str]): The postback parameters (partner_id).
+
+    Returns:
+        str: The reply text.
+    """
+    session = get_session(line_id)
+    language = session.get('language') or 'th'
+    try:
+        partner_id = int(params.get('partner_id', ''))
+    except ValueError:
+        log_message('warning', "Invalid unbind postback", line_id=line_id, partner_id=params.get('partner_id'))
+        return _template(language, 'unbind_failed')
+    unbound = unbind_partner(line_id, partner_id)
+    log_message('info', "Partner unbind", line_id=line_id, partner_id=partner_id, unbound=unbound)
+    return _template(language, 'unbound')
+
+def canned_reply(line_id: str, name: str) -> str:
+    """
+    Builds a template reply for an event without text, such as a sticker, in the
+    language stored in the user's session.
+
+    Args:
+        line_id (str): The LINE ID of the user.
+        name (str): The name of the template.
+
+    Returns:
+        str: The reply text.
+    """
+    route_counts[name] = route_counts.get(name, 0) + 1
+    record_metric(f"route_{name}", 1, 'Count')
+    return _template(get_session(line_id).get('language') or 'th', name)
+
+def _pattern(*alternatives: str) -> Pattern:
+    return re.compile(r'^\s*(?:' + '|'.join(alternatives) + r')\s*[.!?~]*\s*$', re.IGNORECASE)
+
+# Checked in order; the first matching route whose handler returns a reply wins
+ROUTES: List[Tuple[str, Pattern, RouteHandler]] = [
+    ('reorder', _pattern(
+        r're-?order', r'order (?:the )?same(?: again| as (?:last time|before))?', r'same (?:order|as last time)(?: again)?',
+        r'สั่งซ้ำ', r'สั่งเหมือนเดิม', r'สั่งเหมือนครั้งที่แล้ว', r'เหมือนเดิม'
+    ), handle_reorder),
+    ('account', _pattern(
+        r'my account', r'(?:show|view) my account', r'account info(?:rmation)?',
+        r'บัญชีของฉัน', r'ข้อมูลบัญชี', r'ดูบัญชี'
+    ), handle_account),
+    ('unbind', _pattern(
+        r'(?:unlink|disconnect|switch|change) (?:my )?account', r'log ?out', r'sign ?out', r'not my account',
+        r'เปลี่ยนบัญชี', r'ยกเลิกการเชื่อม(?:ต่อ)?บัญชี', r'ออกจากระบบ', r'ไม่ใช่บัญชีของฉัน'
+    ), handle_unbind),
+    ('greeting', _pattern(
+        r'hi', r'hello', r'hey', r'good (?:morning|afternoon|evening)',
+        r'สวัสดี(?:ครับ|ค่ะ|คะ|จ้า)?', r'หวัดดี(?:ครับ|ค่ะ|คะ|จ้า)?'
+    ), handle_greeting),
+    ('thanks', _pattern(
+        r'thanks?(?: you)?(?: (?:so|very) much)?', r'thx', r'ty',
+        r'ขอบคุณ(?:ครับ|ค่ะ|คะ|มาก|มากครับ|มากค่ะ)?', r'ขอบใจ'
+    ), handle_thanks),
+    # Bare "ok", "ครับ" or "ค่ะ" is how customers confirm an order, so it always goes to the assistant
+    ('acknowledge', _pattern(
+        r'noted', r'got it', r'👍', r'รับทราบ(?:ครับ|ค่ะ)?'
+    ), handle_acknowledge),
+]
+
+def route_message(line_id: str, text: str) -> Optional[Reply]:
+    """
+    Answers trivial messages (greetings, thanks, acknowledgements, reorder and
+    account requests) from templates or direct tool calls, without an assistant run.
+    The session is only read once a pattern matches.
+
+    Args:
+        line_id (str): The LINE ID of the user.
+        text (str): The message text.
+
+    Returns:
+        Optional[Reply]: The reply, or None if the message should go to the assistant.
+    """
+    started = time.perf_counter()
+    session = None
+    for name, pattern, handler in ROUTES:
+        if not pattern.match(text):
+            continue
+        if session is None:
+            session = get_session(line_id)
+        language = detect_language(text) or session.get('language') or 'th'
+        reply = handler(session, language)
+        if reply is None:
+            continue
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        saved_ms = max(assistant_latency_ms - elapsed_ms, 0.0)
+        route_counts[name] = route_counts.get(name, 0) + 1
+        record_metric(f"route_{name}", 1, 'Count')
+        record_metric('route_latency_saved', saved_ms)
+        log_message('info', "Message routed", line_id=line_id, route=name,
+                    elapsed_ms=round(elapsed_ms, 1), saved_ms=round(saved_ms, 1), route_counts=route_counts)
+        return reply
+
+    record_metric('route_assistant', 1, 'Count')
+    return None
+
+# Messages about ordering, which keep their OpenAI budget when it runs low
+CHECKOUT = re.compile(
+    r'\b(?:(?:re-?)?order(?:s|ed|ing)?|buy(?:s|ing)?|purchas(?:e|es|ed|ing)|invoices?|check ?out|'
+    r'quot(?:e|es|ed|ing|ations?)|deliver(?:s|ed|ing|y|ies)?)\b|'
+    r'สั่ง|ซื้อ|ใบแจ้งหนี้|ใบเสนอราคา|จัดส่ง',
+    re.IGNORECASE
+)
+
+# A reply that asks the customer something: a question mark, or a Thai question
+# particle, before any closing emoji or punctuation
+QUESTION = re.compile(
+    r'(?:[?？]|ไหม|มั้ย|มั๊ย|หรือไม่|หรือเปล่า|ใช่ไหม|ไหมคะ|ไหมครับ|คะ|นะคะ)[\s\W_]*$'
+)
+
+def awaits_reply(text: str) -> bool:
+    """
+    Tells whether the assistant's reply asks the customer a question, so a short
+    answer like "ok" or "ค่ะ" is passed to the assistant rather than answered from a
+    template.
+
+    Args:
+        text (str): The assistant's reply.
+
+    Returns:
+        bool: True if the reply ends with a question.
+    """
+    return bool(QUESTION.search(text.rstrip()))
+
+# Chit-chat the router has no template for, the first to be shed when the budget runs low
+SMALL_TALK = _pattern(
+    r'how are you(?: doing)?', r'who are you', r"what(?:'s| is) your name", r'are you (?:a )?(?:bot|robot|human|real)',
+    r'(?:ha)+', r'(?:he)+', r'lol', r'5{3,}', r'[\W_]+',
+    r'สบายดีไหม(?:ครับ|คะ)?', r'เป็นไงบ้าง', r'คุณชื่ออะไร(?:ครับ|คะ)?', r'คุณเป็นใคร(?:ครับ|คะ)?', r'ฮ่า+'
+)
+
+def message_priority(text: str) -> str:
+    """
+    Ranks a message for the OpenAI rate limiter: ordering is high priority, small
+    talk low, and everything else, such as product questions, normal.
+
+    Args:
+        text (str): The message text.
+
+    Returns:
+        str: PRIORITY_HIGH, PRIORITY_NORMAL or PRIORITY_LOW.
+    """
+    if CHECKOUT.search(text):
+        return PRIORITY_HIGH
+    if SMALL_TALK.match(text):
+        return PRIORITY_LOW
+    return PRIORITY_NORMAL
@@ -0,0 +1,166 @@
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional, Tuple
+from config import TOOL_CACHE_CONFIG
+from tracing import record_metric
+
+# An entry holds when it expires, the tool output, and the IDs of the records in the
+# output, which lets a write drop only the entries that show the records it changed
+CacheEntry = Tuple[float, str, FrozenSet[int]]
+
+def canonical_parameters(parameters: Dict[str, Any]) -> str:
+    """
+    Serializes tool parameters so calls that mean the same search share a key: keys
+    are sorted, parameters set to null are dropped, and strings are case-folded,
+    since every cached tool matches text case-insensitively (ilike).
+
+    Args:
+        parameters (Dict[str, Any]): The parameters of the tool call.
+
+    Returns:
+        str: The canonical JSON of the parameters.
+    """
+    def canonical(value: Any) -> Any:
+        if isinstance(value, str):
+            return value.casefold()
+        if isinstance(value, list):
+            return [canonical(item) for item in value]
+        return value
+    return json.dumps(
+        {name: canonical(value) for name, value in parameters.items() if value is not None},
+        sort_keys=True, separators=(',', ':'), ensure_ascii=False
+    )
+
+class ToolCache:
+    """
+    In-memory LRU cache of read-only tool outputs, shared by all conversations in the
+    container. Entries expire after a per-tool TTL, and only successful outputs (JSON
+    lists of records) are stored, so an Odoo error is never served again. Expired
+    entries stay until they are evicted, as the records they hold can still answer
+    searches while Odoo is unavailable.
+    """
+
+    def __init__(self, ttl_seconds: Dict[str, int], max_entries: int) -> None:
+        self.ttl_seconds = {name: ttl for name, ttl in ttl_seconds.items() if ttl > 0}
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[Tuple[str, str], CacheEntry]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def cacheable(self, tool_name: str) -> bool:
+        return self.max_entries > 0 and tool_name in self.ttl_seconds
+
+    def get(self, tool_name: str, parameters: Dict[str, Any]) -> Optional[str]:
+        """
+        Returns the cached output of a tool call, counting a hit or a miss.
+
+        Args:
+            tool_name (str): The name of the tool.
+            parameters (Dict[str, Any]): The parameters of the tool call.
+
+        Returns:
+            Optional[str]: The cached output, or None if it is not cached or has expired.
+        """
+        if not self.cacheable(tool_name):
+            return None
+        key = (tool_name, canonical_parameters(parameters))
+        entry = self.entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            self.misses += 1
+            record_metric('tool_cache_miss', 1, 'Count')
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        record_metric('tool_cache_hit', 1, 'Count')
+        return entry[1]
+
+    def put(self, tool_name: str, parameters: Dict[str, Any], result: str) -> None:
+        """
+        Stores the output of a tool call if the tool is cacheable and the call succeeded,
+        evicting the least recently used entries beyond the memory bound.
+
+        Args:
+            tool_name (str): The name of the tool.
+            parameters (Dict[str, Any]): The parameters of the tool call.
+            result (str): The output of the tool.
+        """
+        if not self.cacheable(tool_name):
+            return
+        try:
+            records = json.loads(result)
+        except ValueError:
+            # Errors and empty searches are returned as plain messages
+            return
+        if not isinstance(records, list):
+            return
+
+        ids = frozenset(record['id'] for record in records if isinstance(record, dict) and 'id' in record)
+        key = (tool_name, canonical_parameters(parameters))
+        self.entries[key] = (time.monotonic() + self.ttl_seconds[tool_name], result, ids)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def records(self, tool_name: str) -> List[Dict[str, Any]]:
+        """
+        Returns the records in every cached output of a tool, expired or not, most
+        recently used first and each record once.
+
+        Args:
+            tool_name (str): The name of the tool.
+
+        Returns:
+            List[Dict[str, Any]]: The records.
+        """
+        unique: Dict[Any, Dict[str, Any]] = {}
+        for (name, _), (_, result, _) in reversed(self.entries.items()):
+            if name != tool_name:
+                continue
+            for record in json.loads(result):
+                if isinstance(record, dict) and 'id' in record:
+                    unique.setdefault(record['id'], record)
+        return list(unique.values())
+
+    def invalidate(self, tool_name: str, ids: Optional[Iterable[int]] = None) -> int:
+        """
+        Drops the cached outputs of a tool, either all of them or those showing any of
+        the given records.
+
+        Args:
+            tool_name (str): The name of the tool.
+            ids (Optional[Iterable[int]]): The IDs of the changed records, or None for all.
+
+        Returns:
+            int: The number of entries dropped.
+        """
+        changed = None if ids is None else frozenset(int(record_id) for record_id in ids)
+        stale = [
+            key for key, (_, _, entry_ids) in self.entries.items()
+            if key[0] == tool_name and (changed is None or entry_ids & changed)
+        ]
+        for key in stale:
+            del self.entries[key]
+        return len(stale)
+
+    def invalidate_for_write(self, tool_name: str, parameters: Dict[str, Any]) -> None:
+        """
+        Drops the entries a write tool may have made stale: an invoice changes the
+        products on it, and a new partner can match any earlier partner search.
+
+        Args:
+            tool_name (str): The name of the write tool.
+            parameters (Dict[str, Any]): The parameters of the tool call.
+        """
+        if tool_name == "create_invoice":
+            try:
+                self.invalidate("get_product_info_by_criteria", parameters.get("product_ids") or [])
+            except (TypeError, ValueError):
+                self.invalidate("get_product_info_by_criteria")
+        elif tool_name == "create_partner":
+            self.invalidate("get_partner_info_by_criteria")
+
+    def clear(self) -> None:
+        self.entries.clear()
+
+tool_cache = ToolCache(TOOL_CACHE_CONFIG['ttl_seconds'], TOOL_CACHE_CONFIG['max_entries'])
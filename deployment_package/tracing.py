@@ -0,0 +1,148 @@
+import json
+import sys
+import time
+from contextlib import contextmanager
+from functools import wraps
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from config import METRICS_CONFIG
+
+# CloudWatch accepts at most 100 metrics per EMF directive and 100 values per metric.
+MAX_METRICS = 100
+MAX_VALUES = 100
+
+class Trace:
+    """
+    Collects the per-stage timings and counters of one Lambda invocation.
+    """
+
+    def __init__(self, request_id: Optional[str] = None) -> None:
+        self.started = time.perf_counter()
+        self.metrics: Dict[str, Tuple[str, List[float]]] = {}
+        self.properties: Dict[str, Any] = {}
+        if request_id:
+            self.properties['request_id'] = request_id
+
+    def record(self, name: str, value: float, unit: str = 'Milliseconds') -> None:
+        """
+        Records one value of a metric.
+
+        Args:
+            name (str): The metric name.
+            value (float): The value.
+            unit (str): The CloudWatch unit of the metric.
+        """
+        values = self.metrics.setdefault(name, (unit, []))[1]
+        if len(values) < MAX_VALUES:
+            values.append(round(value, 3))
+
+    def to_emf(self) -> Dict[str, Any]:
+        """
+        Builds the trace record in CloudWatch Embedded Metric Format.
+
+        Returns:
+            Dict[str, Any]: The EMF document.
+        """
+        self.record('invocation', (time.perf_counter() - self.started) * 1000)
+        names = list(self.metrics)[:MAX_METRICS]
+        record: Dict[str, Any] = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_CONFIG['namespace'],
+                    'Dimensions': [['Service']],
+                    'Metrics': [{'Name': name, 'Unit': self.metrics[name][0]} for name in names]
+                }]
+            },
+            'Service': METRICS_CONFIG['service']
+        }
+        record.update(self.properties)
+        for name in names:
+            values = self.metrics[name][1]
+            record[name] = values[0] if len(values) == 1 else values
+        return record
+
+_current: Optional[Trace] = None
+
+def start_trace(request_id: Optional[str] = None) -> Trace:
+    """
+    Starts the trace of a new invocation, replacing any previous one.
+
+    Args:
+        request_id (Optional[str]): The Lambda request ID, added to the record as a property.
+
+    Returns:
+        Trace: The new trace.
+    """
+    global _current
+    _current = Trace(request_id)
+    return _current
+
+def current_trace() -> Optional[Trace]:
+    """
+    Returns the trace of the running invocation, if one was started.
+    """
+    return _current
+
+def record_metric(name: str, value: float, unit: str = 'Milliseconds') -> None:
+    """
+    Records a metric value on the current trace. Does nothing outside of a trace.
+
+    Args:
+        name (str): The metric name.
+        value (float): The value.
+        unit (str): The CloudWatch unit of the metric.
+    """
+    if _current is not None:
+        _current.record(name, value, unit)
+
+def set_property(name: str, value: Any) -> None:
+    """
+    Adds a searchable, non-metric property to the current trace record.
+
+    Args:
+        name (str): The property name.
+        value (Any): The JSON-serializable value.
+    """
+    if _current is not None:
+        _current.properties[name] = value
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """
+    Times a block of code as a stage of the current trace.
+
+    Args:
+        stage (str): The stage name, used as the metric name.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_metric(stage, (time.perf_counter() - started) * 1000)
+
+def traced(stage: str) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+    """
+    Decorator that times every call of a function as a stage of the current trace.
+
+    Args:
+        stage (str): The stage name, used as the metric name.
+    """
+    def decorator(func: Callable[..., Any]) -> Callable[..., Any]:
+        @wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def emit_trace() -> None:
+    """
+    Writes the current trace to stdout as one EMF record, which CloudWatch turns
+    into metrics without an agent, and ends the trace.
+    """
+    global _current
+    if _current is None:
+        return
+    sys.stdout.write(json.dumps(_current.to_emf(), ensure_ascii=False, default=str) + '\n')
+    sys.stdout.flush()
+    _current = None
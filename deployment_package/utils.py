@@ -1,76 +1,341 @@
 import requests
+import urllib3
 import json
+import random
+import re
+import time
 import xmlrpc.client
 import logging
-from typing import Any, Dict, Optional, Tuple
-from config import ODOO_CONFIG
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Dict, Optional, Tuple, Union
+from requests.adapters import HTTPAdapter
+from config import ODOO_CONFIG, LOG_CONFIG, HTTP_CONFIG
+from tracing import record_metric
 
-def log_message(level: str, message: str) -> None:
+LOG_LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+    'critical': logging.CRITICAL
+}
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats log records as one JSON object per line, so CloudWatch Logs Insights
+    can filter and aggregate on fields without parsing free text.
     """
-    Logs a message at the specified level, sets up logging configuration if not already done.
 
-    Args:
-        level (str): The logging level ('debug', 'info', 'warning', 'error', 'critical').
-        message (str): The message to log.
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'timestamp': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def configure_logger() -> logging.Logger:
     """
-    logger = logging.getLogger(__name__)
+    Sets up the JSON logger. Called once at module load; the logger does not
+    propagate to the Lambda runtime's root handler, so every line is written once.
 
-    if not logger.hasHandlers():
-        logger.setLevel(logging.DEBUG)
+    Returns:
+        logging.Logger: The configured logger.
+    """
+    logger = logging.getLogger(__name__)
+    logger.setLevel(LOG_CONFIG['level'])
+    logger.propagate = False
+    if not logger.handlers:
         handler = logging.StreamHandler()
-        handler.setLevel(logging.DEBUG)
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        handler.setFormatter(formatter)
+        handler.setFormatter(JsonFormatter())
         logger.addHandler(handler)
+    return logger
+
+logger = configure_logger()
+
+THAI_PATTERN = re.compile('[\u0e00-\u0e7f]')
+LATIN_PATTERN = re.compile('[A-Za-z]{2,}')
+
+def truncate(value: Any, max_chars: Optional[int] = None) -> Any:
+    """
+    Caps the size of a string written to the logs.
+
+    Args:
+        value (Any): The value to cap. Values that are not strings are returned unchanged.
+        max_chars (Optional[int]): The maximum length, LOG_MAX_CHARS by default.
+
+    Returns:
+        Any: The value, with strings longer than the cap cut and marked with their original length.
+    """
+    max_chars = LOG_CONFIG['max_chars'] if max_chars is None else max_chars
+    if isinstance(value, str) and len(value) > max_chars:
+        return f"{value[:max_chars]}... [truncated, {len(value)} chars]"
+    return value
+
+def log_message(level: str, message: Union[str, Callable[[], str]], sampled: bool = False, **fields: Any) -> None:
+    """
+    Logs a message at the specified level as structured JSON. Nothing is formatted
+    when the level is disabled or the line is sampled out.
+
+    Args:
+        level (str): The logging level ('debug', 'info', 'warning', 'error', 'critical').
+        message (Union[str, Callable[[], str]]): The message, or a callable that builds it,
+            for messages that are expensive to format.
+        sampled (bool): Whether to only log a LOG_DEBUG_SAMPLE_RATE fraction of these lines,
+            for high-volume lines.
+        **fields (Any): Extra fields to include in the JSON record.
+    """
+    levelno = LOG_LEVELS.get(level.lower(), logging.INFO)
+    if not logger.isEnabledFor(levelno):
+        return
+    if sampled and random.random() >= LOG_CONFIG['debug_sample_rate']:
+        return
+
+    if callable(message):
+        message = message()
+    fields = {key: truncate(value) for key, value in fields.items()}
+    logger.log(levelno, truncate(message), extra={'fields': fields})
+
+def detect_language(text: str) -> Optional[str]:
+    """
+    Detects whether a message is written in Thai or English.
+
+    Args:
+        text (str): The message text.
+
+    Returns:
+        Optional[str]: 'th', 'en', or None if the message has no words to tell by.
+    """
+    if THAI_PATTERN.search(text):
+        return 'th'
+    if LATIN_PATTERN.search(text):
+        return 'en'
+    return None
+
+# One session per container, so OpenAI and LINE connections are reused across calls
+http_session = requests.Session()
+
+# Adapters whose connection warmer.py opened in a thread of its own, by URL prefix.
+# requests.Session is not thread-safe, so the warmer leaves them here and the thread
+# sending the next request mounts them on http_session, however late they finish.
+warmed_adapters: Dict[str, HTTPAdapter] = {}
+
+def mount_warmed_adapters() -> None:
+    """
+    Mounts the adapters warmed since the last request on the shared HTTP session,
+    closing the adapters they replace.
+    """
+    while warmed_adapters:
+        prefix, adapter = warmed_adapters.popitem()
+        previous = http_session.adapters.get(prefix)
+        http_session.mount(prefix, adapter)
+        if previous is not None:
+            previous.close()
+
+# 408 and 429 are worth retrying; so are 5xx, except 501 (never going to work)
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+
+# OpenAI error codes that a retry cannot fix
+NON_RETRYABLE_ERROR_CODES = {'insufficient_quota', 'billing_hard_limit_reached'}
+
+DURATION_PART = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+# time.monotonic() by which the current invocation must finish, set by the handler
+_deadline: Optional[float] = None
 
-    level = level.lower()
-    if level == 'debug':
-        logger.debug(message)
-    elif level == 'info':
-        logger.info(message)
-    elif level == 'warning':
-        logger.warning(message)
-    elif level == 'error':
-        logger.error(message)
-    elif level == 'critical':
-        logger.critical(message)
-    else:
-        logger.info(message)
+class RequestError(Exception):
+    """
+    Raised by make_request when a request fails, with the HTTP status if there was a response.
+    """
+
+    def __init__(self, message: str, status_code: Optional[int] = None) -> None:
+        super().__init__(message)
+        self.status_code = status_code
 
-def make_request(method: str, url: str, headers: Dict[str, str], data: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+def set_deadline(remaining_ms: Optional[int]) -> None:
     """
-    Makes an HTTP request and returns the JSON response.
+    Sets the deadline retries must stay within, from the time the Lambda invocation
+    has left (context.get_remaining_time_in_millis()).
+
+    Args:
+        remaining_ms (Optional[int]): The time left in milliseconds, or None for no deadline.
+    """
+    global _deadline
+    _deadline = None if remaining_ms is None else time.monotonic() + remaining_ms / 1000
+
+def time_left() -> Optional[float]:
+    """
+    Returns the seconds left before the deadline set by set_deadline, less the
+    HTTP_DEADLINE_MARGIN_SECONDS safety margin.
+
+    Returns:
+        Optional[float]: The seconds left, or None if there is no deadline.
+    """
+    if _deadline is None:
+        return None
+    return _deadline - HTTP_CONFIG['deadline_margin_seconds'] - time.monotonic()
+
+def _parse_duration(value: str) -> Optional[float]:
+    """
+    Parses a duration such as "20ms", "1.5s" or "6m0s" (OpenAI's x-ratelimit-reset-*
+    headers) into seconds.
+
+    Args:
+        value (str): The duration.
+
+    Returns:
+        Optional[float]: The duration in seconds, or None if it cannot be parsed.
+    """
+    parts = DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in parts)
+
+def _server_delay(response: requests.Response) -> Optional[float]:
+    """
+    Reads how long the server asked the client to wait, from Retry-After (seconds or
+    an HTTP date) or, for OpenAI rate limits, the x-ratelimit-reset-* headers.
+
+    Args:
+        response (requests.Response): The failed response.
+
+    Returns:
+        Optional[float]: The wait in seconds, or None if the server did not say.
+    """
+    retry_after = response.headers.get('Retry-After')
+    if retry_after:
+        try:
+            return max(float(retry_after), 0.0)
+        except ValueError:
+            try:
+                return max((parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+            except (TypeError, ValueError):
+                pass
+    if response.status_code == 429:
+        resets = [
+            _parse_duration(response.headers.get(name, ''))
+            for name in ('x-ratelimit-reset-requests', 'x-ratelimit-reset-tokens')
+        ]
+        resets = [reset for reset in resets if reset is not None]
+        if resets:
+            return max(resets)
+    return None
+
+def _never_sent(error: requests.ConnectionError) -> bool:
+    # Only a failure to connect (DNS, refused, connect timeout) is sure to have sent
+    # nothing; a reset or "Connection aborted" may come after the body was sent
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, urllib3.exceptions.ConnectTimeoutError)
+
+def _is_retryable(response: requests.Response) -> bool:
+    if response.status_code not in RETRYABLE_STATUSES:
+        return False
+    try:
+        error = response.json().get('error') or {}
+    except ValueError:
+        return True
+    return not (isinstance(error, dict) and error.get('code') in NON_RETRYABLE_ERROR_CODES)
+
+def make_request(
+    method: str,
+    url: str,
+    headers: Dict[str, str],
+    data: Optional[Dict[str, Any]] = None,
+    on_response: Optional[Callable[[requests.Response], None]] = None
+) -> Dict[str, Any]:
+    """
+    Makes an HTTP request and returns the JSON response. Retryable statuses (408, 429,
+    5xx) are retried up to HTTP_RETRY_ATTEMPTS times in all, waiting as long as the
+    server asks (Retry-After, x-ratelimit-reset-*, up to HTTP_RETRY_AFTER_MAX_SECONDS)
+    or with capped exponential backoff and full jitter, and never past the invocation
+    deadline. Connection failures are retried for GETs and for POSTs carrying an
+    X-Line-Retry-Key; other POSTs are not idempotent, so they are only retried when
+    the connection could not be opened.
+    Retries and the time spent waiting are recorded as the http_retries and
+    http_retry_wait metrics.
 
     Args:
         method (str): The HTTP method (GET, POST).
         url (str): The URL to send the request to.
         headers (Dict[str, str]): The headers to include in the request.
         data (Optional[Dict[str, Any]]): The data to include in the request.
+        on_response (Optional[Callable[[requests.Response], None]]): Called with every
+            response received, including failed ones, e.g. to read rate limit headers.
 
     Returns:
         Dict[str, Any]: The JSON response.
 
     Raises:
-        Exception: If the request fails.
+        RequestError: If the request fails.
     """
-    try:
-        if method == 'GET':
-            response = requests.get(url, headers=headers)
-        elif method == 'POST':
-            response = requests.post(url, headers=headers, data=json.dumps(data))
+    if method not in ('GET', 'POST'):
+        raise ValueError(f"Unsupported HTTP method: {method}")
+    body = json.dumps(data) if method == 'POST' else None
+    idempotent = method == 'GET' or 'X-Line-Retry-Key' in headers
+    mount_warmed_adapters()
+
+    attempt = 1
+    while True:
+        try:
+            response = http_session.request(method, url, headers=headers, data=body, timeout=HTTP_CONFIG['timeout_seconds'])
+        except requests.ConnectionError as e:
+            # A read timeout is not a ConnectionError and is never retried
+            response, error, status_code, delay = None, f"Connection failed: {e}", None, None
+            retryable = idempotent or _never_sent(e)
+        except requests.RequestException as e:
+            raise RequestError(f"Request failed: {e}\nURL: {url}\nData: {data}")
         else:
-            raise ValueError(f"Unsupported HTTP method: {method}")
+            if on_response:
+                on_response(response)
+            if response.status_code == 200:
+                response_json = response.json() if response.content else {}
+                if 'error' in response_json:
+                    raise RequestError(f"Request failed: Error in response: {response_json['error']['message']}\nURL: {url}", 200)
+                return response_json
+            error, status_code, delay = f"Failed request: {response.text}", response.status_code, _server_delay(response)
+            retryable = _is_retryable(response)
 
-        if response.status_code != 200:
-            raise Exception(f"Failed request: {response.text}")
+        if delay is None:
+            delay = random.uniform(0, min(HTTP_CONFIG['retry_max_seconds'], HTTP_CONFIG['retry_base_seconds'] * 2 ** (attempt - 1)))
+        remaining = time_left()
+        out_of_time = delay > HTTP_CONFIG['retry_after_max_seconds'] or (remaining is not None and delay > remaining)
+        if not retryable or attempt >= HTTP_CONFIG['retry_attempts'] or out_of_time:
+            raise RequestError(f"Request failed: {error}\nURL: {url}\nData: {data}", status_code)
 
-        response_json = response.json()
-        if 'error' in response_json:
-            raise Exception(f"Error in response: {response_json['error']['message']}")
+        log_message('warning', "Retrying request", url=url, status_code=status_code, attempt=attempt, delay=round(delay, 3))
+        record_metric('http_retries', 1, 'Count')
+        record_metric('http_retry_wait', delay * 1000)
+        time.sleep(delay)
+        attempt += 1
 
-        return response_json
-    except Exception as e:
-        raise Exception(f"Request failed: {e}\nURL: {url}\nHeaders: {headers}\nData: {data}")
+def _odoo_proxy(url: str) -> xmlrpc.client.ServerProxy:
+    """
+    Creates an XML-RPC proxy whose connections time out after ODOO_TIMEOUT_SECONDS,
+    so a hanging Odoo server fails the call instead of the whole invocation.
+
+    Args:
+        url (str): The XML-RPC endpoint.
+
+    Returns:
+        xmlrpc.client.ServerProxy: The proxy.
+    """
+    base = xmlrpc.client.SafeTransport if url.startswith('https') else xmlrpc.client.Transport
+
+    class TimeoutTransport(base):  # type: ignore[valid-type, misc]
+        def make_connection(self, host: Any) -> Any:
+            connection = super().make_connection(host)
+            connection.timeout = ODOO_CONFIG['timeout_seconds']
+            return connection
+
+    return xmlrpc.client.ServerProxy(url, transport=TimeoutTransport())
 
 def connect_and_authenticate() -> Tuple[Optional[xmlrpc.client.ServerProxy], Optional[int], str]:
     """
@@ -84,15 +349,15 @@ def connect_and_authenticate() -> Tuple[Optional[xmlrpc.client.ServerProxy], Opt
     username = ODOO_CONFIG["username"]
     password = ODOO_CONFIG["password"]
 
-    common = xmlrpc.client.ServerProxy(f'{url}/xmlrpc/2/common')
+    common = _odoo_proxy(f'{url}/xmlrpc/2/common')
     try:
         version = common.version()
+        uid = common.authenticate(db, username, password, {})
     except Exception as e:
         return None, None, f"Failed to connect to the Odoo server: {e}"
 
-    uid = common.authenticate(db, username, password, {})
     if not uid:
         return None, None, "Authentication failed"
 
-    models = xmlrpc.client.ServerProxy(f'{url}/xmlrpc/2/object')
+    models = _odoo_proxy(f'{url}/xmlrpc/2/object')
     return models, uid, ""
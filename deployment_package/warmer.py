@@ -0,0 +1,83 @@
+import threading
+import time
+from typing import Callable, Dict, List
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from config import AWS_CONFIG, HTTP_CONFIG
+from utils import warmed_adapters, log_message
+from database import dynamodb
+from odoo import warm_odoo_session
+
+# Any response opens the connection; these need no credentials and cost no quota
+WARMUP_URLS = {
+    'openai': 'https://api.openai.com/v1/models',
+    'line': 'https://api.line.me/v2/bot/info'
+}
+
+# Looked up in the thread mapping table; no user has this LINE ID
+WARMUP_LINE_ID = 'warmup'
+
+def _warm_url(url: str) -> Callable[[], bool]:
+    parts = urlsplit(url)
+    prefix = f"{parts.scheme}://{parts.netloc}/"
+
+    def warm() -> bool:
+        # requests.Session is not thread-safe, so the connection is opened on an
+        # adapter of this thread's own and handed over to make_request once it is open
+        adapter = HTTPAdapter()
+        session = requests.Session()
+        session.mount(prefix, adapter)
+        session.head(url, timeout=HTTP_CONFIG['timeout_seconds'])
+        warmed_adapters[prefix] = adapter
+        return True
+    return warm
+
+def _warm_dynamodb() -> bool:
+    dynamodb.get_item(TableName=AWS_CONFIG['table_name'], Key={'line_id': {'S': WARMUP_LINE_ID}})
+    return True
+
+WARMERS: Dict[str, Callable[[], bool]] = {
+    **{name: _warm_url(url) for name, url in WARMUP_URLS.items()},
+    'odoo': warm_odoo_session,
+    'dynamodb': _warm_dynamodb,
+}
+
+def warm_connections(timeout_seconds: float) -> List[str]:
+    """
+    Opens, or refreshes, the connections to OpenAI, LINE, Odoo and DynamoDB in
+    parallel threads, authenticating the Odoo session on the way. The connections go
+    to the pools the handler uses: the HTTP session of utils.py, the Odoo session of
+    odoo.py and the DynamoDB client of database.py. The OpenAI and LINE connections
+    are opened on adapters of their own, which the next request mounts on the HTTP
+    session, so a warmer that finishes after the timeout is not wasted. Warmers
+    still running after the timeout carry on in the background.
+
+    Args:
+        timeout_seconds (float): How long to wait for the warmers.
+
+    Returns:
+        List[str]: The names of the connections that were opened in time.
+    """
+    started = time.monotonic()
+    warmed: List[str] = []
+
+    def run(name: str, warm: Callable[[], bool]) -> None:
+        try:
+            if warm():
+                warmed.append(name)
+        except Exception as e:
+            log_message('warning', "Connection warmup failed", connection=name, error=str(e))
+
+    threads = [
+        threading.Thread(target=run, args=(name, warm), name=f"warm-{name}", daemon=True)
+        for name, warm in WARMERS.items()
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(max(timeout_seconds - (time.monotonic() - started), 0))
+    log_message('info', "Connections warmed", warmed=sorted(warmed),
+                pending=[thread.name for thread in threads if thread.is_alive()],
+                seconds=round(time.monotonic() - started, 3))
+    return warmed
@@ -0,0 +1,265 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+from botocore.exceptions import ClientError
+from config import AWS_CONFIG
+from dynamodb_client import dynamodb
+from utils import log_message
+from tracing import record_metric
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# Global secondary index of the write queue table: partition key status (S), sort key queued_at (N)
+STATUS_INDEX = 'status-queued_at'
+
+def make_job_id(tool_name: str, parameters: Dict[str, Any], context: Optional[Dict[str, str]] = None) -> str:
+    """
+    Derives the ID of a queued write from the tool call and its context, leaving out
+    the tool call ID, so the same call queued twice, e.g. re-issued by the model
+    under a new tool call ID, is one job. When the context names the LINE webhook
+    event, the run is left out too, so a redelivered event queues no second job.
+
+    Args:
+        tool_name (str): The name of the write tool.
+        parameters (Dict[str, Any]): The parameters of the tool call.
+        context (Optional[Dict[str, str]]): The context of the call, such as its thread and run.
+
+    Returns:
+        str: The job ID.
+    """
+    ignored = ('tool_call_id', 'thread_id', 'run_id') if (context or {}).get('event_id') else ('tool_call_id',)
+    scope = {name: value for name, value in (context or {}).items() if name not in ignored}
+    content = json.dumps([tool_name, parameters, scope], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()[:32]
+
+class WriteQueue:
+    """
+    Queue of Odoo write tool calls waiting to be executed. Jobs are kept in the table
+    named by AWS_WRITE_QUEUE_TABLE_NAME (partition key job_id), so any container can
+    execute them, or in memory when it is not set. Waiting jobs are found through the
+    table's STATUS_INDEX (partition key status, sort key queued_at), and a job is
+    claimed with a conditional update before it runs, so two containers draining at
+    once never carry out the same job.
+    """
+
+    def __init__(self, table_name: Optional[str]) -> None:
+        self.table_name = table_name
+        self.local: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.dynamodb = dynamodb if table_name else None
+
+    @property
+    def durable(self) -> bool:
+        """
+        Tells whether jobs outlive this container.
+
+        Returns:
+            bool: True if the queue is kept in DynamoDB.
+        """
+        return self.dynamodb is not None
+
+    def enqueue(self, tool_name: str, parameters: Dict[str, Any], context: Optional[Dict[str, str]] = None) -> str:
+        """
+        Queues a write tool call, unless the same call is already queued.
+
+        Args:
+            tool_name (str): The name of the write tool.
+            parameters (Dict[str, Any]): The parameters of the tool call.
+            context (Optional[Dict[str, str]]): The context the tool was called with.
+
+        Returns:
+            str: The job ID.
+        """
+        job = {
+            'job_id': make_job_id(tool_name, parameters, context),
+            'tool': tool_name,
+            'parameters': parameters,
+            'context': context or {},
+            'status': PENDING,
+            'queued_at': int(time.time())
+        }
+        if self.dynamodb is None:
+            self.local.setdefault(job['job_id'], job)
+        else:
+            try:
+                self.dynamodb.put_item(
+                    TableName=self.table_name,
+                    Item={
+                        'job_id': {'S': job['job_id']},
+                        'tool': {'S': tool_name},
+                        'parameters': {'S': json.dumps(parameters, ensure_ascii=False)},
+                        'context': {'S': json.dumps(job['context'])},
+                        'status': {'S': PENDING},
+                        'queued_at': {'N': str(job['queued_at'])}
+                    },
+                    ConditionExpression='attribute_not_exists(job_id)'
+                )
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+        record_metric('odoo_writes_queued', 1, 'Count')
+        log_message('info', "Write queued", job_id=job['job_id'], tool=tool_name)
+        return job['job_id']
+
+    def claim(self, limit: int) -> List[Dict[str, Any]]:
+        """
+        Claims jobs that are waiting, oldest first, for this container to carry out.
+        A claimed job is leased for WRITE_QUEUE_LEASE_SECONDS; if it is neither
+        completed nor released by then, e.g. because the invocation timed out, it
+        can be claimed again.
+
+        Args:
+            limit (int): The maximum number of jobs.
+
+        Returns:
+            List[Dict[str, Any]]: The jobs claimed.
+        """
+        now = int(time.time())
+        lease_until = now + AWS_CONFIG['write_queue_lease_seconds']
+        if self.dynamodb is None:
+            claimed = []
+            for job in self.local.values():
+                if len(claimed) == limit:
+                    break
+                if job['status'] == PENDING or (job['status'] == RUNNING and job['lease_until'] < now):
+                    job.update(status=RUNNING, lease_until=lease_until)
+                    claimed.append(dict(job))
+            return claimed
+
+        claimed = []
+        # Jobs whose lease ran out are taken back before new ones
+        for status in (RUNNING, PENDING):
+            for item in self._waiting(status, now, limit - len(claimed)):
+                job = self._claim(item['job_id']['S'], now, lease_until)
+                if job is not None:
+                    claimed.append(job)
+            if len(claimed) == limit:
+                break
+        return claimed
+
+    def _waiting(self, status: str, now: int, limit: int) -> List[Dict[str, Any]]:
+        # Reads one status partition of the index, oldest first. The index is eventually
+        # consistent, so the claim, not this read, decides whether a job is still waiting.
+        kwargs: Dict[str, Any] = {
+            'TableName': self.table_name,
+            'IndexName': STATUS_INDEX,
+            'KeyConditionExpression': '#status = :status',
+            'ExpressionAttributeNames': {'#status': 'status'},
+            'ExpressionAttributeValues': {':status': {'S': status}},
+            'ProjectionExpression': 'job_id'
+        }
+        if status == RUNNING:
+            kwargs['FilterExpression'] = 'lease_until < :now'
+            kwargs['ExpressionAttributeValues'][':now'] = {'N': str(now)}
+        else:
+            kwargs['Limit'] = limit
+        items: List[Dict[str, Any]] = []
+        while len(items) < limit:
+            response = self.dynamodb.query(**kwargs)
+            items.extend(response.get('Items', []))
+            if 'LastEvaluatedKey' not in response:
+                break
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        return items[:limit]
+
+    def _claim(self, job_id: str, now: int, lease_until: int) -> Optional[Dict[str, Any]]:
+        # Moves one job to RUNNING unless another container holds it, returning the job
+        # as stored after the update
+        try:
+            response = self.dynamodb.update_item(
+                TableName=self.table_name,
+                Key={'job_id': {'S': job_id}},
+                UpdateExpression='SET #status = :running, lease_until = :lease_until',
+                ConditionExpression='#status = :pending OR (#status = :running AND lease_until < :now)',
+                ExpressionAttributeNames={'#status': 'status'},
+                ExpressionAttributeValues={
+                    ':running': {'S': RUNNING},
+                    ':pending': {'S': PENDING},
+                    ':now': {'N': str(now)},
+                    ':lease_until': {'N': str(lease_until)}
+                },
+                ReturnValues='ALL_NEW'
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return None
+            raise
+        item = response['Attributes']
+        return {
+            'job_id': item['job_id']['S'],
+            'tool': item['tool']['S'],
+            'parameters': json.loads(item['parameters']['S']),
+            'context': json.loads(item['context']['S']),
+            'status': RUNNING,
+            'queued_at': int(item['queued_at']['N']),
+            'lease_until': lease_until
+        }
+
+    def release(self, job: Dict[str, Any]) -> None:
+        """
+        Puts a claimed job that was not carried out back in the queue, unless its
+        lease ran out and another container has claimed it since.
+
+        Args:
+            job (Dict[str, Any]): The job, as returned by claim.
+        """
+        if self.dynamodb is None:
+            stored = self.local.get(job['job_id'])
+            if stored and stored['status'] == RUNNING and stored['lease_until'] == job['lease_until']:
+                stored['status'] = PENDING
+            return
+        try:
+            self.dynamodb.update_item(
+                TableName=self.table_name,
+                Key={'job_id': {'S': job['job_id']}},
+                UpdateExpression='SET #status = :pending REMOVE lease_until',
+                ConditionExpression='#status = :running AND lease_until = :lease_until',
+                ExpressionAttributeNames={'#status': 'status'},
+                ExpressionAttributeValues={
+                    ':pending': {'S': PENDING},
+                    ':running': {'S': RUNNING},
+                    ':lease_until': {'N': str(job['lease_until'])}
+                }
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+
+    def complete(self, job_id: str, status: str, result: str) -> None:
+        """
+        Records the outcome of an executed job. The job is kept for
+        WRITE_QUEUE_RETENTION_DAYS, after which DynamoDB's TTL removes it.
+
+        Args:
+            job_id (str): The job ID.
+            status (str): DONE or FAILED.
+            result (str): The output of the tool.
+        """
+        if self.dynamodb is None:
+            # Nothing reads the outcome back from memory; it is in the logs
+            self.local.pop(job_id, None)
+            return
+        now = int(time.time())
+        update = 'SET #status = :status, #result = :result, completed_at = :now'
+        values = {
+            ':status': {'S': status},
+            ':result': {'S': result},
+            ':now': {'N': str(now)}
+        }
+        retention_days = AWS_CONFIG['write_queue_retention_days']
+        if retention_days:
+            values[':expires'] = {'N': str(now + retention_days * 86400)}
+            update += ', expires_at = :expires'
+        self.dynamodb.update_item(
+            TableName=self.table_name,
+            Key={'job_id': {'S': job_id}},
+            UpdateExpression=update + ' REMOVE lease_until',
+            ExpressionAttributeNames={'#status': 'status', '#result': 'result'},
+            ExpressionAttributeValues=values
+        )
+
+write_queue = WriteQueue(AWS_CONFIG['write_queue_table_name'])
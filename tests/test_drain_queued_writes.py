@@ -0,0 +1,90 @@
+import os
+import socket
+import sys
+import unittest
+from unittest import mock
+
+# Imported the way Lambda does, from inside the package, with placeholder settings
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'deployment_package')
+sys.path.insert(0, PACKAGE_DIR)
+for name, value in {
+    'ODOO_URL': 'https://odoo.invalid',
+    'ODOO_DB': 'test',
+    'ODOO_USERNAME': 'test',
+    'ODOO_PASSWORD': 'test',
+    'OPENAI_API_KEY': 'test',
+    'OPENAI_ASSISTANT_ID': 'test',
+    'AWS_REGION_NAME': 'ap-southeast-1',
+    'AWS_TABLE_NAME': 'test',
+    'LINE_CHANNEL_SECRET': 'test',
+    'LINE_CHANNEL_ACCESS_TOKEN': 'test',
+    'AWS_ACCESS_KEY_ID': 'test',
+    'AWS_SECRET_ACCESS_KEY': 'test',
+}.items():
+    os.environ.setdefault(name, value)
+os.environ.pop('AWS_WRITE_QUEUE_TABLE_NAME', None)
+
+import odoo  # noqa: E402
+from write_queue import PENDING  # noqa: E402
+
+def invoice(partner_id: int) -> dict:
+    return {'partner_id': partner_id, 'product_ids': [42], 'quantities': [1.0]}
+
+class DrainQueuedWritesTest(unittest.TestCase):
+    """Queued invoices that meet a transient Odoo error stay queued instead of failing."""
+
+    def setUp(self) -> None:
+        odoo.write_queue.local.clear()
+        odoo.odoo_breaker.record_success()
+        odoo._session = None
+        self.on_complete = mock.Mock()
+        # No backoff between retries
+        sleep = mock.patch.object(odoo.time, 'sleep')
+        sleep.start()
+        self.addCleanup(sleep.stop)
+        self.addCleanup(odoo.odoo_breaker.record_success)
+
+    def assert_still_queued(self, job_ids: list) -> None:
+        self.on_complete.assert_not_called()
+        self.assertEqual(sorted(odoo.write_queue.local), sorted(job_ids))
+        for job_id in job_ids:
+            self.assertEqual(odoo.write_queue.local[job_id]['status'], PENDING)
+
+    def test_timeout_releases_single_job(self) -> None:
+        job_id = odoo.write_queue.enqueue('create_invoice', invoice(7), {'line_id': 'U1'})
+        models = mock.Mock()
+        models.execute_kw.side_effect = socket.timeout("timed out")
+        with mock.patch.object(odoo, 'connect_and_authenticate', return_value=(models, 1, "")):
+            executed = odoo.drain_queued_writes(on_complete=self.on_complete)
+
+        self.assertEqual(executed, 0)
+        self.assert_still_queued([job_id])
+
+    def test_connect_failure_releases_batch(self) -> None:
+        job_ids = [
+            odoo.write_queue.enqueue('create_invoice', invoice(partner_id), {'line_id': f'U{partner_id}'})
+            for partner_id in (1, 2, 3)
+        ]
+        error = (None, None, "Failed to connect to the Odoo server: [Errno 111] Connection refused")
+        with mock.patch.object(odoo, 'connect_and_authenticate', return_value=error):
+            executed = odoo.drain_queued_writes(on_complete=self.on_complete)
+
+        self.assertEqual(executed, 0)
+        self.assert_still_queued(job_ids)
+
+    def test_unknown_product_fails_job(self) -> None:
+        job_id = odoo.write_queue.enqueue('create_invoice', invoice(7), {'line_id': 'U1'})
+        models = mock.Mock()
+        models.execute_kw.side_effect = lambda db, uid, password, model, method, *args: []
+        with mock.patch.object(odoo, 'connect_and_authenticate', return_value=(models, 1, "")):
+            executed = odoo.drain_queued_writes(on_complete=self.on_complete)
+
+        self.assertEqual(executed, 1)
+        self.assertNotIn(job_id, odoo.write_queue.local)
+        job, result, succeeded = self.on_complete.call_args[0]
+        self.assertEqual(job['job_id'], job_id)
+        self.assertFalse(succeeded)
+        self.assertIn("unknown product_ids [42]", result)
+
+if __name__ == '__main__':
+    unittest.main()
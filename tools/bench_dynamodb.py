@@ -0,0 +1,152 @@
+'''
+Benchmarks the DynamoDB thread-mapping store on the boto3 resource layer
+against the cached low-level client used by deployment_package/database.py.
+
+Network calls are short-circuited with a canned response on the client's
+before-send event, so the numbers cover client construction, request
+serialization and response parsing only.
+
+Usage:
+    python tools/bench_dynamodb.py [--calls N] [--cold-runs N]
+'''
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import Any, Callable, Dict, List
+
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'deployment_package')
+sys.path.insert(0, PACKAGE_DIR)
+
+REGION = 'ap-southeast-1'
+TABLE = 'line_threads'
+ITEM = {'line_id': {'S': 'U0123456789abcdef'}, 'thread_id': {'S': 'thread_abc123'}}
+
+COLD_START_SNIPPETS = {
+    'resource': (
+        "import boto3\n"
+        f"boto3.resource('dynamodb', region_name='{REGION}').Table('{TABLE}')\n"
+    ),
+    'client': (
+        "import boto3\n"
+        f"boto3.client('dynamodb', region_name='{REGION}')\n"
+    ),
+}
+
+class _CannedRaw:
+    def __init__(self, body: bytes):
+        self._body = body
+
+    def stream(self, **kwargs: Any):
+        yield self._body
+
+def _stub_network(client: Any, payload: Dict[str, Any]) -> None:
+    """
+    Answers every request of the client with the given payload instead of sending it.
+
+    Args:
+        client (Any): The low-level botocore client.
+        payload (Dict[str, Any]): The JSON body returned for every request.
+    """
+    from botocore.awsrequest import AWSResponse
+
+    body = json.dumps(payload).encode('utf-8')
+
+    def respond(request: Any, **kwargs: Any) -> AWSResponse:
+        return AWSResponse(request.url, 200, {}, _CannedRaw(body))
+
+    client.meta.events.register('before-send.dynamodb', respond)
+
+def measure_cold_start(runs: int) -> Dict[str, float]:
+    """
+    Measures interpreter start, import and client construction in fresh processes.
+
+    Args:
+        runs (int): The number of processes to start per variant.
+
+    Returns:
+        Dict[str, float]: The median wall time in milliseconds per variant.
+    """
+    env = dict(os.environ, PYTHONPATH=PACKAGE_DIR, AWS_ACCESS_KEY_ID='bench', AWS_SECRET_ACCESS_KEY='bench')
+    results = {}
+    for name, snippet in COLD_START_SNIPPETS.items():
+        samples = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, '-c', snippet], env=env, check=True)
+            samples.append((time.perf_counter() - start) * 1000)
+        results[name] = statistics.median(samples)
+    return results
+
+def _time_calls(fn: Callable[[], Any], calls: int) -> float:
+    fn()
+    start = time.perf_counter()
+    for _ in range(calls):
+        fn()
+    return (time.perf_counter() - start) / calls * 1e6
+
+def measure_per_call(calls: int) -> Dict[str, float]:
+    """
+    Measures get_item and put_item cost per call on a warm container.
+
+    Args:
+        calls (int): The number of calls per measurement.
+
+    Returns:
+        Dict[str, float]: Microseconds per call for each variant and operation.
+    """
+    import boto3
+
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+
+    resource = boto3.resource('dynamodb', region_name=REGION)
+    _stub_network(resource.meta.client, {'Item': ITEM})
+    client = boto3.client('dynamodb', region_name=REGION)
+    _stub_network(client, {'Item': ITEM})
+
+    line_id = ITEM['line_id']['S']
+    thread_id = ITEM['thread_id']['S']
+
+    def resource_get() -> str:
+        # database.py used to build the Table on every call.
+        return resource.Table(TABLE).get_item(Key={'line_id': line_id})['Item']['thread_id']
+
+    def resource_put() -> None:
+        resource.Table(TABLE).put_item(Item={'line_id': line_id, 'thread_id': thread_id})
+
+    def client_get() -> str:
+        return client.get_item(TableName=TABLE, Key={'line_id': {'S': line_id}})['Item']['thread_id']['S']
+
+    def client_put() -> None:
+        client.put_item(TableName=TABLE, Item={'line_id': {'S': line_id}, 'thread_id': {'S': thread_id}})
+
+    assert resource_get() == client_get() == thread_id
+
+    return {
+        'resource get_item': _time_calls(resource_get, calls),
+        'resource put_item': _time_calls(resource_put, calls),
+        'client get_item': _time_calls(client_get, calls),
+        'client put_item': _time_calls(client_put, calls),
+    }
+
+def main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=2000)
+    parser.add_argument('--cold-runs', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    print("Cold start (median ms, fresh process):")
+    for name, value in measure_cold_start(args.cold_runs).items():
+        print(f"  {name:<10} {value:8.1f}")
+
+    print("Per call (us, warm container):")
+    for name, value in measure_per_call(args.calls).items():
+        print(f"  {name:<18} {value:8.1f}")
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,100 @@
+'''
+Microbenchmark of boto3's TypeSerializer/TypeDeserializer against the
+table-dispatch versions in deployment_package/dynamodb_types.py, on flat
+items and on nested maps and lists. Every sample is checked to produce
+identical results (including the errors raised) before timing.
+
+Usage:
+    python tools/bench_dynamodb_types.py [--iterations N]
+'''
+
+import argparse
+import enum
+import os
+import sys
+import timeit
+from collections import OrderedDict
+from decimal import Decimal
+from typing import Any, Callable, List
+
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'deployment_package')
+sys.path.insert(0, PACKAGE_DIR)
+
+from boto3.dynamodb.types import Binary, TypeDeserializer, TypeSerializer
+from dynamodb_types import FastTypeDeserializer, FastTypeSerializer
+
+class Priority(enum.IntEnum):
+    LOW = 1
+
+FLAT = {
+    'line_id': 'U0123456789abcdef',
+    'thread_id': 'thread_abc123',
+    'partner_id': 42,
+    'language': 'th',
+    'active': True,
+    'updated_at': Decimal('1729300000.25'),
+}
+
+NESTED = {
+    'line_id': 'U0123456789abcdef',
+    'last_invoice': {
+        'partner_id': 42,
+        'lines': [
+            {'product_id': product_id, 'quantity': Decimal(quantity), 'name': f'GLOVE #{product_id}', 'note': None}
+            for product_id, quantity in zip(range(100, 120), range(1, 21))
+        ],
+        'tags': ('reorder', 'line'),
+    },
+    'history': [[1, 2, [3, {'deep': {'deeper': [True, False, None]}}]]],
+}
+
+EDGE_CASES = [
+    None, True, 0, -7, Decimal('1.5'), 'text', b'raw', bytearray(b'raw'), Binary(b'raw'),
+    {1, 2}, {'a', 'b'}, {b'x'}, set(), frozenset({Decimal('2')}), OrderedDict(a=1), Priority.LOW,
+    [], {}, (1, 'a'), 1.5, object(), float('nan'),
+]
+
+def _outcome(fn: Callable[[Any], Any], value: Any) -> Any:
+    try:
+        return ('ok', fn(value))
+    except Exception as e:
+        return ('error', type(e), str(e))
+
+def check_identical() -> None:
+    """
+    Asserts that the fast and stock implementations agree on every sample.
+    """
+    stock_s, fast_s = TypeSerializer(), FastTypeSerializer()
+    stock_d, fast_d = TypeDeserializer(), FastTypeDeserializer()
+    for value in EDGE_CASES + [FLAT, NESTED]:
+        expected = _outcome(stock_s.serialize, value)
+        assert _outcome(fast_s.serialize, value) == expected, value
+        if expected[0] == 'ok':
+            serialized = expected[1]
+            assert _outcome(fast_d.deserialize, serialized) == _outcome(stock_d.deserialize, serialized), serialized
+    for value in [{}, {'XX': 1}, {'S': 'a', 'N': '1'}]:
+        assert _outcome(fast_d.deserialize, value) == _outcome(stock_d.deserialize, value), value
+
+def main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=2000)
+    args = parser.parse_args(argv)
+
+    check_identical()
+    print("Results identical on all samples.")
+    print(f"{'':<22}{'stock (us)':>12}{'fast (us)':>12}{'speedup':>10}")
+
+    for label, item in (('flat', FLAT), ('nested', NESTED)):
+        stock_s, fast_s = TypeSerializer(), FastTypeSerializer()
+        stock_d, fast_d = TypeDeserializer(), FastTypeDeserializer()
+        serialized = stock_s.serialize(item)
+        for operation, stock, fast, value in (
+            ('serialize', stock_s.serialize, fast_s.serialize, item),
+            ('deserialize', stock_d.deserialize, fast_d.deserialize, serialized),
+        ):
+            stock_us = timeit.timeit(lambda: stock(value), number=args.iterations) / args.iterations * 1e6
+            fast_us = timeit.timeit(lambda: fast(value), number=args.iterations) / args.iterations * 1e6
+            print(f"{label + ' ' + operation:<22}{stock_us:>12.1f}{fast_us:>12.1f}{stock_us / fast_us:>9.1f}x")
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
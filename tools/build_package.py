@@ -0,0 +1,247 @@
+'''
+Builds a slim Lambda deployment zip from deployment_package/.
+
+The builder imports the handler in a subprocess with placeholder credentials,
+records every botocore/boto3 model and Python module it loads, and copies the
+package into build/ keeping only the service models that were loaded (plus
+REQUIRED_SERVICES). Build-time tooling that the handler never imports (pip,
+setuptools, pkg_resources) is dropped. The loaded models are precompiled
+(see model_cache.py), the slim package is traced again to prove it still
+imports, and the build fails if a needed model is missing.
+
+Usage:
+    python tools/build_package.py [--services dynamodb sts] [--output deployment_package.zip]
+'''
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+import zipfile
+from typing import Any, Dict, List, Set
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+PACKAGE_DIR = os.path.join(ROOT_DIR, 'deployment_package')
+BUILD_DIR = os.path.join(ROOT_DIR, 'build', 'deployment_package')
+
+# Services the chatbot needs even if the trace does not create a client for them.
+REQUIRED_SERVICES = ['dynamodb', 'sts']
+
+# Top-level entries that are only needed to install packages, never at runtime.
+# They are dropped unless the trace shows the handler importing them.
+BUILD_ONLY_ENTRIES = {
+    'pip': 'pip-22.0.2.dist-info',
+    'setuptools': 'setuptools-59.6.0.dist-info',
+    'pkg_resources': None,
+    '_distutils_hack': 'distutils-precedence.pth',
+}
+
+PLACEHOLDER_ENV = {
+    'ODOO_URL': 'https://odoo.invalid',
+    'ODOO_DB': 'build',
+    'ODOO_USERNAME': 'build',
+    'ODOO_PASSWORD': 'build',
+    'OPENAI_API_KEY': 'build',
+    'OPENAI_ASSISTANT_ID': 'build',
+    'AWS_REGION_NAME': 'ap-southeast-1',
+    'AWS_TABLE_NAME': 'build',
+    'LINE_CHANNEL_SECRET': 'build',
+    'LINE_CHANNEL_ACCESS_TOKEN': 'build',
+    'AWS_ACCESS_KEY_ID': 'build',
+    'AWS_SECRET_ACCESS_KEY': 'build',
+    # The trace imports the handler; it must not dial out to warm connections
+    'WARMUP_ON_INIT': 'false',
+}
+
+# Runs inside the package directory: import the handler the way Lambda does,
+# create the clients for the required services, and report what was loaded.
+TRACE_SCRIPT = '''
+import json, os, sys, time
+start = time.perf_counter()
+import botocore.loaders
+loaded = []
+original = botocore.loaders.Loader.load_data_with_path
+def load_data_with_path(self, name):
+    data, path = original(self, name)
+    loaded.append(path)
+    return data, path
+botocore.loaders.Loader.load_data_with_path = load_data_with_path
+import lambda_function
+from model_cache import create_session
+session = create_session()
+for service in sys.argv[1:]:
+    session.client(service, region_name='ap-southeast-1')
+elapsed_ms = (time.perf_counter() - start) * 1000
+here = os.getcwd() + os.sep
+modules = sorted({m.split('.')[0] for m, mod in list(sys.modules.items()) if (getattr(mod, '__file__', None) or '').startswith(here)})
+print(json.dumps({'models': sorted(set(loaded)), 'modules': modules, 'elapsed_ms': elapsed_ms}))
+'''
+
+def trace(package_dir: str, services: List[str]) -> Dict[str, Any]:
+    """
+    Imports the handler from a package directory in a fresh interpreter and records what it loads.
+
+    Args:
+        package_dir (str): The deployment package directory to trace.
+        services (List[str]): Services to create clients for after importing the handler.
+
+    Returns:
+        Dict[str, Any]: The loaded model paths (without the '.json' extension), the top-level
+            modules imported from the package directory and the import time in milliseconds.
+    """
+    # -S skips site-packages, as on Lambda, so the trace only sees what the package ships.
+    env = dict(os.environ, **PLACEHOLDER_ENV, PYTHONPATH=package_dir, PYTHONDONTWRITEBYTECODE='1')
+    result = subprocess.run(
+        [sys.executable, '-S', '-c', TRACE_SCRIPT, *services],
+        cwd=package_dir, env=env, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        sys.exit(f"Tracing {package_dir} failed:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def cold_start_ms(package_dir: str, services: List[str], runs: int) -> float:
+    """
+    Measures the median handler import time across fresh interpreters.
+
+    Args:
+        package_dir (str): The deployment package directory.
+        services (List[str]): Services to create clients for.
+        runs (int): The number of interpreters to start.
+
+    Returns:
+        float: The median import time in milliseconds.
+    """
+    return statistics.median(trace(package_dir, services)['elapsed_ms'] for _ in range(runs))
+
+def model_services(model_paths: List[str], package_dir: str) -> Set[str]:
+    """
+    Maps loaded model paths to the service directories they live in.
+
+    Args:
+        model_paths (List[str]): Loaded model paths.
+        package_dir (str): The traced deployment package directory.
+
+    Returns:
+        Set[str]: Service directory names under botocore/data and boto3/data.
+    """
+    services = set()
+    for path in model_paths:
+        relative = os.path.relpath(path, package_dir).split(os.sep)
+        # e.g. botocore/data/dynamodb/2012-08-10/service-2
+        if len(relative) > 3 and relative[1] == 'data':
+            services.add(relative[2])
+    return services
+
+def copy_package(services: Set[str], modules: Set[str]) -> List[str]:
+    """
+    Copies the deployment package into the build directory, pruning unused data.
+
+    Args:
+        services (Set[str]): Service model directories to keep.
+        modules (Set[str]): Top-level modules imported by the handler.
+
+    Returns:
+        List[str]: The top-level entries that were dropped.
+    """
+    dropped = []
+    skip_top_level = set()
+    for module, companion in BUILD_ONLY_ENTRIES.items():
+        if module not in modules:
+            skip_top_level.add(module)
+            if companion:
+                skip_top_level.add(companion)
+
+    def ignore(directory: str, names: List[str]) -> Set[str]:
+        ignored = {name for name in names if name == '__pycache__' or name.endswith('.pyc')}
+        if os.path.samefile(directory, PACKAGE_DIR):
+            ignored |= skip_top_level & set(names)
+            dropped.extend(sorted(skip_top_level & set(names)))
+        elif os.path.basename(directory) == 'data' and os.path.basename(os.path.dirname(directory)) in ('botocore', 'boto3'):
+            ignored |= {name for name in names if os.path.isdir(os.path.join(directory, name)) and name not in services}
+        return ignored
+
+    if os.path.isdir(BUILD_DIR):
+        shutil.rmtree(BUILD_DIR)
+    shutil.copytree(PACKAGE_DIR, BUILD_DIR, ignore=ignore)
+    return dropped
+
+def check_models(model_paths: List[str], services: List[str]) -> None:
+    """
+    Fails the build if a traced model or a required service model is missing from the slim package.
+
+    Args:
+        model_paths (List[str]): Model paths loaded from the source package.
+        services (List[str]): Services that must have a service model.
+    """
+    missing = []
+    for path in model_paths:
+        relative = os.path.relpath(path, PACKAGE_DIR)
+        if not any(os.path.isfile(os.path.join(BUILD_DIR, relative + ext)) for ext in ('.json', '.json.gz')):
+            missing.append(relative)
+    for service in services:
+        service_dir = os.path.join(BUILD_DIR, 'botocore', 'data', service)
+        versions = os.listdir(service_dir) if os.path.isdir(service_dir) else []
+        if not any(os.path.isfile(os.path.join(service_dir, version, 'service-2.json.gz')) for version in versions):
+            missing.append(f"botocore/data/{service}/*/service-2.json.gz")
+    if missing:
+        sys.exit("Slim package is missing models:\n  " + "\n  ".join(missing))
+
+def precompile_models(model_paths: List[str]) -> None:
+    """
+    Precompiles the loaded models inside the slim package.
+
+    Args:
+        model_paths (List[str]): Model paths loaded from the source package.
+    """
+    sys.path.insert(0, PACKAGE_DIR)
+    from model_cache import precompile
+
+    for path in model_paths:
+        precompile(os.path.join(BUILD_DIR, os.path.relpath(path, PACKAGE_DIR)))
+
+def zip_dir(directory: str, output: str) -> None:
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for current, _, files in os.walk(directory):
+            for name in sorted(files):
+                path = os.path.join(current, name)
+                archive.write(path, os.path.relpath(path, directory))
+
+def dir_size(directory: str) -> int:
+    return sum(os.path.getsize(os.path.join(current, name)) for current, _, files in os.walk(directory) for name in files)
+
+def main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--services', nargs='+', default=REQUIRED_SERVICES)
+    parser.add_argument('--output', default=os.path.join(ROOT_DIR, 'deployment_package.zip'))
+    parser.add_argument('--cold-runs', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    traced = trace(PACKAGE_DIR, args.services)
+    services = model_services(traced['models'], PACKAGE_DIR) | set(args.services)
+    print(f"Traced {len(traced['models'])} models from services: {', '.join(sorted(services))}")
+
+    dropped = copy_package(services, set(traced['modules']))
+    print(f"Dropped unused build tooling: {', '.join(dropped) or 'none'}")
+    check_models(traced['models'], args.services)
+    precompile_models(traced['models'])
+    trace(BUILD_DIR, args.services)
+
+    with_build = os.path.join(os.path.dirname(BUILD_DIR), 'full.zip')
+    zip_dir(PACKAGE_DIR, with_build)
+    zip_dir(BUILD_DIR, args.output)
+
+    print(f"{'':<18}{'before':>12}{'after':>12}")
+    print(f"{'unpacked (MiB)':<18}{dir_size(PACKAGE_DIR) / 2**20:>12.1f}{dir_size(BUILD_DIR) / 2**20:>12.1f}")
+    print(f"{'zip (MiB)':<18}{os.path.getsize(with_build) / 2**20:>12.1f}{os.path.getsize(args.output) / 2**20:>12.1f}")
+    before_ms = cold_start_ms(PACKAGE_DIR, args.services, args.cold_runs)
+    after_ms = cold_start_ms(BUILD_DIR, args.services, args.cold_runs)
+    print(f"{'cold start (ms)':<18}{before_ms:>12.1f}{after_ms:>12.1f}")
+    os.remove(with_build)
+    print(f"Wrote {args.output}")
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,89 @@
+'''
+Build step that precompiles the botocore and boto3 models the chatbot loads
+into marshal files shipped inside deployment_package/. model_cache.py makes
+botocore prefer these files over decompressing and parsing the JSON models.
+
+Run it before zipping the deployment package, with the same Python version
+as the Lambda runtime (marshal data is tied to the interpreter version):
+    python tools/precompile_models.py [--services dynamodb sts] [--clean]
+'''
+
+import argparse
+import glob
+import os
+import sys
+import time
+from typing import List
+
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'deployment_package')
+sys.path.insert(0, PACKAGE_DIR)
+
+from model_cache import PRECOMPILED_SUFFIX, load_precompiled, precompile
+
+DEFAULT_SERVICES = ['dynamodb', 'sts']
+
+# Models loaded by every client regardless of the service.
+SHARED_MODELS = ['endpoints', 'partitions', 'sdk-default-configuration', '_retry']
+
+def _strip_json_ext(path: str) -> str:
+    for ext in ('.json.gz', '.json'):
+        if path.endswith(ext):
+            return path[:-len(ext)]
+    return path
+
+def model_paths(services: List[str]) -> List[str]:
+    """
+    Lists the models to precompile, as paths without the '.json' extension.
+
+    Args:
+        services (List[str]): The service names the chatbot creates clients for.
+
+    Returns:
+        List[str]: The model paths.
+    """
+    botocore_data = os.path.join(PACKAGE_DIR, 'botocore', 'data')
+    boto3_data = os.path.join(PACKAGE_DIR, 'boto3', 'data')
+
+    paths = [os.path.join(botocore_data, name) for name in SHARED_MODELS]
+    for data_dir in (botocore_data, boto3_data):
+        for service in services:
+            for path in glob.glob(os.path.join(data_dir, service, '*', '*.json*')):
+                paths.append(_strip_json_ext(path))
+    return sorted(set(paths))
+
+def clean() -> int:
+    """
+    Removes every precompiled model from the deployment package.
+
+    Returns:
+        int: The number of files removed.
+    """
+    removed = 0
+    for path in glob.glob(os.path.join(PACKAGE_DIR, '**', f'*{PRECOMPILED_SUFFIX}'), recursive=True):
+        os.remove(path)
+        removed += 1
+    return removed
+
+def main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--services', nargs='+', default=DEFAULT_SERVICES)
+    parser.add_argument('--clean', action='store_true', help='remove precompiled models and exit')
+    args = parser.parse_args(argv)
+
+    if args.clean:
+        print(f"Removed {clean()} precompiled models")
+        return
+
+    for path in model_paths(args.services):
+        written = precompile(path)
+        if written is None:
+            sys.exit(f"Missing model: {path}")
+
+        start = time.perf_counter()
+        if load_precompiled(path) is None:
+            sys.exit(f"Precompiled model does not load back: {written}")
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        print(f"{os.path.relpath(written, PACKAGE_DIR)} ({os.path.getsize(written) // 1024} KiB, {elapsed_ms:.1f} ms to load)")
+
+if __name__ == '__main__':
+    main(sys.argv[1:])